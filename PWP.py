@@ -17,21 +17,67 @@ import numpy as np
 import seawater as sw
 import matplotlib.pyplot as plt
 import xarray as xr
-import pickle
 import timeit
 import os
+import math
+import functools
 from datetime import datetime
 import PWP_helper as phf
-import imp
-import ipdb
-
-
-imp.reload(phf)
+import PWP_cache
+import PWP_catalog
+import PWP_live
+import PWP_events
+import PWP_pyramid
 
 #from IPython.core.debugger import Tracer
 #debug_here = set_trace
 
-def run(met_data, prof_data, param_kwds=None, overwrite=True, diagnostics=False, suffix='', save_plots=False):
+#order of the rows in the ColumnState block and the matching pwp_out fields
+STATE_VARS = ('temp', 'sal', 'dens', 'uvel', 'vvel')
+
+class ColumnState(object):
+    
+    """
+    Container for the model state of a single water column.
+    
+    The temperature, salinity, density and velocity profiles are stored as the rows of one 
+    contiguous (5, nz) array, state.data. The attributes t, s, d, u and v are views of these 
+    rows, so the mixing routines can modify the state in place without packing and unpacking 
+    tuples. Note that t, s, d, u and v should never be re-assigned; write into them instead 
+    (e.g. state.d[:] = density(state.s, state.t)). 
+    
+    The block is always float64, also in reduced precision runs (see the precision option of 
+    set_params): the state is only rounded to the dtype of the output arrays when it is stored.
+    """
+    
+    __slots__ = ('data', 't', 's', 'd', 'u', 'v')
+    
+    def __init__(self, data):
+        self.data = data
+        self.t, self.s, self.d, self.u, self.v = data
+        
+    @classmethod
+    def from_output(cls, pwp_out, n):
+        
+        "copy the n-th column of the model output into a new state"
+        
+        data = np.empty((len(STATE_VARS), len(pwp_out['z'])), dtype=np.float64)
+        for i, vname in enumerate(STATE_VARS):
+            data[i] = pwp_out[vname][:, n]
+            
+        return cls(data)
+        
+    def store(self, pwp_out, n):
+        
+        "write the state to the n-th column of the model output (rounded to its dtype)"
+        
+        for i, vname in enumerate(STATE_VARS):
+            pwp_out[vname][:, n] = self.data[i]
+            
+    def copy(self):
+        return ColumnState(self.data.copy())
+
+def run(met_data, prof_data, param_kwds=None, overwrite=True, diagnostics=False, suffix='', save_plots=False, save_kwds=None, use_cache=True, catalog=True):
     
     #TODO: move this to the helper file
     """
@@ -54,8 +100,11 @@ def run(met_data, prof_data, param_kwds=None, overwrite=True, diagnostics=False,
         5) Save results to output file
     
     Input: 
-    met_data -  path to netCDF file containing forcing/meterological data. This file must be in the 
-                input_data/ directory. 
+    met_data -  forcing/meteorological data: the name of a netCDF file in the input_data/ directory 
+                (or a path), a MATLAB file with the met structure of the original code (e.g. 
+                'matlab_files/met.mat'), an xarray Dataset or a dict of numpy arrays. Datasets and 
+                arrays that are already in memory are used without writing them to disk 
+                (see PWP_helper.load_input).
                 
                 The data fields should include 'time', 'sw', 'lw', 'qlat', 'qsens', 'tx', 
                 'ty', and 'precip'. These fields should store 1-D time series of the same 
@@ -69,11 +118,12 @@ def run(met_data, prof_data, param_kwds=None, overwrite=True, diagnostics=False,
                 See https://github.com/earlew/pwp_python#input-data for more info about the
                 expect intput data.
                   
-    prof_data - path to netCDF file containing initial profile data. This must be in input_data/ directory.
-                The fields of this dataset should include:
+    prof_data - initial profile data, in any of the forms accepted for met_data (e.g. 
+                'matlab_files/prof.mat'). The fields of this dataset should include:
                 ['z', 't', 's', 'lat']. These represent 1-D vertical profiles of temperature,
                 salinity and density. 'lat' is expected to be a length=1 array-like object. e.g. 
-                prof_data['lat'] = [25.0].
+                prof_data['lat'] = [25.0]. If the profile has no 'lat' (as prof.mat), it must
+                be given in param_kwds.
     
                 See https://github.com/earlew/pwp_python#input-data for more info about the
                 expect intput data.
@@ -82,17 +132,34 @@ def run(met_data, prof_data, param_kwds=None, overwrite=True, diagnostics=False,
                 every model run. If False, a unique time_stamp is generated and appended
                 to the file name. Default is True.
                 
-    diagnostics - if True, the code will generate live plots of mixed layer properties at 
-                each time step.
+    diagnostics - if True, the code will generate live plots of mixed layer properties while the 
+                model runs. The plots are drawn by a separate process every few time steps (see 
+                PWP_live.py), so they do not slow down the model. A PWP_live.LiveDiagnostics object 
+                can be passed instead to change the update interval.
     
     suffix - string to add to the end of filenames. e.g. suffix = 'nodiff' leads to 'pwp_out_nodiff.nc.
             default is an empty string ''.
 
     save_plots -this gets passed on to the makeSomePlots() function in the PWP_helper. If True, the code
-                saves the generated plots. Default is False.
+                saves the generated plots. For runs longer than 5000 time steps, the plots are then
+                rendered and saved by a separate process (see PWP_helper.plot_in_background), so run()
+                returns without waiting for them. Default is False.
                 
     param_kwds -dict containing keyword arguments for set_params function. See PWP_helper.set_params()
                 for more details. If None, default parameters are used. Default is None.
+    
+    save_kwds - dict containing keyword arguments for the save_output function (compression level, 
+                quantization, chunk size). See PWP_helper.save_output() for more details. 
+                Default is None.
+    
+    use_cache - if True, the result is looked up in the run cache (see PWP_cache.py) before the model
+                is integrated. If an identical run (same input files, parameters, save_kwds and model
+                code) is found, the stored forcing and output are opened lazily and returned instead.
+                New results are added to the cache. Runs with diagnostics=True bypass the cache.
+                Default is True.
+                
+    catalog - if True, the run is recorded in the run catalog (see PWP_catalog.py) with its inputs, 
+              parameters, timing and summary statistics. Default is True.
                 
     Output:
     
@@ -103,10 +170,10 @@ def run(met_data, prof_data, param_kwds=None, overwrite=True, diagnostics=False,
     
     This script also saves the following to file:
     
-    'pwp_output.nc'- a netCDF containing the output generated by the model.
-    'pwp_output.p' - a pickle file containing the output generated by the model.
-    'forcing.p' - a pickle file containing the (interpolated) forcing used for the model run.
-    If overwrite is set to False, a timestamp will be added to these file names.
+    'pwp_output.nc'- a compressed netCDF4 file containing the output generated by the model. The 
+                     (interpolated) forcing used for the model run is stored in its 'forcing' group
+                     and the scalar model parameters are stored as global attributes.
+    If overwrite is set to False, a timestamp will be added to the file name.
     
     ------------------------------------------------------------------------------
     There are two ways to run the model:
@@ -128,31 +195,32 @@ def run(met_data, prof_data, param_kwds=None, overwrite=True, diagnostics=False,
     #close all figures
     plt.close('all')
     
-    #start timer
+    #start timer (the time spent in each stage is recorded in the run catalog)
     t0 = timeit.default_timer()
+    timing = {}
     
     ## Get surface forcing and profile data 
     # These are x-ray datasets, but you can treat them as dicts. 
     # Do met_dset.keys() to explore the data fields
-    met_dset = xr.open_dataset('input_data/%s' %met_data) 
-    prof_dset = xr.open_dataset('input_data/%s' %prof_data)
+    # Inputs that are already in memory are used as they are (see PWP_helper.load_input).
+    met_dset = phf.load_input(met_data) 
+    prof_dset = phf.load_input(prof_data)
+    timing['load'] = timeit.default_timer()-t0
     
     ## get model parameters and constants (read docs for set_params function)
-    lat = prof_dset['lat'] #needed to compute internal wave dissipation
+    if 'lat' in prof_dset:
+        lat = prof_dset['lat'] #needed to compute internal wave dissipation
+    elif param_kwds is not None and 'lat' in param_kwds:
+        lat = param_kwds['lat']
+    else:
+        raise ValueError("The profile data has no 'lat'. Please pass it in param_kwds.")
     if param_kwds is None:
         params = phf.set_params(lat=lat) 
     else:
         param_kwds['lat'] = lat
         params = phf.set_params(**param_kwds)
     
-    ## prep forcing and initial profile data for model run (see prep_data function for more details)
-    forcing, pwp_out, params = phf.prep_data(met_dset, prof_dset, params)
-    
-    ## run the model
-    pwp_out = pwpgo(forcing, params, pwp_out, diagnostics)
-    
-         
-    ## write output to disk
+    ## name of the output file
     if overwrite:
         time_stamp = ''
     else:
@@ -161,179 +229,511 @@ def run(met_data, prof_data, param_kwds=None, overwrite=True, diagnostics=False,
     
     if len(suffix)>0 and suffix[0] != '_':
         suffix = '_%s' %suffix
-        
-    # save output as netCDF file
-    pwp_out_ds = xr.Dataset({'temp': (['z', 'time'], pwp_out['temp']), 'sal': (['z', 'time'], pwp_out['sal']), 
-                'uvel': (['z', 'time'], pwp_out['uvel']), 'vvel': (['z', 'time'], pwp_out['vvel']),
-                'dens': (['z', 'time'],  pwp_out['dens']), 'mld': (['time'],  pwp_out['mld'])}, 
-                coords={'z': pwp_out['z'], 'time': pwp_out['time']})
-
-    pwp_out_ds.to_netcdf("output/pwp_output%s%s.nc" %(suffix, time_stamp))
-
-    # also output and forcing as pickle file
-    pickle.dump(forcing, open( "output/forcing%s%s.p" %(suffix, time_stamp), "wb" ))
-    pickle.dump(pwp_out, open( "output/pwp_out%s%s.p" %(suffix, time_stamp), "wb" ))
     
-    #check timer
-    tnow = timeit.default_timer()
-    t_elapsed  = (tnow - t0)  
-    print("Time elapsed: %i minutes and %i seconds" %(np.floor(t_elapsed/60), t_elapsed%60))
-    
-    ## do analysis of the results
-    phf.makeSomePlots(forcing, pwp_out, suffix=suffix, save_plots=save_plots)
+    out_fname = "output/pwp_output%s%s.nc" %(suffix, time_stamp)
+    if save_kwds is None:
+        save_kwds = {}
+    
+    ## check the cache for an identical run
+    use_cache = use_cache and not diagnostics
+    if use_cache:
+        met_key = phf.input_path(met_data) if isinstance(met_data, str) else met_dset
+        prof_key = phf.input_path(prof_data) if isinstance(prof_data, str) else prof_dset
+        cache_key = PWP_cache.run_key(met_key, prof_key, params, save_kwds)
+        cached = PWP_cache.lookup(cache_key)
+    else:
+        cached = None
+        
+    if cached is not None:
+        print("Found an identical run in the cache. Skipping the model integration.")
+        forcing, pwp_out = cached
+        PWP_cache.retrieve(cache_key, out_fname)
+        timing['cache'] = timeit.default_timer()-t0-timing['load']
+    else:
+        ## prep forcing and initial profile data for model run (see prep_data function for more details)
+        t1 = timeit.default_timer()
+        forcing, pwp_out, params = phf.prep_data(met_dset, prof_dset, params)
+        t2 = timeit.default_timer()
+        timing['prep'] = t2-t1
+    
+    #the memory-mapped output files (see the memmap_dir option) are removed however the run ends. 
+    #The returned arrays stay readable.
+    try:
+        if cached is None:
+            ## run the model
+            pwp_out = pwpgo(forcing, params, pwp_out, diagnostics)
+            t3 = timeit.default_timer()
+            timing['model'] = t3-t2
+            
+            ## write output and forcing to disk as a compressed netCDF file
+            phf.save_output(pwp_out, out_fname, forcing=forcing, params=params, **save_kwds)
+            if use_cache:
+                PWP_cache.store(cache_key, out_fname)
+            timing['save'] = timeit.default_timer()-t3
+        
+        #check timer
+        tnow = timeit.default_timer()
+        t_elapsed  = (tnow - t0)  
+        print("Time elapsed: %i minutes and %i seconds" %(np.floor(t_elapsed/60), t_elapsed%60))
+        
+        ## do analysis of the results (long runs are binned in time before plotting, and saved from a
+        ## separate process)
+        if len(pwp_out['time']) > 5000 and save_plots:
+            phf.plot_in_background(forcing, pwp_out, suffix=suffix)
+            print("Saving the plots in the background...")
+        elif len(pwp_out['time']) > 5000:
+            phf.makeQuickPlots(forcing, pwp_out, suffix=suffix, save_plots=save_plots)
+        else:
+            phf.makeSomePlots(forcing, pwp_out, suffix=suffix, save_plots=save_plots)
+        timing['plot'] = timeit.default_timer()-tnow
+        timing['total'] = timeit.default_timer()-t0
+        
+        ## record the run in the catalog
+        if catalog:
+            PWP_catalog.record(out_fname, met_data, prof_data, params, pwp_out, timing=timing, suffix=suffix, 
+                               cached=cached is not None)
+    finally:
+        phf.remove_memmaps(pwp_out, keep_arrays=True)
     
     return forcing, pwp_out
 
-def pwpgo(forcing, params, pwp_out, diagnostics):
+def pwpgo(forcing, params, pwp_out, diagnostics, plot=True):
 
     """
     This is the main driver of the PWP module.
+    
+    diagnostics can be False, True (live plots with the default settings) or a 
+    PWP_live.LiveDiagnostics object. If plot is False, the debug plot of the final profiles is 
+    skipped.
+    
+    If params['adaptive'] is True, the model is integrated with variable step sizes instead (see 
+    pwpgo_adaptive).
     """
     
+    if params.get('adaptive', False):
+        return pwpgo_adaptive(forcing, params, pwp_out, diagnostics, plot=plot)
+    
     #unpack some of the variables 
     #This is not necessary, but I don't want to update all the variable names just yet.
-    q_in = forcing['q_in']
-    q_out = forcing['q_out']
-    emp = forcing['emp']
     taux = forcing['tx']
     tauy = forcing['ty']
-    absrb = forcing['absrb']
     
     z = pwp_out['z']
-    dz = pwp_out['dz']
     dt = pwp_out['dt']
     zlen = len(z)
     tlen = len(pwp_out['time'])
     
-    rb = params['rb']
-    rg = params['rg']
-    f = params['f']
-    cpw = params['cpw']
-    g = params['g']
-    ucon = params['ucon']
-    
-    printDragWarning = True
+    if diagnostics is True:
+        diagnostics = PWP_live.LiveDiagnostics(z)
     
     print("Number of time steps: %s" %tlen)
+    if not params['drag_ON']:
+        print("Warning: Parameterization for inertial-internal wave dispersion is turned off.")
+    
+    #carry the column state across time steps in one contiguous (5, nz) block
+    state = ColumnState.from_output(pwp_out, 0)
+    
+    #optional log of the mixing events (see PWP_events.py)
+    events = PWP_events.MixingLog(z, pwp_out['dz'], params['g']) if params.get('log_mixing', False) else None
+    
+    #optional daily/weekly/monthly aggregates, built as the steps are produced (see PWP_pyramid.py)
+    pyramid = PWP_pyramid.TimePyramid(zlen) if params.get('time_pyramid', False) else None
+    if pyramid is not None:
+        pyramid.push(pwp_out['time'][0], state.data, pwp_out['mld'][0])
     
     for n in range(1,tlen):
         percent_comp = 100*n/float(tlen)
         print('Loop iter. %s (%.1f %%)' %(n, percent_comp))
         
-        #select for previous profile data
-        temp = pwp_out['temp'][:, n-1]
-        sal = pwp_out['sal'][:, n-1]
-        dens = pwp_out['dens'][:, n-1]
-        uvel = pwp_out['uvel'][:, n-1]
-        vvel = pwp_out['vvel'][:, n-1]
-    
-        ### Absorb solar radiation and FWF in surf layer ###
+        #the surface heat and salt tendencies are built for a block of steps at a time
+        k = (n-1) % SURFACE_BLOCK
+        if k == 0:
+            n1 = min(n-1+SURFACE_BLOCK, tlen-1)
+            heat, cool, fresh = surface_operator(forcing['q_in'][n-1:n1], forcing['q_out'][n-1:n1], 
+                                                 forcing['emp'][n-1:n1], forcing['absrb'], dt, 
+                                                 pwp_out['dz'], params['cpw'])
         
-        #save initial T,S (may not be necessary)
-        temp_old = pwp_out['temp'][0, n-1]
-        sal_old = pwp_out['sal'][0, n-1] 
-    
-        #update layer 1 temp and sal
-        temp[0] = temp[0] + (q_in[n-1]*absrb[0]-q_out[n-1])*dt/(dz*dens[0]*cpw)
-        #sal[0] = sal[0]/(1-emp[n-1]*dt/dz)
-        sal[0] = sal[0] + sal[0]*emp[n-1]*dt/dz
+        mld_idx, mld, _ = pwp_step(state, params, pwp_out, dt, heat[k], cool[k], fresh[k], 
+                                   taux[n-1], tauy[n-1], n, events=events)
         
-        # debug_here()
+        ### update output profile data ###
+        state.store(pwp_out, n)
+        pwp_out['mld'][n] = mld
+        if pyramid is not None:
+            pyramid.push(pwp_out['time'][n], state.data, mld)
     
-        #check if temp is less than freezing point
-        T_fz = sw.fp(sal_old, 1) #why use sal_old? Need to recheck
-        if temp[0] < T_fz:
-            temp[0] = T_fz
+        #do diagnostics (non-blocking, see PWP_live.py)
+        if diagnostics:
+            diagnostics.push(n, pwp_out['time'][n], state, mld)
+
+    if diagnostics:
+        diagnostics.close()
+    
+    if events is not None:
+        pwp_out['mixing_events'] = events.finish(pwp_out['time'])
+    if pyramid is not None:
+        pwp_out['time_pyramid'] = pyramid.finish()
+        
+    if plot:
+        plot_final_state(state, z)
         
-        ### Absorb rad. at depth ###
-        temp[1:] = temp[1:] + q_in[n-1]*absrb[1:]*dt/(dz*dens[1:]*cpw)
+    return pwp_out
+
+def pwp_step(state, params, pwp_out, dt, heat, cool, fresh, taux, tauy, n=0, track_mixing=False, 
+             events=None):
     
-        ### compute new density ###
-        dens = sw.dens0(sal, temp)
+    """
+    Advance the column state by one time step of dt seconds. The surface forcing is held constant 
+    over the step: heat, cool and fresh are the heat and salt tendencies of the step (see 
+    surface_operator) and taux, tauy the wind stress. The state is modified in place.
+    
+    Returns (mld_idx, mld, mix_idx). If track_mixing is True, mix_idx is the deepest level whose 
+    temperature or salinity was changed by remove_si, bulk_mix or grad_mix (-1 if none); 
+    otherwise it is None.
     
-        ### relieve static instability ###
-        temp, sal, dens, uvel, vvel = remove_si(temp, sal, dens, uvel, vvel)
+    If events is a PWP_events.MixingLog, the changes made by each mixing stage are logged in it.
+    """
     
-        ### Compute MLD ###       
-        #find ml index
-        ml_thresh = params['mld_thresh']
-        mld_idx = np.flatnonzero(dens-dens[0]>ml_thresh)[0] #finds the first index that exceed ML threshold
+    z = pwp_out['z']
+    dz = pwp_out['dz']
+    zlen = len(z)
     
-        #check to ensure that ML is defined
-        assert mld_idx.size != 0, "Error: Mixed layer depth is undefined."
+    rb = params['rb']
+    rg = params['rg']
+    f = params['f']
+    g = params['g']
+    ucon = params['ucon']
     
-        #get surf MLD
-        mld = z[mld_idx]    
-        
-        ### Rotate u,v do wind input, rotate again, apply mixing ###
-        ang = -f*dt/2
-        uvel, vvel = rot(uvel, vvel, ang)
-        du = (taux[n-1]/(mld*dens[0]))*dt
-        dv = (tauy[n-1]/(mld*dens[0]))*dt
-        uvel[:mld_idx] = uvel[:mld_idx]+du
-        vvel[:mld_idx] = vvel[:mld_idx]+dv
+    #select for previous profile data
+    temp = state.t
+    sal = state.s
+    dens = state.d
+
+    ### Absorb solar radiation and FWF in surf layer ###
     
+    #save initial T,S (may not be necessary)
+    temp_old = temp[0]
+    sal_old = sal[0]
+
+    #apply the heat and salt tendencies
+    dtemp = heat/dens #absorb rad. at depth
+    dtemp[0] = (heat[0]-cool)/dens[0]
+    #sal[0] = sal[0]/(1-emp*dt/dz)
+    dsal = sal_old*fresh
+
+    #update layer 1 temp and sal, and temp at depth
+    temp += dtemp
+    sal[0] = sal[0] + dsal
 
-        ### Apply drag to current ###
-        #Original comment: this is a horrible parameterization of inertial-internal wave dispersion
-        if params['drag_ON']:
-            if ucon > 1e-10:
-                uvel = uvel*(1-dt*ucon)
-                vvel = vvel*(1-dt*ucon)
+    #check if temp is less than freezing point (which is always below 0, so warmer water is skipped)
+    if temp[0] < 0:
+        T_fz = freezing_point(float(sal_old)) #why use sal_old? Need to recheck
+        if temp[0] < T_fz:
+            temp[0] = T_fz
+
+    ### compute new density ###
+    dens[:] = density(sal, temp)
+    
+    if track_mixing:
+        ts_before = state.data[:2].copy()
+
+    ### relieve static instability ###
+    if events is not None:
+        before = state.data.copy()
+    remove_si(state)
+    if events is not None:
+        events.record(n, 'remove_si', before, state)
+
+    ### Compute MLD ###       
+    #find ml index
+    ml_thresh = params['mld_thresh']
+    mld_idx = np.flatnonzero(dens-dens[0]>ml_thresh)[0] #finds the first index that exceed ML threshold
+
+    #check to ensure that ML is defined
+    assert mld_idx.size != 0, "Error: Mixed layer depth is undefined."
+
+    #get surf MLD
+    mld = z[mld_idx]    
+    
+    ### Rotate u,v do wind input, rotate again, apply mixing ###
+    ang = -f*dt/2
+    uvel, vvel = rot(state.u, state.v, ang)
+    du = (taux/(mld*dens[0]))*dt
+    dv = (tauy/(mld*dens[0]))*dt
+    uvel[:mld_idx] = uvel[:mld_idx]+du
+    vvel[:mld_idx] = vvel[:mld_idx]+dv
+
+    ### Apply drag to current ###
+    #Original comment: this is a horrible parameterization of inertial-internal wave dispersion
+    if params['drag_ON'] and ucon > 1e-10:
+        if dt == params['dt']:
+            drag = 1-dt*ucon
         else:
-            if printDragWarning:
-                print("Warning: Parameterization for inertial-internal wave dispersion is turned off.")
-                printDragWarning = False
+            #keep the damping per unit time of the nominal step (see pwpgo_adaptive)
+            drag = (1-params['dt']*ucon)**(dt/params['dt'])
+        uvel = uvel*drag
+        vvel = vvel*drag
+
+    state.u[:], state.v[:] = rot(uvel, vvel, ang)
 
-        uvel, vvel = rot(uvel, vvel, ang)
+    ### Apply Bulk Richardson number instability form of mixing (as in PWP) ###
+    if rb > 1e-5:
+        if events is not None:
+            before = state.data.copy()
+        bulk_mix(state, g, rb, zlen, z, mld_idx)
+        if events is not None:
+            events.record(n, 'bulk_mix', before, state)
+
+    ### Do the gradient Richardson number instability form of mixing ###
+    if rg > 0:
+        if events is not None:
+            before = state.data.copy()
+        grad_mix(state, dz, g, rg, zlen, n)
+        if events is not None:
+            events.record(n, 'grad_mix', before, state)
+        
+    if track_mixing:
+        changed = np.flatnonzero((state.data[:2] != ts_before).any(axis=0))
+        mix_idx = changed[-1] if len(changed) > 0 else -1
+    else:
+        mix_idx = None
+    
+    ### Apply diffusion ###
+    if params['rkz'] > 0:
+        dstab = params['dstab'] if dt == params['dt'] else params['dstab']*dt/params['dt']
+        diffus(dstab, zlen, state.t) 
+        diffus(dstab, zlen, state.s) 
+        state.d[:] = density(state.s, state.t)
+        diffus(dstab, zlen, state.u)
+        diffus(dstab, zlen, state.v)
+        
+    return mld_idx, mld, mix_idx
+
+def pwpgo_adaptive(forcing, params, pwp_out, diagnostics=False, grow_after=2, plot=True):
+    
+    """
+    Integrate the model with variable step sizes. The forcing and output stay on the regular time 
+    grid of prep_data (step dt), but the model itself takes steps of dt*2**k, with k between 
+    -params['max_sub'] and params['max_long'] (see set_params for the thresholds):
+    
+    - Long steps (k > 0) are only taken while the column is quiet: the wind stress over the 
+      whole step is below params['tau_lo'] (N/m2) and the previous grow_after steps did not 
+      entrain (mix below the layer mixed in the step before). The surface fluxes are averaged 
+      over the step. The profiles of the skipped time steps are interpolated linearly between 
+      the start and end of the step, and their MLD is that of the nearer of the two.
+    - A step in which the mixing stages (remove_si, bulk_mix, grad_mix) entrain more than 
+      params['entrain_max'] levels below the layer mixed in the previous step is rejected and 
+      repeated with half the step size, until the smallest step is reached. If params['max_sub'] 
+      > 0, this goes on below dt (sub-cycling), and steps are also sub-cycled while the wind 
+      stress is above params['tau_hi'].
+    
+    Steps are aligned so that every regular output time is hit exactly. Long steps are also 
+    limited so that the diffusion remains stable. The drag is applied with the damping rate of 
+    the regular step.
+    
+    The chosen step sizes (seconds) are stored in pwp_out['step_sizes'] and a summary is printed.
+    diagnostics and plot are as for pwpgo.
+    """
+    
+    q_in = forcing['q_in']
+    q_out = forcing['q_out']
+    emp = forcing['emp']
+    taux = forcing['tx']
+    tauy = forcing['ty']
+    absrb = forcing['absrb']
+    tau = np.hypot(taux, tauy)
     
-        ### Apply Bulk Richardson number instability form of mixing (as in PWP) ###
-        if rb > 1e-5:
-            temp, sal, dens, uvel, vvel = bulk_mix(temp, sal, dens, uvel, vvel, g, rb, zlen, z, mld_idx)
+    z = pwp_out['z']
+    dt = pwp_out['dt']
+    zlen = len(z)
+    tlen = len(pwp_out['time'])
     
-        ### Do the gradient Richardson number instability form of mixing ###
-        if rg > 0:
-            temp, sal, dens, uvel, vvel = grad_mix(temp, sal, dens, uvel, vvel, dz, g, rg, zlen,n)
+    max_sub = params['max_sub']
+    max_long = params['max_long']
+    tau_lo = params['tau_lo']
+    tau_hi = params['tau_hi']
+    entrain_max = params['entrain_max']
+    if params['rkz'] > 0:
+        #diffusion is only stable for dstab <= 0.5
+        while max_long > 0 and params['dstab']*2**max_long > 0.5:
+            max_long -= 1
+    
+    if diagnostics is True:
+        diagnostics = PWP_live.LiveDiagnostics(z)
+    
+    print("Number of output time steps: %s (adaptive stepping)" %tlen)
+    if not params['drag_ON']:
+        print("Warning: Parameterization for inertial-internal wave dispersion is turned off.")
+    
+    state = ColumnState.from_output(pwp_out, 0)
+    events = PWP_events.MixingLog(z, pwp_out['dz'], params['g']) if params.get('log_mixing', False) else None
+    pyramid = PWP_pyramid.TimePyramid(zlen) if params.get('time_pyramid', False) else None
+    if pyramid is not None:
+        pyramid.push(pwp_out['time'][0], state.data, pwp_out['mld'][0])
+    
+    #time is counted in ticks of the smallest step, T ticks per regular step
+    T = 2**max_sub
+    end_tick = (tlen-1)*T
+    tick = 0
+    k = 0
+    calm = 0
+    mixed_idx = np.flatnonzero(state.d-state.d[0] > params['mld_thresh'])[0]
+    n_stored = 0
+    step_sizes = []
+    n_rejected = 0
+    
+    while tick < end_tick:
+        
+        #largest step allowed by the alignment and the end of the run
+        k_step = k
+        while k_step > -max_sub and (tick % 2**(k_step+max_sub) != 0 or tick+2**(k_step+max_sub) > end_tick):
+            k_step -= 1
+        k_aligned = k_step
+        
+        #limit the step by the wind stress over its span
+        while True:
+            width = 2**(k_step+max_sub)
+            i0 = tick//T
+            i1 = (tick+width-1)//T+1
+            tau_max = tau[i0:i1].max()
+            if k_step > 0 and tau_max >= tau_lo:
+                k_step -= 1
+            elif k_step > -1 and k_step > -max_sub and tau_max > tau_hi:
+                k_step -= 1
+            else:
+                break
+        
+        #take the step, halving it if it entrains too much
+        while True:
+            width = 2**(k_step+max_sub)
+            h = dt*width/T
+            i0 = tick//T
+            i1 = (tick+width-1)//T+1
+            heat, cool, fresh = surface_operator(q_in[i0:i1].mean(keepdims=True), q_out[i0:i1].mean(keepdims=True), 
+                                                 emp[i0:i1].mean(keepdims=True), absrb, h, pwp_out['dz'], params['cpw'])
             
+            backup = state.data.copy()
+            mark = None if events is None else events.mark()
+            mld_idx, mld, mix_idx = pwp_step(state, params, pwp_out, h, heat[0], cool[0], fresh[0], 
+                                             taux[i0:i1].mean(), tauy[i0:i1].mean(), i0+1, 
+                                             track_mixing=True, events=events)
+            entrain = mix_idx+1-mixed_idx
+            if entrain > entrain_max and k_step > -max_sub:
+                state.data[:] = backup
+                if events is not None:
+                    events.rollback(mark)
+                n_rejected += 1
+                k_step -= 1
+                continue
+            break
+        
+        step_sizes.append(h)
+        tick += width
+        #depth (index) of the layer mixed in this step, which the next step is compared to
+        mixed_idx = max(mld_idx, mix_idx+1)
         
-        ### Apply diffusion ###
-        if params['rkz'] > 0:
-            temp = diffus(params['dstab'], zlen, temp) 
-            sal = diffus(params['dstab'], zlen, sal) 
-            dens = sw.dens0(sal, temp)
-            uvel = diffus(params['dstab'], zlen, uvel)
-            vvel = diffus(params['dstab'], zlen, vvel)
+        #return to the regular step once the entrainment has eased, and grow beyond it after a 
+        #few steps without any entrainment. A step that was only shortened to hit the alignment 
+        #keeps the step size k that is aimed for.
+        calm = calm+1 if entrain <= 0 else 0
+        if k_step < 0:
+            k = k_step+1 if 2*entrain <= entrain_max else k_step
+        elif entrain > 0:
+            k = 0
+        elif k_step < k_aligned:
+            k = k_step
+        elif calm >= grow_after and k < max_long:
+            k = k+1
+            calm = 0
         
         ### update output profile data ###
-        pwp_out['temp'][:, n] = temp 
-        pwp_out['sal'][:, n] = sal 
-        pwp_out['dens'][:, n] = dens
-        pwp_out['uvel'][:, n] = uvel
-        pwp_out['vvel'][:, n] = vvel
-        pwp_out['mld'][n] = mld
+        if tick % T == 0:
+            n = tick//T
+            state.store(pwp_out, n)
+            pwp_out['mld'][n] = mld
+            if n-n_stored > 1:
+                #fill the output times that were skipped by a long step
+                w = np.arange(1, n-n_stored)/float(n-n_stored)
+                for vname in STATE_VARS:
+                    a0 = pwp_out[vname][:, n_stored]
+                    a1 = pwp_out[vname][:, n]
+                    pwp_out[vname][:, n_stored+1:n] = (a0[:, np.newaxis]*(1-w) + a1[:, np.newaxis]*w)
+                #the MLD is a grid depth, so it is taken from the nearest computed step
+                pwp_out['mld'][n_stored+1:n] = np.where(w < 0.5, pwp_out['mld'][n_stored], mld)
+            if pyramid is not None:
+                for m in range(n_stored+1, n+1):
+                    pyramid.push_stored(pwp_out, m)
+            n_stored = n
+            
+            if diagnostics:
+                diagnostics.push(n, pwp_out['time'][n], state, mld)
+    
+    if diagnostics:
+        diagnostics.close()
+    
+    step_sizes = np.array(step_sizes)
+    pwp_out['step_sizes'] = step_sizes
+    if events is not None:
+        pwp_out['mixing_events'] = events.finish(pwp_out['time'])
+    if pyramid is not None:
+        pwp_out['time_pyramid'] = pyramid.finish()
+    print("Adaptive stepping: %s steps (%s rejected) instead of %s. Step sizes %.2f to %.2f hours, mean %.2f hours." 
+          %(len(step_sizes), n_rejected, tlen-1, step_sizes.min()/3600., step_sizes.max()/3600., step_sizes.mean()/3600.))
+    
+    if plot:
+        plot_final_state(state, z)
     
-        #do diagnostics
-        if diagnostics==1:
-            phf.livePlots(pwp_out, n)
+    return pwp_out
 
+def plot_final_state(state, z):
+    
+    "debug plot of the final profiles"
+    
     fig,ax = plt.subplots(1,4)
-    ax[0].plot(temp,z)
+    ax[0].plot(state.t,z)
     ax[0].set_title("temp")
-    ax[1].plot(sal)
+    ax[1].plot(state.s)
     ax[1].set_title("sal")
-    ax[2].plot(dens)
+    ax[2].plot(state.d)
     ax[2].set_title("denS")
-    ax[3].plot(np.diff(dens))
+    ax[3].plot(np.diff(state.d))
     ax[3].axvline(0,color="black")
     ax[3].set_title("dens diff")
     for i in range(4):
         ax[i].invert_yaxis()
         ax[i].grid(linewidth=.3)
     plt.show()
-        
-    return pwp_out
     
 
+#number of time steps for which surface_operator builds the surface tendencies at once
+SURFACE_BLOCK = 256
+
+def surface_operator(q_in, q_out, emp, absrb, dt, dz, cpw):
+    
+    """
+    Heat and salt tendencies of the surface forcing for a block of time steps, built in one go 
+    from the forcing arrays (in float64):
+    
+    heat: (nsteps, nz) radiative heating q_in*absrb*dt/(dz*cpw). Dividing it by the density 
+          gives the temperature change of each layer.
+    cool: (nsteps,) surface heat loss q_out*dt/(dz*cpw), taken from the first layer.
+    fresh: (nsteps,) relative salinity change emp*dt/dz of the first layer.
+    """
+    
+    fac = dt/(dz*cpw)
+    heat = np.outer(np.asarray(q_in, dtype=np.float64)*fac, absrb)
+    cool = np.asarray(q_out, dtype=np.float64)*fac
+    fresh = np.asarray(emp, dtype=np.float64)*(dt/dz)
+    
+    return heat, cool, fresh
+
+def freezing_point(s):
+    
+    #Freezing point (UNESCO 1983) at the surface (1 dbar) for salinity s, as sw.fp(s, 1), but 
+    #on a python float, without the array overhead.
+    return (-0.0575*s + 1.710523e-3*s*math.sqrt(s) - 2.154996e-4*s*s - 7.53e-4)/1.00024
+
+@functools.lru_cache(maxsize=32)
 def absorb(beta1, beta2, zlen, dz):
     
     # Compute solar radiation absorption profile. This
@@ -354,55 +754,55 @@ def absorb(beta1, beta2, zlen, dz):
     z2b2 = z2/beta2
     absrb = rs1*(np.exp(-z1b1)-np.exp(-z2b1))+rs2*(np.exp(-z1b2)-np.exp(-z2b2))
     
+    #the profile is cached (and shared between runs), so it must not be modified
+    absrb.flags.writeable = False
+    
     return absrb
     
-def remove_si(t, s, d, u, v):
+def remove_si(state):
     
     # Find and relieve static instability that may occur in the
     # density array 'd'. This simulates free convection.
     # ml_index is the index of the depth of the surface mixed layer after adjustment,
     
-    stat_unstable = True
+    #Mixing down to level j only changes the density of levels 0..j, so only the first j+1 
+    #density differences are recomputed after each mix, and the search for the next instability 
+    #starts below the mixed layer (whose levels have identical densities).
+    d_diff = np.diff(state.d)
+    start = 0
       
-    while stat_unstable:
-        
-        d_diff = np.diff(d)
-        if np.any(d_diff<0):
-            stat_unstable=True
-            first_inst_idx = np.flatnonzero(d_diff<0)[0]
-            d0 = d
-            (t, s, d, u, v) = mix5(t, s, d, u, v, first_inst_idx+1)
-            
-            #plot density 
-            # plt.figure(num=86)
-            # plt.clf() #probably redundant
-            # plt.plot(d0-1000, range(len(d0)), 'b-', label='pre-mix')
-            # plt.plot(d-1000, range(len(d0)), 'r-', label='post-mix')
-            # plt.gca().invert_yaxis()
-            # plt.xlabel('Density-1000 (kg/m3)')
-            # plt.grid(True)
-            # plt.pause(0.05)
-            # plt.show()
-            
-            #debug_here()           
-        else:
-            stat_unstable = False
+    while True:
+        
+        unstable = np.flatnonzero(d_diff[start:]<0)
+        if len(unstable) == 0:
+            break
+        first_inst_idx = start+unstable[0]
+        mix5(state, first_inst_idx+1)
+        
+        j = first_inst_idx+2
+        d_diff[:j] = np.diff(state.d[:j+1])
+        start = j-1
             
-    return t, s, d, u, v
+    return state
     
     
-def mix5(t, s, d, u, v, j):
+def mix5(state, j):
     
     #This subroutine mixes the arrays t, s, u, v down to level j.
+    #All five rows are averaged in one pass, then density is recomputed from the mixed t and s.
     j = j+1 #so that the j-th layer is included in the mixing
-    t[:j] = np.mean(t[:j])
-    s[:j] = np.mean(s[:j])
-    d[:j] = sw.dens0(s[:j], t[:j])
-    u[:j] = np.mean(u[:j])
-    v[:j] = np.mean(v[:j])
+    col = state.data[:, :j]
+    col[:] = col.mean(axis=1, dtype=np.float64)[:, np.newaxis]
+    state.d[:j] = density(state.s[:j], state.t[:j])
     
-    return t, s, d, u, v
+    return state
             
+def density(s, t):
+    
+    #Surface referenced density. The equation of state is always evaluated in float64 since the
+    #stability checks and the MLD criterion depend on small density differences.
+    return sw.dens0(np.asarray(s, dtype=np.float64), np.asarray(t, dtype=np.float64))
+    
 def rot(u, v, ang):
     
     #This subroutine rotates the vector (u,v) through an angle, ang
@@ -412,10 +812,13 @@ def rot(u, v, ang):
     
     return u, v   
     
-def bulk_mix(t, s, d, u, v, g, rb, nz, z, mld_idx):
+def bulk_mix(state, g, rb, nz, z, mld_idx):
     #sub-routine to do bulk richardson mixing
     
     rvc = rb #critical rich number??
+    d = state.d
+    u = state.u
+    v = state.v
     
     for j in range(mld_idx, nz):
         h   = z[j]
@@ -430,11 +833,11 @@ def bulk_mix(t, s, d, u, v, g, rb, nz, z, mld_idx):
         if rv > rvc:
             break
         else:
-            t, s, d, u, v = mix5(t, s, d, u, v, j)
+            mix5(state, j)
             
-    return t, s, d, u, v
+    return state
 
-def grad_mix(t, s, d, u, v, dz, g, rg, nz,n):
+def grad_mix(state, dz, g, rg, nz, n):
     
     #copied from source script:
     # %  This function performs the gradeint Richardson Number relaxation
@@ -447,53 +850,62 @@ def grad_mix(t, s, d, u, v, dz, g, rg, nz,n):
     #print "entered grad mix"
     
     rc = rg #critical rich. number
-    j1 = 0
-    j2 = nz-1
-    j_range = np.arange(j1,j2)
+    
+    #the Richardson number of the whole profile is computed once. Stirring cells j and j+1 only 
+    #changes the Richardson number of the interfaces j-1, j and j+1, so only these are recomputed
+    #before the next search for the minimum.
+    r = richardson(state, dz, g, 0, nz-1)
     i = 0 #loop count
-    #debug_here()
     
     while 1:
-        #TODO: find a better way to do implement this loop
         
-        r = np.zeros(len(j_range))
-        
-        for j in j_range:
-            
-            dd = (d[j+1]-d[j])/d[j]
-            dv = (u[j+1]-u[j])**2+(v[j+1]-v[j])**2
-            if dv==0 or dv<1e-10:
-                r[j] = np.inf
-            else:
-                #compute grad. rich. number
-                r[j] = g*dz*dd/dv                
-         
-        #debug_here()       
         #find the smallest value of r in the profile
-        r_min = np.min(r)
         j_min_idx = np.argmin(r)
-        
+        r_min = r[j_min_idx]
+
+        #a column that has blown up (NaN) can never be stirred to a stable state
+        if np.isnan(r_min):
+            raise FloatingPointError("non-finite Richardson number in grad_mix at step %s" %n)
+
         #Check to see whether the smallest r is critical or not.
         if r_min > rc:
             break
             
         #Mix the cells j_min_idx and j_min_idx+1 that had the smallest Richardson Number
-        t, s, d, u, v = stir(t, s, d, u, v, rc, r_min, j_min_idx,n)
+        stir(state, rc, r_min, j_min_idx, n)
         
         #recompute the rich number over the part of the profile that has changed
-        j1 = j_min_idx-2
+        j1 = j_min_idx-1
         if j1 < 1:
              j1 = 0
         
         j2 = j_min_idx+2
         if j2 > nz-1:
              j2 = nz-1
+        
+        r[j1:j2] = richardson(state, dz, g, j1, j2)
              
         i+=1
                      
-    return t, s, d, u, v
+    return state
+
+def richardson(state, dz, g, j1, j2):
+    
+    #gradient Richardson number at the interfaces j1..j2-1 (between cells j and j+1). Returned in 
+    #float64, with inf where the velocity difference is negligible.
+    d = state.d[j1:j2+1]
+    u = state.u[j1:j2+1]
+    v = state.v[j1:j2+1]
+    
+    dd = (d[1:]-d[:-1])/d[:-1]
+    dv = (u[1:]-u[:-1])**2+(v[1:]-v[:-1])**2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r = (g*dz*dd/dv).astype(np.float64)
+    r[dv<1e-10] = np.inf
+    
+    return r
                 
-def stir(t, s, d, u, v, rc, r, j,n):
+def stir(state, rc, r, j, n):
     
     #copied from source script:
     
@@ -514,31 +926,16 @@ def stir(t, s, d, u, v, rc, r, j,n):
     rnew = rc+rcon/5.
     f = 1-r/rnew
     
-    #mix temp
-    dt = (t[j+1]-t[j])*f/2.
-    t[j+1] = t[j+1]-dt
-    t[j] = t[j]+dt
-    
-    #mix sal
-    ds = (s[j+1]-s[j])*f/2.
-    s[j+1] = s[j+1]-ds
-    s[j] = s[j]+ds
-    
-    #recompute density 
-    #d[j:j+1] = sw.dens0(s[j:j+1], t[j:j+1]) 
-    #have to be careful here. x[j:j+1] in python is not the same as x[[j,j+1]]. We want the latter
-    #ipdb.set_trace(context=9,cond=n>=12)
-    d[[j,j+1]] = sw.dens0(s[[j,j+1]], t[[j,j+1]])
-    
-    du = (u[j+1]-u[j])*f/2
-    u[j+1] = u[j+1]-du
-    u[j] = u[j]+du
+    #mix temp, sal, u and v of cells j and j+1 in one go (columns of the state block)
+    pair = state.data[:, j:j+2]
+    delta = (pair[:, 1]-pair[:, 0])*f/2.
+    pair[:, 1] = pair[:, 1]-delta
+    pair[:, 0] = pair[:, 0]+delta
     
-    dv = (v[j+1]-v[j])*f/2
-    v[j+1] = v[j+1]-dv
-    v[j] = v[j]+dv
+    #recompute density of cells j and j+1
+    state.d[j:j+2] = density(state.s[j:j+2], state.t[j:j+2])
     
-    return t, s, d, u, v
+    return state
     
 def diffus(dstab,nz,a):
     
@@ -556,10 +953,7 @@ if __name__ == "__main__":
     
     #forcing_fname = 'beaufort_met.nc'
     forcing_fname = 'Svalbard_Lufthavn.nc'
-<<<<<<< HEAD
     #prof_fname = 'beaufort_profile.nc'
-=======
->>>>>>> 9d09f0ada4b8e8be56eff0926702185ddb433d4f
     prof_fname = 'input_januar.nc'
     print("Running Test Case 1 with data from Beaufort gyre...")
     forcing, pwp_out = run(met_data=forcing_fname, prof_data=prof_fname, suffix='demo1_SvalLuft_januarCTD', save_plots=True, diagnostics=False)
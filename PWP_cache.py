@@ -0,0 +1,250 @@
+"""
+This module contains a cache of PWP model results.
+
+A cached result is the netCDF output of a run (see PWP_helper.save_output), stored under a key
+that is the hash of the forcing file, the profile file, the full parameter dictionary and the
+model code (the modules in CODE_MODULES). Inputs that are passed in memory (Datasets or dicts of
+arrays) are hashed by their contents instead of their file. PWP.run() looks up the key before integrating, so re-running
+an identical configuration just re-opens the stored output.
+
+The cache lives in output/cache/ and is bounded in size: the least recently used entries are
+removed once the total size exceeds CACHE_MAX_BYTES. Use invalidate() to remove entries by hand.
+"""
+
+import os
+import hashlib
+import shutil
+import numpy as np
+import xarray as xr
+
+CACHE_DIR = 'output/cache'
+CACHE_MAX_BYTES = 2*1024**3 #2 GB
+
+#modules that compute the results of a run, or write and read its stored output. A change to any
+#of them invalidates the cached results; the services that only run the model (workers, schedulers,
+#live plots) are left out.
+CODE_MODULES = ['PWP.py', 'PWP_helper.py', 'PWP_cache.py', 'PWP_sparse.py', 'PWP_events.py', 'PWP_pyramid.py']
+
+#parameters that do not affect the model results
+IGNORED_PARAMS = ['memmap_dir']
+
+#file hashes computed by this process, keyed by (path, mtime, size)
+_file_hashes = {}
+
+def file_hash(path):
+
+    "sha256 hex digest of the contents of a file"
+
+    st = os.stat(path)
+    memo_key = (os.path.abspath(path), st.st_mtime, st.st_size)
+    if memo_key not in _file_hashes:
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(2**20), b''):
+                h.update(block)
+        _file_hashes[memo_key] = h.hexdigest()
+
+    return _file_hashes[memo_key]
+
+def data_hash(dset):
+
+    "sha256 hex digest of an in-memory input (Dataset or dict of arrays): names, dtypes, shapes and values"
+
+    names = dset.variables if hasattr(dset, 'variables') else dset
+    h = hashlib.sha256()
+    for vname in sorted(names):
+        arr = np.asarray(dset[vname])
+        h.update(('%s;%s;%s;' %(vname, arr.dtype.str, arr.shape)).encode())
+        if arr.dtype.hasobject:
+            h.update(repr(arr.tolist()).encode())
+        else:
+            h.update(np.ascontiguousarray(arr).view(np.uint8))
+
+    return h.hexdigest()
+
+def input_hash(data):
+
+    "hash of a model input, which is either a file name or an in-memory dataset"
+
+    if isinstance(data, str):
+        return file_hash(data)
+
+    return data_hash(data)
+
+def code_version():
+
+    "hash of the model source code, so that results are not reused across code changes"
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    h = hashlib.sha256()
+    for fname in CODE_MODULES:
+        h.update(file_hash(os.path.join(here, fname)).encode())
+
+    return h.hexdigest()
+
+def params_repr(params):
+
+    """
+    Canonical string representation of a parameter dictionary. Array-like values (e.g. lat, which
+    is often an xarray DataArray) are converted to plain python numbers first.
+    """
+
+    items = []
+    for key in sorted(params):
+        if key in IGNORED_PARAMS:
+            continue
+        val = params[key]
+        if not isinstance(val, str) and val is not None:
+            val = np.asarray(val).tolist()
+        items.append('%s=%r' %(key, val))
+
+    return ';'.join(items)
+
+def run_key(met_data, prof_data, params, save_kwds=None):
+
+    """
+    cache key of a model run. The inputs are file paths or in-memory datasets (see input_hash).
+    save_kwds (e.g. quantization) change the stored output, so they are included.
+    """
+
+    h = hashlib.sha256()
+    h.update(input_hash(met_data).encode())
+    h.update(input_hash(prof_data).encode())
+    h.update(params_repr(params).encode())
+    h.update(params_repr(save_kwds or {}).encode())
+    h.update(code_version().encode())
+
+    return h.hexdigest()
+
+def entry_path(key):
+    return os.path.join(CACHE_DIR, '%s.nc' %key)
+
+def lookup(key):
+
+    """
+    Return (forcing, pwp_out) for a cached run, or None if the key is not in the cache.
+
+    The output is opened lazily: forcing and pwp_out are dicts of xarray DataArrays (plus the
+    scalars dt, dz and lat in pwp_out) that are only read from disk when they are used.
+    """
+
+    fname = entry_path(key)
+    if not os.path.exists(fname):
+        return None
+
+    #mark the entry as recently used
+    os.utime(fname, None)
+
+    out_ds = xr.open_dataset(fname)
+    forcing_ds = xr.open_dataset(fname, group='forcing')
+
+    pwp_out = {}
+    for vname in out_ds.variables:
+        pwp_out[vname] = out_ds[vname]
+
+    #keyframe encoded profiles (see PWP_sparse.py) are decoded into memory
+    if 'keyframe_every' in out_ds.attrs:
+        import netCDF4
+        import PWP_sparse
+        with netCDF4.Dataset(fname, 'r') as nc:
+            for vname in ['temp', 'sal', 'dens', 'uvel', 'vvel']:
+                if PWP_sparse.is_encoded(nc, vname):
+                    pwp_out[vname] = PWP_sparse.read_variable(nc, vname)
+    for vname in ['dt', 'dz', 'lat']:
+        pwp_out[vname] = out_ds.attrs[vname]
+
+    forcing = {}
+    for vname in forcing_ds.variables:
+        forcing[vname] = forcing_ds[vname]
+
+    #runs with log_mixing=True also have the mixing event log (see PWP_events.py)
+    if out_ds.attrs.get('log_mixing', 0):
+        events_ds = xr.open_dataset(fname, group='mixing_events')
+        pwp_out['mixing_events'] = {vname: events_ds[vname].values for vname in events_ds.variables}
+
+    #and runs with time_pyramid=True the aggregated levels (see PWP_pyramid.py)
+    if out_ds.attrs.get('time_pyramid', 0):
+        import PWP_pyramid
+        pwp_out['time_pyramid'] = {}
+        for name, _ in PWP_pyramid.LEVELS:
+            level_ds = xr.open_dataset(fname, group='pyramid_%s' %name)
+            pwp_out['time_pyramid'][name] = {vname: level_ds[vname].values for vname in level_ds.variables}
+
+    return forcing, pwp_out
+
+def store(key, fname):
+
+    """
+    Add the output file fname (written by PWP_helper.save_output) to the cache under key. The file
+    is hard-linked into the cache if possible, and copied otherwise. Old entries are evicted if the
+    cache grows beyond CACHE_MAX_BYTES.
+    """
+
+    if not os.path.isdir(CACHE_DIR):
+        os.makedirs(CACHE_DIR)
+
+    dest = entry_path(key)
+    if os.path.exists(dest):
+        os.remove(dest)
+    try:
+        os.link(fname, dest)
+    except OSError:
+        shutil.copyfile(fname, dest)
+
+    evict()
+
+def retrieve(key, fname):
+
+    "put a copy (hard link if possible) of a cached output file at fname"
+
+    if os.path.exists(fname):
+        os.remove(fname)
+    try:
+        os.link(entry_path(key), fname)
+    except OSError:
+        shutil.copyfile(entry_path(key), fname)
+
+def detach(fname):
+
+    """
+    Make fname a file of its own before it is modified in place: if it is hard-linked (e.g. to a
+    cache entry, see store and retrieve), it is replaced by a copy, so the other links keep their
+    content.
+    """
+
+    if os.stat(fname).st_nlink > 1:
+        tmp = fname + '.detach'
+        shutil.copy2(fname, tmp)
+        os.replace(tmp, fname)
+
+def evict(max_bytes=None):
+
+    "remove the least recently used entries until the cache is smaller than max_bytes"
+
+    if max_bytes is None:
+        max_bytes = CACHE_MAX_BYTES
+    if not os.path.isdir(CACHE_DIR):
+        return
+
+    entries = []
+    for fname in os.listdir(CACHE_DIR):
+        path = os.path.join(CACHE_DIR, fname)
+        st = os.stat(path)
+        entries.append((st.st_mtime, st.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        os.remove(path)
+        total -= size
+
+def invalidate(key=None):
+
+    "remove a single entry from the cache, or the whole cache if key is None"
+
+    if key is None:
+        if os.path.isdir(CACHE_DIR):
+            shutil.rmtree(CACHE_DIR)
+    elif os.path.exists(entry_path(key)):
+        os.remove(entry_path(key))
@@ -0,0 +1,382 @@
+"""
+This module contains a driver that calibrates the mixing parameters (rb, rg, rkz) and the
+extinction coefficients (beta1, beta2) of set_params against observed CTD profiles.
+
+A candidate parameter set is scored by its misfit to the observations: the RMS temperature and
+salinity differences and the MLD difference, each divided by a typical scale (see SCALES),
+summed over the observed profiles. The search is a cross-entropy method, a derivative-free
+optimizer that works on batches: each generation, a batch of candidates is drawn from a normal
+distribution (in parameter space scaled to the unit cube), all of them are run in parallel, and
+the distribution is moved to the best (elite) candidates.
+
+The forcing and the initial profiles are published once in shared memory (see PWP_shared.py).
+Each run is watched by a MisfitMonitor, which scores the observed profiles as the model passes
+them. Since the misfit only grows as more profiles are scored, a run is aborted as soon as its
+partial misfit exceeds abort_factor times the best complete misfit so far, or when the state
+blows up. Note that this can only cut runs short if there are observations before the end of
+the run.
+
+Usage:
+
+    >> import PWP_calibrate
+    >> obs = PWP_calibrate.read_ctd('ctd_cast.txt') #exported like Dariabastelt/IsK_14Jan2021_salinity.txt
+    >> best_kwds, history = PWP_calibrate.calibrate('met.nc', 'initial_profile.nc', obs, obs_time=10.)
+    >> forcing, pwp_out = PWP.run('met.nc', 'initial_profile.nc', param_kwds=best_kwds)
+"""
+
+import os
+import timeit
+import contextlib
+from multiprocessing import Pool
+
+import numpy as np
+import xarray as xr
+
+import PWP_shared
+
+#default search space: (lower bound, upper bound) of each calibrated parameter.
+#The upper bound of rkz keeps the diffusion stable for the default dt and dz (dt*rkz/dz**2 <= 0.5).
+SPACE = {'rb': (0.3, 1.0), 'rg': (0.1, 0.5), 'rkz': (0., 4e-5), 'beta1': (0.3, 1.5), 'beta2': (5., 30.)}
+
+#typical misfits of temperature (C), salinity and MLD (m) that are counted as one unit of misfit
+SCALES = {'t': 0.1, 's': 0.02, 'mld': 5.}
+
+#shared inputs of the calibration workers, attached once per worker process (see init_worker)
+_worker = {}
+
+class RunAborted(Exception):
+
+    "raised by MisfitMonitor to stop a run that can no longer beat the best candidate"
+
+    pass
+
+def read_ctd(fname, dz=1.):
+
+    """
+    Read a CTD cast exported as a tab separated text file (as IsK_14Jan2021_salinity.txt), keep
+    the downcast and average it in dz (m) bins.
+
+    Returns an xarray Dataset with t and s on the z coordinate (mean depth of each bin).
+    """
+
+    import pandas as pd
+
+    df = pd.read_csv(fname, sep='\t', skiprows=[0, 1, 2], encoding='latin-1')
+    df = df.rename(columns={'Depth(u)': 'z', 'Temp': 't', 'Sal.': 's'})[['z', 't', 's']]
+
+    #keep the downcast, i.e. everything up to the deepest sample
+    df = df.iloc[:df['z'].values.argmax()+1]
+
+    bins = np.floor(df['z'].values/dz)
+    df = df.groupby(bins).mean()
+
+    return xr.Dataset({'t': ('z', df['t'].values), 's': ('z', df['s'].values)}, coords={'z': df['z'].values})
+
+def mixed_layer_depth(sal, temp, z, thresh):
+
+    """
+    Depth of the first level whose density exceeds that of the uppermost valid level by more
+    than thresh (kg/m3). NaN levels are ignored; if no level does, the deepest valid depth is
+    returned.
+    """
+
+    import PWP
+
+    valid = np.isfinite(sal) & np.isfinite(temp)
+    dens = PWP.density(sal[valid], temp[valid])
+    deep = np.flatnonzero(dens-dens[0] > thresh)
+    zv = z[valid]
+
+    return zv[deep[0]] if len(deep) > 0 else zv[-1]
+
+def observed_profiles(obs, model_z, model_time, obs_time=None, mld_thresh=0.03):
+
+    """
+    Put the observations on the model grid.
+
+    obs is a Dataset with t and s on a z coordinate, plus an optional time dimension (model
+    days). Without one, the profile is taken to be observed at obs_time, or at the end of the
+    run if obs_time is None.
+
+    Returns a list of dicts (one per profile) with the model output step 'n', the profiles 't'
+    and 's' interpolated to model_z (NaN outside of the observed depth range) and the 'mld'.
+    """
+
+    if 'time' not in obs.dims:
+        obs = obs.expand_dims(time=[model_time[-1] if obs_time is None else obs_time])
+
+    profiles = []
+    for i in range(obs.sizes['time']):
+        prof = obs.isel(time=i).dropna('z', how='all').sortby('z')
+        n = int(np.abs(model_time-float(prof['time'])).argmin())
+
+        #the initial profile does not depend on the parameters, so compare with the first step at least
+        n = max(n, 1)
+        t = np.interp(model_z, prof['z'].values, prof['t'].values, left=np.nan, right=np.nan)
+        s = np.interp(model_z, prof['z'].values, prof['s'].values, left=np.nan, right=np.nan)
+        profiles.append({'n': n, 't': t, 's': s, 'mld': mixed_layer_depth(s, t, model_z, mld_thresh)})
+
+    profiles.sort(key=lambda prof: prof['n'])
+
+    return profiles
+
+def profile_misfit(prof, temp, sal, z, mld_thresh=0.03, scales=SCALES):
+
+    "misfit of the model profiles temp and sal to one observed profile (see observed_profiles)"
+
+    valid = np.isfinite(prof['t'])
+    rms_t = np.sqrt(np.mean((temp[valid]-prof['t'][valid])**2))
+    rms_s = np.sqrt(np.mean((sal[valid]-prof['s'][valid])**2))
+    d_mld = mixed_layer_depth(sal, temp, z, mld_thresh)-prof['mld']
+
+    return (rms_t/scales['t'])**2 + (rms_s/scales['s'])**2 + (d_mld/scales['mld'])**2
+
+class MisfitMonitor(object):
+
+    """
+    Scores a run against the observed profiles while it is integrated. It is passed to pwpgo in
+    place of the live diagnostics, so push() is called after every stored time step.
+
+    INPUT:
+    pwp_out: output dict of the run (the profiles are read from it, so that the output steps
+             that adaptive runs interpolate are scored as well).
+    profiles: list of observed profiles from observed_profiles().
+    limit: the run is aborted (RunAborted) once its misfit exceeds limit. [np.inf]
+    check_every: the state is checked for NaNs every check_every steps. [24]
+    """
+
+    def __init__(self, pwp_out, profiles, limit=np.inf, mld_thresh=0.03, scales=SCALES, check_every=24):
+
+        self.pwp_out = pwp_out
+        self.profiles = profiles
+        self.limit = limit
+        self.mld_thresh = mld_thresh
+        self.scales = scales
+        self.check_every = check_every
+        self.score = 0.
+        self.scored = 0
+        self.n = 0
+
+    def push(self, n, time, state, mld):
+
+        self.n = n
+        if n % self.check_every == 0 and not np.isfinite(state.data).all():
+            self.score = np.inf
+            raise RunAborted("non-finite state at step %s" %n)
+
+        while self.scored < len(self.profiles) and self.profiles[self.scored]['n'] <= n:
+            prof = self.profiles[self.scored]
+            temp = np.asarray(self.pwp_out['temp'][:, prof['n']], dtype=np.float64)
+            sal = np.asarray(self.pwp_out['sal'][:, prof['n']], dtype=np.float64)
+            self.score += profile_misfit(prof, temp, sal, self.pwp_out['z'], self.mld_thresh, self.scales)
+            self.scored += 1
+
+            #the misfit can only grow with the remaining profiles
+            if not self.score <= self.limit:
+                raise RunAborted("misfit %.3g exceeds %.3g at step %s" %(self.score, self.limit, n))
+
+    def close(self):
+
+        pass
+
+def init_worker(forcing_desc, init_desc, params, profiles, mld_thresh, scales):
+
+    "Pool initializer: attach the shared forcing and initial profiles once per worker process"
+
+    import matplotlib
+    matplotlib.use('Agg')
+    import PWP
+
+    _worker.clear()
+    _worker['forcing'] = PWP_shared.attach(forcing_desc)
+    _worker['init'] = PWP_shared.attach(init_desc)
+    _worker['params'] = params
+    _worker['profiles'] = profiles
+    _worker['mld_thresh'] = mld_thresh
+    _worker['scales'] = scales
+
+def evaluate(args):
+
+    """
+    Run the model with one candidate parameter set and score it.
+    Returns (i, score, status, last step, elapsed seconds), where status is 'ok', 'aborted',
+    'unstable' (the diffusion would be unstable) or the error raised by the run.
+    """
+
+    import PWP
+    import PWP_helper as phf
+
+    i, values, limit = args
+    t0 = timeit.default_timer()
+
+    params = dict(_worker['params'])
+    params.update(values)
+    params['dstab'] = params['dt']*params['rkz']/params['dz']**2
+    if params['dstab'] > 0.5:
+        return i, np.inf, 'unstable', 0, timeit.default_timer()-t0
+
+    #the absorption profile is the only part of the prepared forcing that depends on the parameters
+    forcing = dict(_worker['forcing'])
+    zlen = len(_worker['init']['z'])
+    forcing['absrb'] = PWP.absorb(params['beta1'], params['beta2'], zlen, params['dz']).astype(forcing['absrb'].dtype)
+
+    pwp_out = PWP_shared.new_output(_worker['init'], params.get('memmap_dir'))
+    monitor = MisfitMonitor(pwp_out, _worker['profiles'], limit, _worker['mld_thresh'], _worker['scales'])
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            PWP.pwpgo(forcing, params, pwp_out, monitor, plot=False)
+        status = 'ok'
+    except RunAborted:
+        status = 'aborted'
+    except Exception as err:
+        monitor.score = np.inf
+        status = repr(err)
+    finally:
+        phf.remove_memmaps(pwp_out)
+
+    score = monitor.score if status == 'ok' else max(monitor.score, limit)
+
+    return i, score, status, monitor.n, timeit.default_timer()-t0
+
+def calibrate(met_data, prof_data, obs, param_kwds=None, space=None, obs_time=None, mld_thresh=0.03,
+              scales=None, batch_size=None, generations=8, elite_frac=0.25, abort_factor=2., processes=None, seed=0):
+
+    """
+    Calibrate model parameters against observed profiles.
+
+    INPUT:
+    met_data, prof_data: forcing and initial profile, file names in input_data/ or in-memory data
+                         (see PWP_helper.load_input).
+    obs: observed profiles, a CTD file name (see read_ctd) or a Dataset with t and s on a z
+         coordinate and an optional time dimension (model days).
+    param_kwds: dict with keyword arguments for set_params for the parameters that are not
+                calibrated (lat is taken from the profile). Calibrated parameters given here
+                are used as one of the first candidates. [None]
+    space: dict with the (lower bound, upper bound) of each calibrated parameter. [SPACE]
+    obs_time: model day of a single observed profile without a time dimension. If None, it is
+              taken to be at the end of the run. [None]
+    mld_thresh: density criterion (kg/m3) for the MLD of both the observations and the model
+                when scoring. It is coarser than the model's own mld_thresh, since CTD
+                densities are noisy. [0.03]
+    scales: typical misfits that count as one unit of misfit (see SCALES). [None]
+    batch_size: candidates per generation. If None, two per process (at least 8). [None]
+    generations: number of generations. [8]
+    elite_frac: fraction of each batch that the search distribution is fitted to. [0.25]
+    abort_factor: runs are stopped once their partial misfit exceeds abort_factor times the
+                  best misfit so far. [2]
+    processes: number of worker processes. If None, the number of CPUs is used. [None]
+    seed: seed of the random number generator. [0]
+
+    OUTPUT:
+    best_kwds: param_kwds with the best calibrated parameters, e.g. for PWP.run.
+    history: xarray Dataset with every evaluated candidate (eval, param), its misfit, status
+             and run time. The best misfit and the elapsed time are stored in its attrs.
+    """
+
+    import PWP_helper as phf
+
+    t0 = timeit.default_timer()
+    if space is None:
+        space = SPACE
+    if scales is None:
+        scales = SCALES
+    if param_kwds is None:
+        param_kwds = {}
+    if processes is None:
+        processes = os.cpu_count()
+    if batch_size is None:
+        batch_size = max(8, 2*processes)
+
+    met_data = phf.load_input(met_data)
+    prof_data = phf.load_input(prof_data)
+    if isinstance(obs, str):
+        obs = read_ctd(obs)
+
+    kwds = dict(param_kwds)
+    kwds['lat'] = float(np.asarray(prof_data['lat']).squeeze())
+    params = phf.set_params(**kwds)
+    forcing, pwp_out, params = phf.prep_data(met_data, prof_data, params)
+    profiles = observed_profiles(obs, pwp_out['z'], pwp_out['time'][:len(pwp_out['mld'])], obs_time, mld_thresh)
+
+    names = list(space)
+    lower = np.array([space[name][0] for name in names], dtype=np.float64)
+    width = np.array([space[name][1]-space[name][0] for name in names], dtype=np.float64)
+
+    #the search distribution lives in the unit cube
+    rng = np.random.default_rng(seed)
+    mean = np.full(len(names), 0.5)
+    std = np.full(len(names), 0.3)
+    start = np.clip((np.array([params[name] for name in names])-lower)/width, 0., 1.)
+    n_elite = max(2, int(round(elite_frac*batch_size)))
+
+    candidates = []
+    scores = []
+    status = []
+    steps = []
+    run_time = []
+    generation = []
+    best_score = np.inf
+    best = None
+
+    forcing_desc, forcing_shm = PWP_shared.publish(forcing)
+    init_desc, init_shm = PWP_shared.publish(PWP_shared.initial_output(pwp_out))
+    initargs = (forcing_desc, init_desc, params, profiles, mld_thresh, scales)
+    print("Calibrating %s on %s processes: %s generations of %s candidates..." %(', '.join(names), processes, generations, batch_size))
+    try:
+        with Pool(processes, initializer=init_worker, initargs=initargs) as pool:
+            for gen in range(generations):
+                if gen == 0:
+                    unit = rng.uniform(size=(batch_size, len(names)))
+                    unit[0] = start
+                else:
+                    unit = np.clip(mean + std*rng.standard_normal((batch_size, len(names))), 0., 1.)
+                values = lower + unit*width
+
+                limit = abort_factor*best_score
+                jobs = [(i, dict(zip(names, values[i])), limit) for i in range(batch_size)]
+                gen_scores = np.full(batch_size, np.inf)
+                for i, score, stat, step, elapsed in pool.imap_unordered(evaluate, jobs):
+                    gen_scores[i] = score
+                    candidates.append(values[i])
+                    scores.append(score)
+                    status.append(stat)
+                    steps.append(step)
+                    run_time.append(elapsed)
+                    generation.append(gen)
+                    if stat == 'ok' and score < best_score:
+                        best_score = score
+                        best = values[i]
+
+                #fit the search distribution to the elite candidates (smoothed to avoid early collapse)
+                elite = unit[np.argsort(gen_scores)[:n_elite]]
+                mean = 0.7*elite.mean(axis=0) + 0.3*mean
+                std = np.maximum(0.7*elite.std(axis=0) + 0.3*std, 0.02)
+
+                n_aborted = status[-batch_size:].count('aborted')
+                print("Generation %s: best misfit %.4g, %s of %s runs aborted" %(gen, best_score, n_aborted, batch_size))
+    finally:
+        PWP_shared.release(forcing_shm)
+        PWP_shared.release(init_shm)
+
+    if best is None:
+        raise RuntimeError("None of the candidate parameter sets could be run.")
+
+    best_kwds = {key: val for key, val in param_kwds.items() if key != 'lat'}
+    best_kwds.update({name: float(val) for name, val in zip(names, best)})
+
+    history = xr.Dataset({'values': (['eval', 'param'], np.array(candidates)),
+                          'misfit': (['eval'], np.array(scores)),
+                          'status': (['eval'], np.array(status, dtype=object)),
+                          'last_step': (['eval'], np.array(steps)),
+                          'run_time': (['eval'], np.array(run_time)),
+                          'generation': (['eval'], np.array(generation))},
+                         coords={'param': names})
+    t_elapsed = timeit.default_timer()-t0
+    history.attrs['best_misfit'] = best_score
+    history.attrs['elapsed'] = t_elapsed
+    history.attrs['processes'] = processes
+
+    print("Best parameters: %s" %', '.join('%s=%.4g' %(name, best_kwds[name]) for name in names))
+    print("Time elapsed: %i minutes and %i seconds" %(np.floor(t_elapsed/60), t_elapsed%60))
+
+    return best_kwds, history
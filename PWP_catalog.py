@@ -0,0 +1,287 @@
+"""
+This module contains a catalog of PWP model runs.
+
+Every run made with PWP.run() (and every job of PWP_worker.py) is recorded in a SQLite database,
+output/catalog.sqlite: the output file, the input files and their hashes, the full parameter
+dictionary, the wall time and the time spent in each stage, and a few summary statistics of the
+result (max MLD, final SST and SSS, heat content change). Runs can then be compared and searched
+without opening their output files:
+
+    >> runs = PWP_catalog.find(params={'rg': 0.25}, met_name='Svalbard*', order_by='max_mld', descending=True)
+    >> [(r['out_fname'], r['max_mld']) for r in runs]
+
+The scalar parameters are also stored one row per run and parameter in an indexed table, so
+queries on parameter values do not scan the whole catalog. Output files written before the
+catalog existed can be added with add_output().
+"""
+
+import os
+import json
+import sqlite3
+from datetime import datetime
+
+import numpy as np
+
+CATALOG_DB = 'output/catalog.sqlite'
+
+#columns of the runs table (besides the id) and their SQL types
+RUN_COLUMNS = (('created', 'TEXT'), ('out_fname', 'TEXT'), ('suffix', 'TEXT'),
+               ('met_name', 'TEXT'), ('prof_name', 'TEXT'), ('met_hash', 'TEXT'), ('prof_hash', 'TEXT'),
+               ('cached', 'INTEGER'), ('params', 'TEXT'), ('wall_time', 'REAL'), ('timing', 'TEXT'),
+               ('ntime', 'INTEGER'), ('days', 'REAL'), ('max_mld', 'REAL'), ('final_mld', 'REAL'),
+               ('final_sst', 'REAL'), ('final_sss', 'REAL'), ('heat_change', 'REAL'), ('salt_change', 'REAL'))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY AUTOINCREMENT, %s);
+CREATE TABLE IF NOT EXISTS run_params (run_id INTEGER REFERENCES runs(id) ON DELETE CASCADE,
+                                       name TEXT, value REAL, text TEXT);
+CREATE INDEX IF NOT EXISTS run_params_value ON run_params (name, value, run_id);
+CREATE INDEX IF NOT EXISTS run_params_text ON run_params (name, text, run_id);
+CREATE INDEX IF NOT EXISTS runs_met ON runs (met_name);
+CREATE INDEX IF NOT EXISTS runs_prof ON runs (prof_name);
+CREATE INDEX IF NOT EXISTS runs_met_hash ON runs (met_hash);
+CREATE INDEX IF NOT EXISTS runs_max_mld ON runs (max_mld);
+CREATE INDEX IF NOT EXISTS runs_created ON runs (created);
+""" %', '.join('%s %s' %col for col in RUN_COLUMNS)
+
+#relative tolerance of parameter matches in find(), so that e.g. rg=0.25 matches 0.25000000001
+PARAM_RTOL = 1e-9
+
+def connect(db=None):
+
+    "open the catalog database (CATALOG_DB if db is None), creating it if needed"
+
+    if db is None:
+        db = CATALOG_DB
+    dirname = os.path.dirname(db)
+    if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname)
+
+    #concurrent runs (e.g. the workers of PWP_worker.py) wait for each other's writes
+    conn = sqlite3.connect(db, timeout=60.)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA foreign_keys = ON')
+    conn.executescript(SCHEMA)
+
+    return conn
+
+def plain_params(params):
+
+    "params as a dict of plain python values (lat is often a DataArray), as stored in the catalog"
+
+    plain = {}
+    for key, val in params.items():
+        if val is not None and not isinstance(val, str):
+            val = np.asarray(val).tolist()
+        plain[key] = val
+
+    return plain
+
+def summary_stats(pwp_out, dz=None, cpw=4183.3):
+
+    """
+    Summary statistics of a model output (pwp_out, or a Dataset of an output file): number of
+    steps, length of the run (days), max and final MLD (m), final SST and SSS and the change of the
+    depth integrated heat (J/m^2) and salt (kg/m^2) content between the first and last step.
+    Only the first and last profiles are read.
+    """
+
+    if dz is None:
+        dz = float(pwp_out['dz'])
+    time = np.asarray(pwp_out['time'])
+    mld = np.asarray(pwp_out['mld'], dtype=np.float64)
+    first = {vname: np.asarray(pwp_out[vname][:, 0], dtype=np.float64) for vname in ['temp', 'sal', 'dens']}
+    last = {vname: np.asarray(pwp_out[vname][:, -1], dtype=np.float64) for vname in ['temp', 'sal', 'dens']}
+
+    heat0 = np.sum(first['dens']*first['temp'])*cpw*dz
+    heat1 = np.sum(last['dens']*last['temp'])*cpw*dz
+    salt0 = np.sum(first['dens']*first['sal'])*dz/1000.
+    salt1 = np.sum(last['dens']*last['sal'])*dz/1000.
+
+    return {'ntime': len(time), 'days': float(time[-1]-time[0]),
+            'max_mld': float(np.nanmax(mld)), 'final_mld': float(mld[-1]),
+            'final_sst': float(last['temp'][0]), 'final_sss': float(last['sal'][0]),
+            'heat_change': float(heat1-heat0), 'salt_change': float(salt1-salt0)}
+
+def record(out_fname, met_data, prof_data, params, pwp_out, timing=None, suffix='', cached=False, db=None):
+
+    """
+    Add a run to the catalog.
+
+    INPUT:
+    out_fname: path of the output file.
+    met_data, prof_data: the inputs of the run, file names (as for PWP.run) or in-memory datasets.
+    params: the parameter dictionary of the run.
+    pwp_out: the model output, used for the summary statistics.
+    timing: dict with the time (seconds) spent in each stage, e.g. {'prep': .., 'model': ..}. The
+            wall time is timing['total'], or the sum of the stages. [None]
+    suffix: suffix of the output file name. ['']
+    cached: True if the result was taken from the run cache (see PWP_cache.py). [False]
+    db: catalog database. [CATALOG_DB]
+
+    OUTPUT:
+    id of the new catalog entry.
+    """
+
+    import PWP_cache
+    import PWP_helper as phf
+
+    if timing is None:
+        timing = {}
+    plain = plain_params(params)
+
+    row = {'created': datetime.now().isoformat(timespec='seconds'),
+           'out_fname': os.path.abspath(out_fname), 'suffix': suffix, 'cached': int(cached),
+           'params': json.dumps(plain, sort_keys=True),
+           'wall_time': timing.get('total', sum(timing.values())),
+           'timing': json.dumps(timing, sort_keys=True)}
+    for key, data in [('met', met_data), ('prof', prof_data)]:
+        if isinstance(data, str):
+            path = phf.input_path(data)
+            row['%s_name' %key] = os.path.basename(path)
+            row['%s_hash' %key] = PWP_cache.input_hash(path)
+        else:
+            row['%s_name' %key] = None
+            row['%s_hash' %key] = PWP_cache.input_hash(data)
+    row.update(summary_stats(pwp_out, dz=plain.get('dz'), cpw=plain.get('cpw', 4183.3)))
+
+    return insert(row, plain, db)
+
+def insert(row, plain, db=None):
+
+    "insert a row of the runs table and its parameters (see record) and return its id"
+
+    names = [col for col, _ in RUN_COLUMNS]
+    conn = connect(db)
+    try:
+        with conn:
+            cur = conn.execute('INSERT INTO runs (%s) VALUES (%s)' %(', '.join(names), ', '.join('?'*len(names))),
+                               [row[col] for col in names])
+            run_id = cur.lastrowid
+            conn.executemany('INSERT INTO run_params (run_id, name, value, text) VALUES (?, ?, ?, ?)',
+                             [(run_id,)+param_value(name, val) for name, val in plain.items()])
+    finally:
+        conn.close()
+
+    return run_id
+
+def param_value(name, val):
+
+    "(name, value, text) row of run_params: numbers (and booleans) go in value, strings in text"
+
+    if isinstance(val, (bool, int, float)):
+        return (name, float(val), None)
+    if isinstance(val, str):
+        return (name, None, val)
+    return (name, None, json.dumps(val))
+
+def find(params=None, order_by='id', descending=False, limit=None, db=None, **filters):
+
+    """
+    Search the catalog.
+
+    INPUT:
+    params: dict of parameter values that the runs must have, e.g. {'rg': 0.25, 'precision': 'float32'}.
+            A value can also be a (min, max) tuple. [None]
+    order_by: column of the runs table to sort by (see RUN_COLUMNS), e.g. 'max_mld'. ['id']
+    descending: sort in descending order. [False]
+    limit: maximum number of runs returned. [None]
+    db: catalog database. [CATALOG_DB]
+    filters: values of columns of the runs table, e.g. met_name='Svalbard_Lufthavn.nc' or
+             cached=0. Strings with * or ? are matched as patterns (e.g. met_name='Svalbard*').
+
+    OUTPUT:
+    list of dicts, one per run, with the columns of the runs table. 'params' and 'timing' are
+    decoded into dicts.
+    """
+
+    names = ['id']+[col for col, _ in RUN_COLUMNS]
+    if order_by not in names:
+        raise ValueError("Cannot sort by %r. Use one of %s" %(order_by, ', '.join(names)))
+
+    where = []
+    args = []
+    for col, val in filters.items():
+        if col not in names:
+            raise ValueError("Unknown column %r. Use one of %s" %(col, ', '.join(names)))
+        if isinstance(val, str) and ('*' in val or '?' in val):
+            where.append('runs.%s GLOB ?' %col)
+        else:
+            where.append('runs.%s = ?' %col)
+        args.append(val)
+
+    #each parameter condition is an indexed lookup in run_params
+    for name, val in (params or {}).items():
+        if isinstance(val, tuple):
+            lo, hi = val
+            cond = 'value BETWEEN ? AND ?'
+            vals = [lo, hi]
+        elif isinstance(val, (bool, int, float)):
+            tol = PARAM_RTOL*max(abs(val), 1.)
+            cond = 'value BETWEEN ? AND ?'
+            vals = [val-tol, val+tol]
+        else:
+            cond = 'text = ?'
+            vals = [val]
+        where.append('runs.id IN (SELECT run_id FROM run_params WHERE name = ? AND %s)' %cond)
+        args.extend([name]+vals)
+
+    sql = 'SELECT * FROM runs'
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    sql += ' ORDER BY %s %s' %(order_by, 'DESC' if descending else 'ASC')
+    if limit is not None:
+        sql += ' LIMIT %i' %limit
+
+    conn = connect(db)
+    try:
+        rows = conn.execute(sql, args).fetchall()
+    finally:
+        conn.close()
+
+    runs = []
+    for row in rows:
+        run = dict(row)
+        run['params'] = json.loads(run['params'])
+        run['timing'] = json.loads(run['timing'])
+        runs.append(run)
+
+    return runs
+
+def remove(run_ids, db=None):
+
+    "remove the runs with the given ids from the catalog (the output files are not touched)"
+
+    conn = connect(db)
+    try:
+        with conn:
+            conn.executemany('DELETE FROM runs WHERE id = ?', [(int(i),) for i in np.atleast_1d(run_ids)])
+    finally:
+        conn.close()
+
+def add_output(fname, db=None):
+
+    """
+    Add an existing output file (written by PWP_helper.save_output) to the catalog. The parameters
+    are read from its attributes; the input files and timing are unknown, so they are left empty.
+    Returns the id of the new entry.
+    """
+
+    import netCDF4
+    import PWP_sparse
+
+    with netCDF4.Dataset(fname, 'r') as nc:
+        params = {key: nc.getncattr(key) for key in nc.ncattrs()}
+        out = {'time': nc.variables['time'][:], 'mld': np.ma.filled(nc.variables['mld'][:], np.nan),
+               'dz': params.get('dz', 1.)}
+        for vname in ['temp', 'sal', 'dens']:
+            out[vname] = PWP_sparse.read_variable(nc, vname, [0, len(out['time'])-1])
+
+    plain = plain_params(params)
+    row = {'created': datetime.fromtimestamp(os.path.getmtime(fname)).isoformat(timespec='seconds'),
+           'out_fname': os.path.abspath(fname), 'suffix': None, 'cached': 0,
+           'params': json.dumps(plain, sort_keys=True), 'wall_time': None, 'timing': json.dumps({}),
+           'met_name': None, 'prof_name': None, 'met_hash': None, 'prof_hash': None}
+    row.update(summary_stats(out, cpw=plain.get('cpw', 4183.3)))
+
+    return insert(row, plain, db)
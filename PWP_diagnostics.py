@@ -0,0 +1,221 @@
+"""
+This module contains derived diagnostics of the PWP model output.
+
+All functions work on whole (z, time) arrays at once (numpy arrays or xarray DataArrays), so
+they are meant to be applied after the run rather than inside the model loop. Depth integrals
+are sums over the model layers times dz, consistent with the layer formulation of the model.
+
+add_diagnostics() adds all of them to an output Dataset in one pass. stream_diagnostics() does
+the same for an output file, reading it chunk by chunk, so runs that do not fit in memory can
+be processed.
+"""
+
+import numpy as np
+import xarray as xr
+
+import PWP_sparse
+
+G = 9.81 #acceleration due to gravity (m/s^2), as in set_params
+CPW = 4183.3 #specific heat of water (J/kgC), as in set_params
+
+def heat_content(temp, dens, dz, cpw=CPW):
+
+    "depth integrated heat content, sum(rho*cpw*T)*dz (J/m^2)"
+
+    return (dens*temp).sum(axis=0)*cpw*dz
+
+def salt_content(sal, dens, dz):
+
+    "depth integrated salt content, sum(rho*S/1000)*dz (kg/m^2)"
+
+    return (dens*sal).sum(axis=0)*dz/1000.
+
+def kinetic_energy(uvel, vvel, dens, dz):
+
+    "depth integrated kinetic energy, sum(0.5*rho*(u^2+v^2))*dz (J/m^2)"
+
+    return (0.5*dens*(uvel**2+vvel**2)).sum(axis=0)*dz
+
+def momentum(uvel, vvel, dens, dz):
+
+    "depth integrated momentum, sum(rho*|u|)*dz (kg/m/s)"
+
+    return (dens*np.sqrt(uvel**2+vvel**2)).sum(axis=0)*dz
+
+def buoyancy_freq(dens, dz, g=G):
+
+    """
+    Squared buoyancy frequency N^2 = g/rho*drho/dz (1/s^2) at the interfaces between layers,
+    i.e. an array with one level fewer than dens.
+    """
+
+    dens = np.asarray(dens)
+    rho_mid = 0.5*(dens[1:]+dens[:-1])
+
+    return g*(dens[1:]-dens[:-1])/(dz*rho_mid)
+
+def layer_heat_content(temp, dens, dz, nlev, cpw=CPW):
+
+    "heat content of the top nlev layers (J/m^2)"
+
+    return heat_content(temp[:nlev], dens[:nlev], dz, cpw)
+
+def time_rate(x, time):
+
+    "time derivative of x (per day, since the model time is in days)"
+
+    return np.gradient(np.asarray(x), np.asarray(time), axis=-1)
+
+def output_dataset(pwp_out):
+
+    "package the (z, time) model output in pwp_out as an xarray Dataset"
+
+    ntime = np.asarray(pwp_out['mld']).shape[0]
+    data_vars = {}
+    for vname in ['temp', 'sal', 'dens', 'uvel', 'vvel']:
+        data_vars[vname] = (['z', 'time'], np.asarray(pwp_out[vname]))
+    data_vars['mld'] = (['time'], np.asarray(pwp_out['mld']))
+    coords = {'z': np.asarray(pwp_out['z']), 'time': np.asarray(pwp_out['time'])[:ntime]}
+
+    return xr.Dataset(data_vars, coords=coords)
+
+def column_diagnostics(temp, sal, dens, uvel, vvel, dz, surf_depth=None, cpw=CPW, g=G):
+
+    """
+    Compute the diagnostics that only need the profiles at each time step (no time derivatives).
+    Returns a dict of (name, (dims, values)) pairs that can be passed to xr.Dataset.
+    """
+
+    diags = {}
+    diags['heat_content'] = (['time'], heat_content(temp, dens, dz, cpw))
+    diags['salt_content'] = (['time'], salt_content(sal, dens, dz))
+    diags['ke'] = (['time'], kinetic_energy(uvel, vvel, dens, dz))
+    diags['momentum'] = (['time'], momentum(uvel, vvel, dens, dz))
+    diags['N2'] = (['z_mid', 'time'], buoyancy_freq(dens, dz, g))
+    if surf_depth is not None:
+        nlev = int(round(surf_depth/dz))
+        diags['surf_heat_content'] = (['time'], layer_heat_content(temp, dens, dz, nlev, cpw))
+
+    return diags
+
+def add_diagnostics(ds, dz=None, forcing=None, surf_depth=None, cpw=CPW, g=G):
+
+    """
+    Add derived diagnostics to a model output Dataset (e.g. xr.open_dataset('output/pwp_output.nc')
+    or output_dataset(pwp_out)), computed in one vectorized pass.
+
+    Variables added:
+    heat_content, salt_content: depth integrated heat (J/m^2) and salt (kg/m^2) content.
+    ke, momentum: depth integrated kinetic energy (J/m^2) and momentum (kg/m/s).
+    N2: squared buoyancy frequency at the layer interfaces (z_mid, time) (1/s^2).
+    mld_rate: MLD deepening rate (m/day).
+    heat_content_rate: rate of change of the heat content (W/m^2).
+
+    If surf_depth (m) is given, the heat budget of the surface layer above it is added as well:
+    surf_heat_content (J/m^2), its rate of change surf_heat_rate (W/m^2) and, if the forcing is
+    given, the net surface heat flux surf_qnet (W/m^2) and the residual surf_heat_resid (W/m^2),
+    i.e. the heat exchanged with the water below by mixing and penetrating radiation.
+    """
+
+    if dz is None:
+        dz = float(ds['z'][1]-ds['z'][0])
+
+    diags = column_diagnostics(ds['temp'].values, ds['sal'].values, ds['dens'].values, ds['uvel'].values,
+                               ds['vvel'].values, dz, surf_depth, cpw, g)
+    ds = ds.assign(diags)
+    ds = ds.assign_coords(z_mid=0.5*(ds['z'].values[1:]+ds['z'].values[:-1]))
+
+    return add_rates(ds, forcing, surf_depth)
+
+def add_rates(ds, forcing=None, surf_depth=None):
+
+    "add the time derivatives of the diagnostics in ds (see add_diagnostics)"
+
+    time = ds['time'].values
+    sec_per_day = 86400.
+    ds['mld_rate'] = (['time'], time_rate(ds['mld'].values, time))
+    ds['heat_content_rate'] = (['time'], time_rate(ds['heat_content'].values, time)/sec_per_day)
+
+    if surf_depth is not None:
+        ds['surf_heat_rate'] = (['time'], time_rate(ds['surf_heat_content'].values, time)/sec_per_day)
+        if forcing is not None:
+            ntime = len(time)
+            qnet = np.asarray(forcing['q_in'])[:ntime] - np.asarray(forcing['q_out'])[:ntime]
+            ds['surf_qnet'] = (['time'], qnet)
+            ds['surf_heat_resid'] = ds['surf_heat_rate'] - ds['surf_qnet']
+
+    return ds
+
+def stream_diagnostics(fname, chunk=2000, surf_depth=None, cpw=CPW, g=G, write=True):
+
+    """
+    Compute the diagnostics of add_diagnostics() for an output file written by
+    PWP_helper.save_output, reading chunk time steps at a time, so only one chunk of the
+    (z, time) variables is in memory at once.
+
+    If write is True, the diagnostics are added to the file: the (z_mid, time) diagnostics (N2)
+    are written chunk by chunk as they are computed and are not part of the returned Dataset (read
+    them from the file, e.g. with xr.open_dataset). A file that is hard-linked to a cache entry is
+    copied first (see PWP_cache.detach), so the cached result is not modified. If write is False,
+    N2 is gathered in memory and returned. The forcing stored in the file is used for the surface
+    layer heat budget. Returns a Dataset with the diagnostics.
+    """
+
+    import netCDF4
+    import PWP_cache
+
+    if write:
+        PWP_cache.detach(fname)
+
+    with netCDF4.Dataset(fname, 'a' if write else 'r') as nc:
+        z = nc.variables['z'][:]
+        time = nc.variables['time'][:]
+        mld = nc.variables['mld'][:]
+        dz = float(z[1]-z[0])
+        ntime = len(time)
+        z_mid = 0.5*(z[1:]+z[:-1])
+        if write and 'z_mid' not in nc.dimensions:
+            nc.createDimension('z_mid', len(z)-1)
+            nc.createVariable('z_mid', 'f8', ('z_mid',))[:] = z_mid
+
+        #the time series are kept for the rates, the profiles are written out (or gathered)
+        series = []
+        profiles = {}
+        for t0 in range(0, ntime, chunk):
+            cols = [PWP_sparse.read_variable(nc, vname, slice(t0, t0+chunk))
+                    for vname in ['temp', 'sal', 'dens', 'uvel', 'vvel']]
+            diags = column_diagnostics(*cols, dz=dz, surf_depth=surf_depth, cpw=cpw, g=g)
+            for vname, (dims, vals) in list(diags.items()):
+                if 'z_mid' not in dims:
+                    continue
+                del diags[vname]
+                if write:
+                    if vname not in nc.variables:
+                        nc.createVariable(vname, 'f8', dims, zlib=True, shuffle=True)
+                    nc.variables[vname][:, t0:t0+vals.shape[-1]] = vals
+                else:
+                    profiles.setdefault(vname, (dims, []))[1].append(vals)
+            series.append(diags)
+
+        forcing = None
+        if 'forcing' in nc.groups:
+            grp = nc.groups['forcing']
+            forcing = {'q_in': grp.variables['q_in'][:], 'q_out': grp.variables['q_out'][:]}
+
+        data_vars = {}
+        for vname, (dims, _) in series[0].items():
+            data_vars[vname] = (dims, np.concatenate([p[vname][1] for p in series], axis=-1))
+        for vname, (dims, parts) in profiles.items():
+            data_vars[vname] = (dims, np.concatenate(parts, axis=-1))
+        data_vars['mld'] = (['time'], mld)
+        ds = xr.Dataset(data_vars, coords={'time': time, 'z_mid': z_mid})
+        ds = add_rates(ds, forcing, surf_depth)
+        ds = ds.drop_vars('mld')
+
+        if write:
+            for vname in ds.data_vars:
+                if vname not in nc.variables:
+                    nc.createVariable(vname, 'f8', ds[vname].dims, zlib=True, shuffle=True)
+                nc.variables[vname][:] = ds[vname].values
+
+    return ds
@@ -0,0 +1,217 @@
+"""
+This module generates ensembles of stochastically perturbed forcing and runs the model on them.
+
+make_ensemble() takes the forcing prepared by prep_data and perturbs the wind stress (tx, ty), the
+shortwave radiation (sw), the latent heat flux (qlat) and the precipitation (precip) with red
+noise, i.e. a first order autoregressive (AR1) process with a given amplitude and decorrelation
+time. All members are generated at once: the noise is a (member, time) array, filtered along
+time in one call. The members are returned as a Dataset of (member, time) arrays of the fields
+that the model uses, so an ensemble is a single object (and a single file, if it is saved with
+to_netcdf) rather than a forcing file per member.
+
+run_ensemble() integrates the model for every member in parallel. The base forcing, the
+ensemble and the initial profiles are published once in shared memory (see PWP_shared.py).
+
+Usage:
+
+    >> forcing, pwp_out, params = PWP_helper.prep_data(met_dset, prof_dset, params)
+    >> ens = PWP_ensemble.make_ensemble(forcing, params, 50, seed=1)
+    >> results = PWP_ensemble.run_ensemble(forcing, pwp_out, params, ens)
+"""
+
+import os
+import contextlib
+from multiprocessing import Pool
+
+import numpy as np
+import xarray as xr
+
+import PWP_shared
+
+#default perturbations: (amplitude, decorrelation time in days, kind). Additive perturbations
+#have the units of the field; multiplicative ones are fractions of it (the field is multiplied
+#by 1+amplitude*noise and kept non-negative, so e.g. there is no sunlight at night).
+PERTURBATIONS = {'tx': (0.02, 1., 'add'),
+                 'ty': (0.02, 1., 'add'),
+                 'sw': (0.1, 2., 'mul'),
+                 'qlat': (0.2, 2., 'mul'),
+                 'precip': (0.3, 1., 'mul')}
+
+#fields of the forcing that depend on the perturbed ones and are stored per member
+MEMBER_VARS = ['tx', 'ty', 'q_in', 'q_out', 'emp']
+
+#factor that converts the latent heat flux into evaporation, as in prep_data
+EVAP_FAC = 0.03456/(86400*1000)
+
+#shared inputs of the ensemble workers, attached once per worker process (see init_worker)
+_worker = {}
+
+def red_noise(nmember, ntime, dt, tau, rng):
+
+    """
+    (nmember, ntime) array of stationary AR1 noise with unit variance and decorrelation time tau,
+    sampled every dt (same units as tau). All members are filtered in one call.
+    """
+
+    from scipy.signal import lfilter
+
+    phi = np.exp(-dt/tau)
+    eps = rng.standard_normal((nmember, ntime))
+
+    #start from the stationary distribution, so that the variance does not grow at first
+    zi = phi*rng.standard_normal((nmember, 1))
+
+    return lfilter([np.sqrt(1-phi**2)], [1., -phi], eps, axis=1, zi=zi)[0]
+
+def make_ensemble(forcing, params, nmember, perturbations=None, seed=0):
+
+    """
+    Generate nmember perturbed versions of a prepared forcing.
+
+    INPUT:
+    forcing, params: as returned by prep_data.
+    nmember: number of ensemble members.
+    perturbations: dict with (amplitude, decorrelation time in days, 'add' or 'mul') of each
+                   perturbed field (see PERTURBATIONS). Fields that are left out are not perturbed.
+                   Fields that are switched off in params (winds_ON etc.) are never perturbed. [None]
+    seed: seed of the random number generator; the same seed gives the same ensemble. [0]
+
+    OUTPUT:
+    xarray Dataset with the (member, time) forcing of each member for the fields in MEMBER_VARS,
+    in the precision of the forcing, plus the perturbations that were applied (d_<field>). The
+    derived fields are recomputed as in prep_data: q_in = sw, q_out = -(lw+qlat+qsens) and
+    emp = |evap|-|precip|, where evap follows the perturbed qlat.
+    """
+
+    if perturbations is None:
+        perturbations = PERTURBATIONS
+    switched_off = {'tx': not params['winds_ON'], 'ty': not params['winds_ON'],
+                    'sw': not params['heat_ON'], 'qlat': not params['heat_ON'], 'precip': not params['emp_ON']}
+
+    rng = np.random.default_rng(seed)
+    time = np.asarray(forcing['time'])
+    ntime = len(time)
+    dtype = np.asarray(forcing['tx']).dtype
+
+    fields = {}
+    perturbed = {}
+    for vname in ['tx', 'ty', 'sw', 'qlat', 'precip']:
+        base = np.asarray(forcing[vname], dtype=np.float64)
+        if vname not in perturbations or switched_off[vname]:
+            fields[vname] = base[np.newaxis, :]
+            continue
+        amp, tau, kind = perturbations[vname]
+        noise = amp*red_noise(nmember, ntime, params['dt_d'], tau, rng)
+        if kind == 'add':
+            fields[vname] = base + noise
+        elif kind == 'mul':
+            fields[vname] = np.maximum(base*(1+noise), 0.)
+        else:
+            raise ValueError("The kind of perturbation must be 'add' or 'mul', got %r" %kind)
+        perturbed[vname] = fields[vname]-base
+
+    lw = np.asarray(forcing['lw'], dtype=np.float64)
+    qsens = np.asarray(forcing['qsens'], dtype=np.float64)
+    evap = np.asarray(forcing['evap'], dtype=np.float64)
+    if 'qlat' in perturbed:
+        evap = evap + EVAP_FAC*perturbed['qlat']
+
+    members = {'tx': fields['tx'], 'ty': fields['ty'], 'q_in': fields['sw'],
+               'q_out': -(lw + fields['qlat'] + qsens)}
+    if params['emp_ON']:
+        emp = np.abs(evap) - np.abs(fields['precip'])
+        emp[np.isnan(emp)] = 0.
+        members['emp'] = emp
+    else:
+        members['emp'] = np.asarray(forcing['emp'], dtype=np.float64)[np.newaxis, :]
+
+    data_vars = {}
+    for vname in MEMBER_VARS:
+        arr = np.broadcast_to(members[vname], (nmember, ntime)).astype(dtype)
+        data_vars[vname] = (['member', 'time'], arr)
+    for vname, arr in perturbed.items():
+        data_vars['d_%s' %vname] = (['member', 'time'], arr.astype(dtype))
+
+    ens = xr.Dataset(data_vars, coords={'member': np.arange(nmember), 'time': time})
+    ens.attrs['seed'] = seed
+    for vname, (amp, tau, kind) in perturbations.items():
+        if vname in perturbed:
+            ens.attrs['perturb_%s' %vname] = '%s amplitude %g, decorrelation time %g days' %(kind, amp, tau)
+
+    return ens
+
+def member_forcing(forcing, ens, i):
+
+    "forcing dict of member i: the base forcing with the member's fields (views of ens) swapped in"
+
+    member = dict(forcing)
+    for vname in MEMBER_VARS:
+        member[vname] = np.asarray(ens[vname])[i]
+
+    return member
+
+def init_worker(forcing_desc, ens_desc, init_desc):
+
+    "Pool initializer: attach the shared forcing, ensemble and initial profiles once per worker process"
+
+    import matplotlib
+    matplotlib.use('Agg')
+    import PWP
+
+    _worker.clear()
+    _worker['forcing'] = PWP_shared.attach(forcing_desc)
+    _worker['ens'] = PWP_shared.attach(ens_desc)
+    _worker['init'] = PWP_shared.attach(init_desc)
+
+def run_member(args):
+
+    "integrate the model for member i of the shared ensemble (see run_ensemble)"
+
+    import PWP
+    import PWP_helper as phf
+
+    i, params, reduce_func = args
+    forcing = member_forcing(_worker['forcing'], _worker['ens'], i)
+    pwp_out = PWP_shared.new_output(_worker['init'], params.get('memmap_dir'))
+
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            pwp_out = PWP.pwpgo(forcing, params, pwp_out, False, plot=False)
+
+        if reduce_func is None:
+            return pwp_out
+        return reduce_func(pwp_out, i)
+    finally:
+        #the output is sent back (or reduced) from the mapped data, the files are not needed
+        phf.remove_memmaps(pwp_out, keep_arrays=True)
+
+def run_ensemble(forcing, pwp_out, params, ens, reduce_func=None, processes=None):
+
+    """
+    Run the model for every member of an ensemble made by make_ensemble, in parallel.
+
+    INPUT:
+    forcing, pwp_out, params: as returned by prep_data.
+    ens: ensemble Dataset from make_ensemble().
+    reduce_func: if given, reduce_func(pwp_out, member) is called in the worker and its result
+                 is returned instead of the full output, e.g. the MLD time series. It is sent to
+                 the workers, so it must be a module level function (not a lambda). [None]
+    processes: number of worker processes. If None, the number of CPUs is used. [None]
+
+    OUTPUT:
+    list with the output (or reduced result) of each member, in order.
+    """
+
+    forcing_desc, forcing_shm = PWP_shared.publish(forcing)
+    ens_desc, ens_shm = PWP_shared.publish({vname: np.ascontiguousarray(ens[vname].values) for vname in MEMBER_VARS})
+    init_desc, init_shm = PWP_shared.publish(PWP_shared.initial_output(pwp_out))
+    jobs = [(i, params, reduce_func) for i in range(ens.sizes['member'])]
+    try:
+        with Pool(processes, initializer=init_worker, initargs=(forcing_desc, ens_desc, init_desc)) as pool:
+            results = pool.map(run_member, jobs, chunksize=1)
+    finally:
+        PWP_shared.release(forcing_shm)
+        PWP_shared.release(ens_shm)
+        PWP_shared.release(init_shm)
+
+    return results
@@ -0,0 +1,133 @@
+"""
+This module contains the mixing event log of the PWP model.
+
+If set_params(log_mixing=True), every mixing stage of every time step that changes the column
+(remove_si: free convection, bulk_mix: bulk Richardson number mixing, grad_mix: gradient
+Richardson number mixing) is recorded as one event: the step and its time, the stage, the depth
+range that was changed and how much it was changed (potential and kinetic energy, largest
+temperature and salinity change). The events are kept as columnar arrays in
+pwp_out['mixing_events'] and are written to the 'mixing_events' group of the output file, so
+the mixing history of a long run can be analysed without reading the (z, time) output.
+
+The events are in time order, so select() finds a time range by bisection:
+
+    >> events = PWP_events.read_events('output/pwp_output.nc')
+    >> convection = PWP_events.select(events, t0=100., t1=200., stage='remove_si')
+"""
+
+import numpy as np
+import xarray as xr
+
+#mixing stages, in the order they are applied. The 'stage' column holds the index into STAGES.
+STAGES = ('remove_si', 'bulk_mix', 'grad_mix')
+
+#columns of the event log and their dtypes
+COLUMNS = (('step', np.int64), ('stage', np.int8), ('z_top', np.float64), ('z_bottom', np.float64),
+           ('d_pe', np.float64), ('d_ke', np.float64), ('max_dtemp', np.float64), ('max_dsal', np.float64))
+
+class MixingLog(object):
+
+    """
+    Collects the mixing events of a run (see module docs).
+
+    The columns are:
+    step: model time step of the event.
+    stage: index of the mixing stage in STAGES.
+    z_top, z_bottom: depth (m) of the shallowest and deepest level that was changed.
+    d_pe: change of the potential energy of the column (J/m^2). Mixing a stable column raises it,
+          convection releases it.
+    d_ke: change of the kinetic energy of the column (J/m^2).
+    max_dtemp, max_dsal: largest change of temperature (C) and salinity at any level.
+    """
+
+    def __init__(self, z, dz, g):
+
+        self.z = np.asarray(z, dtype=np.float64)
+        self.dz = dz
+        self.g = g
+        self.columns = {name: [] for name, _ in COLUMNS}
+
+    def record(self, n, stage, before, state):
+
+        "log the change of the column from before (a copy of state.data) to state, if there is one"
+
+        changed = np.flatnonzero((state.data != before).any(axis=0))
+        if len(changed) == 0:
+            return
+
+        j1 = changed[0]
+        j2 = changed[-1]+1
+        new = state.data[:, j1:j2].astype(np.float64)
+        old = before[:, j1:j2].astype(np.float64)
+        z = self.z[j1:j2]
+
+        #z is positive down, so the height of a level is -z
+        d_pe = -self.g*self.dz*np.dot(new[2]-old[2], z)
+        d_ke = 0.5*self.dz*(np.dot(new[2], new[3]**2+new[4]**2) - np.dot(old[2], old[3]**2+old[4]**2))
+
+        cols = self.columns
+        cols['step'].append(n)
+        cols['stage'].append(STAGES.index(stage))
+        cols['z_top'].append(z[0])
+        cols['z_bottom'].append(z[-1])
+        cols['d_pe'].append(d_pe)
+        cols['d_ke'].append(d_ke)
+        cols['max_dtemp'].append(np.abs(new[0]-old[0]).max())
+        cols['max_dsal'].append(np.abs(new[1]-old[1]).max())
+
+    def mark(self):
+
+        "position in the log, to roll back to (see rollback)"
+
+        return len(self.columns['step'])
+
+    def rollback(self, mark):
+
+        "drop the events logged since mark, e.g. those of a step that is repeated"
+
+        for col in self.columns.values():
+            del col[mark:]
+
+    def finish(self, time):
+
+        "the log as a dict of arrays, with the model time of each event (time is pwp_out['time'])"
+
+        events = {name: np.array(self.columns[name], dtype=dtype) for name, dtype in COLUMNS}
+        time = np.asarray(time)
+        events['time'] = time[np.minimum(events['step'], len(time)-1)]
+
+        return events
+
+def to_dataset(events):
+
+    "event log (dict of arrays) as an xarray Dataset along the 'event' dimension"
+
+    ds = xr.Dataset({name: ('event', np.asarray(arr)) for name, arr in events.items()})
+    ds.attrs['stages'] = ','.join(STAGES)
+
+    return ds
+
+def read_events(fname):
+
+    "read the event log of an output file written by PWP_helper.save_output (as a Dataset)"
+
+    return xr.open_dataset(fname, group='mixing_events')
+
+def select(events, t0=None, t1=None, stage=None):
+
+    """
+    Events with t0 <= time < t1 (either bound can be None) and, optionally, of one stage (a
+    name in STAGES). events is a dict of arrays or a Dataset; the result is of the same kind.
+    """
+
+    time = np.asarray(events['time'])
+    i0 = 0 if t0 is None else np.searchsorted(time, t0, side='left')
+    i1 = len(time) if t1 is None else np.searchsorted(time, t1, side='left')
+    idx = np.arange(i0, i1)
+    if stage is not None:
+        idx = idx[np.asarray(events['stage'])[i0:i1] == STAGES.index(stage)]
+
+    if isinstance(events, xr.Dataset):
+        return events.isel(event=idx)
+
+    return {name: np.asarray(arr)[idx] for name, arr in events.items()}
@@ -0,0 +1,277 @@
+"""
+This module contains a driver that runs the PWP model independently at many stations, e.g. the
+points of a lat/lon grid.
+
+The inputs are a gridded forcing file and a gridded profile file in input_data/. The forcing
+fields ('time', 'sw', 'lw', 'qlat', 'qsens', 'tx', 'ty', 'precip') have the dimensions
+(time, <spatial dims>) and the profile fields ('z', 't', 's', 'lat') have the dimensions
+(z, <spatial dims>), where the spatial dims are either a single 'station' dimension or a grid
+such as ('lat', 'lon'). Both files must have the same spatial dims. Stations whose profile is all
+NaN (e.g. land points) are skipped.
+
+The stations are shared out over a pool of worker processes. The raw forcing and profiles are
+published once in shared memory (see PWP_shared.py) and the workers attach to them read-only,
+so they are neither pickled nor copied per worker. The workers write their results straight
+into memory-mapped output arrays, which are returned as a (station, z, time) Dataset.
+
+Usage:
+
+    >> import PWP_grid
+    >> ds = PWP_grid.run_grid('met_grid.nc', 'prof_grid.nc', param_kwds={'rg': 0.})
+    >> ds.unstack('station') #back to the lat/lon grid, if the inputs were gridded
+"""
+
+import os
+import shutil
+import tempfile
+import timeit
+import contextlib
+from multiprocessing import Pool
+
+import numpy as np
+import xarray as xr
+
+import PWP_shared
+
+MET_VARS = ['sw', 'lw', 'qlat', 'qsens', 'tx', 'ty', 'precip']
+PROF_VARS = ['t', 's']
+
+#shared inputs and memory-mapped outputs, opened once per worker process (see init_worker)
+_shared = {}
+
+def stack_stations(dset, lead_dim):
+
+    """
+    Collapse the spatial dims of a gridded dataset into a single 'station' dimension, which is
+    put last, i.e. the variables become (lead_dim, station).
+    """
+
+    spatial = [d for d in dset[PROF_VARS[0] if lead_dim == 'z' else MET_VARS[0]].dims if d != lead_dim]
+    if spatial == ['station']:
+        return dset.transpose(lead_dim, 'station', ...)
+    if len(spatial) == 1:
+        return dset.rename({spatial[0]: 'station'}).transpose(lead_dim, 'station', ...)
+
+    return dset.stack(station=spatial).transpose(lead_dim, 'station', ...)
+
+def share_inputs(met_dset, prof_dset):
+
+    """
+    Publish the station forcing (station, time) and profiles (station, z) in shared memory (see
+    PWP_shared.py). Returns (descriptor, shm); the descriptor is what the worker processes use to
+    attach to the arrays.
+    """
+
+    arrays = {'met_time': np.asarray(met_dset['time'], dtype=np.float64),
+              'prof_z': np.asarray(prof_dset['z'], dtype=np.float64),
+              'lat': station_lat(prof_dset)}
+    for vname in MET_VARS:
+        arrays[vname] = np.asarray(met_dset[vname], dtype=np.float64).T
+    for vname in PROF_VARS:
+        arrays[vname] = np.asarray(prof_dset[vname], dtype=np.float64).T
+
+    return PWP_shared.publish(arrays)
+
+def station_lat(prof_dset):
+
+    "latitude of each station, whether lat is a grid coordinate or a per-station variable"
+
+    lat = prof_dset['lat']
+    if 'station' not in lat.dims:
+        lat = lat.broadcast_like(prof_dset[PROF_VARS[0]].isel(z=0))
+
+    return np.asarray(lat, dtype=np.float64).reshape(-1)
+
+def init_worker(inputs_desc, out_files, out_shape, dtype):
+
+    "Pool initializer: attach the shared inputs and open the output arrays once per worker process"
+
+    import matplotlib
+    matplotlib.use('Agg')
+    import PWP
+
+    _shared.clear()
+    _shared['inputs'] = PWP_shared.attach(inputs_desc)
+
+    _shared['outputs'] = {}
+    for vname, fname in out_files.items():
+        shape = out_shape if vname != 'mld' else out_shape[:2]
+        _shared['outputs'][vname] = np.memmap(fname, dtype=dtype, mode='r+', shape=shape)
+
+def station_datasets(i):
+
+    "build the forcing and profile datasets of station i (as PWP.run would read them from file)"
+
+    inputs = _shared['inputs']
+    met_dset = xr.Dataset({vname: ('time', inputs[vname][i]) for vname in MET_VARS},
+                          coords={'time': inputs['met_time']})
+    prof_dset = xr.Dataset({vname: ('z', inputs[vname][i]) for vname in PROF_VARS},
+                           coords={'z': inputs['prof_z']})
+    prof_dset['lat'] = inputs['lat'][i]
+
+    return met_dset, prof_dset
+
+def run_station(args):
+
+    """
+    Run the model at station i and write the results into the shared output arrays.
+    Returns (i, elapsed seconds, error), where error is None or the error raised by the run.
+    """
+
+    import PWP
+    import PWP_helper as phf
+
+    i, param_kwds = args
+    t0 = timeit.default_timer()
+    try:
+        met_dset, prof_dset = station_datasets(i)
+        kwds = dict(param_kwds)
+        kwds['lat'] = _shared['inputs']['lat'][i]
+        params = phf.set_params(**kwds)
+
+        #the per-step progress messages of thousands of columns are of no use here
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            #only the initial profiles are needed from prep_data's output
+            forcing, pwp_out, params = phf.prep_data(met_dset, prof_dset, params, alloc=False)
+
+            #let the model write straight into the shared (station, time, z) output arrays
+            outputs = _shared['outputs']
+            for vname in PWP.STATE_VARS:
+                outputs[vname][i, 0] = pwp_out[vname][:, 0]
+                pwp_out[vname] = outputs[vname][i].T
+            pwp_out['mld'] = outputs['mld'][i]
+
+            PWP.pwpgo(forcing, params, pwp_out, False, plot=False)
+        error = None
+    except Exception as err:
+        error = repr(err)
+
+    return i, timeit.default_timer()-t0, error
+
+def output_grid(met_dset, param_kwds):
+
+    """
+    Time and depth vectors and dtype of the output of a single station, as allocated by
+    prep_data. Returns (time_vec, z, dtype).
+    """
+
+    import PWP_helper as phf
+
+    params = phf.set_params(lat=0., **param_kwds)
+    time = np.asarray(met_dset['time'])
+    time_vec = np.arange(time[0], time[-1], params['dt_d'])
+    tlen = int(np.floor(len(time_vec)/params['dt_save']))
+    z = np.arange(0, params['max_depth']+params['dz'], params['dz'])
+
+    return time_vec[:tlen], z, np.dtype(params['precision'])
+
+def run_grid(met_data, prof_data, param_kwds=None, processes=None, chunksize=None, out_dir='output'):
+
+    """
+    Run the PWP model at every station of a gridded forcing and profile dataset.
+
+    INPUT:
+    met_data: gridded forcing, a netCDF file name or an xarray Dataset (see module docs and
+              PWP_helper.load_input).
+    prof_data: gridded initial profiles, a netCDF file name or an xarray Dataset.
+    param_kwds: dict with keyword arguments for set_params (except lat, which is taken from the
+                profile of each station). [None]
+    processes: number of worker processes. If None, the number of CPUs is used. [None]
+    chunksize: number of stations handed to a worker at a time. If None, it is chosen so that
+               each worker gets about 4 chunks. [None]
+    out_dir: the output arrays are memory-mapped files in a new sub-directory of out_dir. The
+             directory is kept as long as the returned Dataset refers to it; remove it with
+             remove_grid_output(ds) when done. ['output']
+
+    OUTPUT:
+    xarray Dataset with the variables temp, sal, dens, uvel, vvel (station, z, time) and mld
+    (station, time). The station coordinate carries the spatial coordinates of the inputs (use
+    ds.unstack('station') to get back to a lat/lon grid). The attrs include the run time and
+    the number of failed stations; the 'failed' variable flags stations whose run raised an error.
+    """
+
+    import PWP
+    import PWP_helper as phf
+
+    if param_kwds is None:
+        param_kwds = {}
+    param_kwds = {key: val for key, val in param_kwds.items() if key != 'lat'}
+
+    t0 = timeit.default_timer()
+    met_data = phf.load_input(met_data)
+    prof_data = phf.load_input(prof_data)
+
+    met_dset = stack_stations(met_data, 'time')
+    prof_dset = stack_stations(prof_data, 'z')
+
+    #skip stations without a profile (e.g. land points)
+    valid = np.flatnonzero(np.isfinite(np.asarray(prof_dset[PROF_VARS[0]])).any(axis=0))
+    met_dset = met_dset.isel(station=valid)
+    prof_dset = prof_dset.isel(station=valid)
+    nstation = len(valid)
+
+    time_vec, z, precision = output_grid(met_dset, param_kwds)
+
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    work_dir = tempfile.mkdtemp(prefix='pwp_grid_', dir=out_dir)
+    inputs_desc, inputs_shm = share_inputs(met_dset, prof_dset)
+    lat = station_lat(prof_dset)
+
+    out_shape = (nstation, len(time_vec), len(z))
+    out_files = {}
+    for vname in list(PWP.STATE_VARS)+['mld']:
+        out_files[vname] = os.path.join(work_dir, 'out_%s.dat' %vname)
+        shape = out_shape if vname != 'mld' else out_shape[:2]
+        np.memmap(out_files[vname], dtype=precision, mode='w+', shape=shape).flush()
+
+    if processes is None:
+        processes = os.cpu_count()
+    if chunksize is None:
+        chunksize = max(1, nstation//(4*processes))
+
+    print("Running %s stations on %s processes..." %(nstation, processes))
+    failed = np.zeros(nstation, dtype=bool)
+    station_time = np.zeros(nstation)
+    jobs = [(i, param_kwds) for i in range(nstation)]
+    try:
+        with Pool(processes, initializer=init_worker, initargs=(inputs_desc, out_files, out_shape, precision)) as pool:
+            for i, elapsed, error in pool.imap_unordered(run_station, jobs, chunksize=chunksize):
+                station_time[i] = elapsed
+                if error is not None:
+                    failed[i] = True
+                    print("Station %s failed: %s" %(i, error))
+    finally:
+        PWP_shared.release(inputs_shm)
+
+    #assemble the (station, z, time) dataset from transposed views of the output files
+    data_vars = {}
+    for vname in PWP.STATE_VARS:
+        arr = np.memmap(out_files[vname], dtype=precision, mode='r', shape=out_shape)
+        data_vars[vname] = (['station', 'z', 'time'], arr.transpose(0, 2, 1))
+    data_vars['mld'] = (['station', 'time'], np.memmap(out_files['mld'], dtype=precision, mode='r', shape=out_shape[:2]))
+    data_vars['failed'] = (['station'], failed)
+    data_vars['station_time'] = (['station'], station_time)
+
+    ds = xr.Dataset(data_vars, coords={'z': z, 'time': time_vec})
+    ds = ds.assign_coords(prof_dset['station'].coords)
+    if 'lat' not in ds.coords:
+        ds = ds.assign_coords(lat=('station', lat))
+
+    t_elapsed = timeit.default_timer()-t0
+    ds.attrs['work_dir'] = work_dir
+    ds.attrs['processes'] = processes
+    ds.attrs['elapsed'] = t_elapsed
+    ds.attrs['n_failed'] = int(failed.sum())
+    print("Time elapsed: %i minutes and %i seconds" %(np.floor(t_elapsed/60), t_elapsed%60))
+
+    return ds
+
+def remove_grid_output(ds):
+
+    "remove the memory-mapped files behind a Dataset returned by run_grid"
+
+    work_dir = ds.attrs['work_dir']
+    ds.close()
+    if os.path.isdir(work_dir):
+        shutil.rmtree(work_dir)
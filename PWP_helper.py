@@ -7,8 +7,12 @@ import numpy as np
 import seawater as sw
 import matplotlib.pyplot as plt
 import PWP
+import PWP_events
+import PWP_sparse
+import PWP_pyramid
 from datetime import datetime
 import warnings
+import os
 
 #warnings.filterwarnings("error")
 #warnings.simplefilter('error', RuntimeWarning)
@@ -74,11 +78,7 @@ def run_demo2(winds_ON=True, emp_ON=True, heat_ON=True, drag_ON=True):
     forcing, pwp_out = PWP.run(met_data=forcing_fname, prof_data=prof_fname, suffix=suffix, save_plots=True, param_kwds=p)
      
 
-<<<<<<< HEAD
-def set_params(lat, dt=3., dz=1., max_depth=277., mld_thresh=1e-4, dt_save=1., rb=0.65, rg=0.25, rkz=0., beta1=0.6, beta2=20.0, heat_ON=True, winds_ON=True, emp_ON=True, drag_ON=True):
-=======
-def set_params(lat, dt=1., dz=1., max_depth=277., mld_thresh=1e-4, dt_save=1., rb=0.65, rg=0.25, rkz=0., beta1=0.6, beta2=20.0, heat_ON=True, winds_ON=True, emp_ON=True, drag_ON=True):
->>>>>>> 9d09f0ada4b8e8be56eff0926702185ddb433d4f
+def set_params(lat, dt=3., dz=1., max_depth=277., mld_thresh=1e-4, dt_save=1., rb=0.65, rg=0.25, rkz=0., beta1=0.6, beta2=20.0, heat_ON=True, winds_ON=True, emp_ON=True, drag_ON=True, precision='float64', memmap_dir=None, adaptive=False, max_sub=0, max_long=3, tau_lo=0.1, tau_hi=0.5, entrain_max=5, log_mixing=False, time_pyramid=False):
     
     """
     This function sets the main paramaters/constants used in the model.
@@ -101,6 +101,35 @@ def set_params(lat, dt=1., dz=1., max_depth=277., mld_thresh=1e-4, dt_save=1., r
     emp_ON: True/False flag to turn ON/OFF freshwater forcing. [True]
     heat_ON: True/False flag to turn ON/OFF surface heat flux forcing. [True]
     drag_ON: True/False flag to turn ON/OFF current drag due to internal-inertial wave breaking. [True]
+    precision: floating point precision of the forcing and output, 'float64' or 'float32'.
+               float32 halves the output size. The model state is always integrated in float64 
+               and only rounded when it is stored, so the drift is mostly the rounding of the 
+               forcing. Note that float32 only resolves density to ~6e-5 kg/m3, which is close to 
+               the default mld_thresh, so the stored density should not be used to recompute the 
+               MLD. See compare_precision() for the resulting drift. ['float64']
+    memmap_dir: if not None, the (z, time) output arrays are backed by np.memmap files that are
+                created in a new sub-directory of memmap_dir, so that the memory needed for the 
+                run does not grow with its length. PWP.run removes the files at the end of the 
+                run; after prep_data and pwpgo, use remove_memmaps(). [None]
+    adaptive: if True, the model takes long steps while the column is quiet and, if max_sub > 0, 
+              sub-cycles while the wind stress or the entrainment is strong (see PWP.pwpgo_adaptive). 
+              The forcing and output stay on the regular dt grid. See compare_adaptive() for the 
+              saving and the resulting drift. [False]
+    max_sub: in adaptive mode, the smallest step is dt/2**max_sub. Sub-cycling adds steps in every 
+             storm, so it is off by default. [0]
+    max_long: in adaptive mode, the longest step is dt*2**max_long. [3]
+    tau_lo: in adaptive mode, steps longer than dt are only taken while the wind stress is below 
+            tau_lo (N/m2). [0.1]
+    tau_hi: in adaptive mode with max_sub > 0, steps are sub-cycled while the wind stress is above 
+            tau_hi (N/m2). [0.5]
+    entrain_max: in adaptive mode, a step is repeated with half the step size (down to 
+                 dt/2**max_sub) if it mixes more than entrain_max levels below the layer mixed in 
+                 the previous step. [5]
+    log_mixing: if True, the changes made by each mixing stage are logged as events (step, stage, depth 
+                range, energy and property change) in pwp_out['mixing_events'] (see PWP_events.py). [False]
+    time_pyramid: if True, daily, weekly and monthly means, minima and maxima of the profiles and the MLD 
+                  are built during the run and stored in pwp_out['time_pyramid'] and in the output file, 
+                  so long runs can be browsed without reading the full record (see PWP_pyramid.py). [False]
     
     OUTPUT is dict with fields containing the above variables plus the following:
     dt_d: time increment (dt) in units of days
@@ -133,11 +162,81 @@ def set_params(lat, dt=1., dz=1., max_depth=277., mld_thresh=1e-4, dt_save=1., r
     params['heat_ON'] = heat_ON
     params['drag_ON'] = drag_ON
     
+    if precision not in ('float64', 'float32'):
+        raise ValueError("precision must be 'float64' or 'float32', got %r" %precision)
+    params['precision'] = precision
+    params['memmap_dir'] = memmap_dir
+    params['adaptive'] = adaptive
+    params['max_sub'] = max_sub
+    params['max_long'] = max_long
+    params['tau_lo'] = tau_lo
+    params['tau_hi'] = tau_hi
+    params['entrain_max'] = entrain_max
+    
+    params['log_mixing'] = log_mixing
+    params['time_pyramid'] = time_pyramid
+    
     return params
     
     
 
-def prep_data(met_dset, prof_dset, params):
+def input_path(fname):
+    
+    "path of an input file: input_data/fname if it exists there, fname otherwise"
+    
+    path = 'input_data/%s' %fname
+    if os.path.exists(path):
+        return path
+    
+    return fname
+
+def load_input(data, struct_name=None):
+    
+    """
+    Return model input (forcing or profile) as a dictionary-like object that prep_data accepts.
+    
+    data can be:
+    - an xarray Dataset or a dict of arrays. These are returned as they are (array-likes in a 
+      dict are converted with np.asarray, which does not copy numpy arrays), so inputs that were 
+      prepared in memory do not have to be written to disk first.
+    - the name of a netCDF file. It is looked up in input_data/ first, then as a path.
+    - the name of a MATLAB file with the met or profile structure of the original PWP code 
+      (e.g. matlab_files/met.mat). The fields of the structure are returned as a dict of 1-D 
+      arrays. If the file holds more than one variable, struct_name selects it. The MATLAB code 
+      counts lw, qlat and qsens as positive out of the ocean, so their signs are flipped to the 
+      convention of this code. Note that prof.mat has no latitude, so lat must then be given in 
+      param_kwds.
+    """
+    
+    import xarray as xr
+    
+    if isinstance(data, xr.Dataset):
+        return data
+    if isinstance(data, dict):
+        return {vname: val if isinstance(val, str) else np.asarray(val) for vname, val in data.items()}
+    
+    fname = input_path(data)
+    if not fname.endswith('.mat'):
+        return xr.open_dataset(fname)
+    
+    import scipy.io
+    mat = scipy.io.loadmat(fname, squeeze_me=True, struct_as_record=False)
+    names = [key for key in mat if not key.startswith('__')]
+    if struct_name is None:
+        if len(names) != 1:
+            raise ValueError("%s contains %s; choose one with struct_name." %(fname, ', '.join(names)))
+        struct_name = names[0]
+    struct = mat[struct_name]
+    
+    #'data' is the same fields again as one matrix
+    dset = {vname: np.atleast_1d(getattr(struct, vname)) for vname in struct._fieldnames if vname != 'data'}
+    for vname in ['lw', 'qlat', 'qsens']:
+        if vname in dset:
+            dset[vname] = -dset[vname]
+    
+    return dset
+    
+def prep_data(met_dset, prof_dset, params, alloc=True):
     
     """
     This function prepares the forcing and profile data for the model run.
@@ -150,7 +249,8 @@ def prep_data(met_dset, prof_dset, params):
     Lastly, this function initializes the numpy arrays to collect the model's output.
     
     INPUT:
-    met_data: dictionary-like object with forcing data. Fields should include: 
+    met_data: dictionary-like object with forcing data (an xarray Dataset or a dict of arrays, see 
+            load_input). Fields should include: 
             ['time', 'sw', 'lw', 'qlat', 'qsens', 'tx', 'ty', 'precip']. These fields should 
             store 1-D time series of the same length. 
             
@@ -165,13 +265,18 @@ def prep_data(met_dset, prof_dset, params):
             TODO: Modify code to accept met_data['time'] as an array of datetime objects
     
             
-    prof_data: dictionary-like object with initial profile data. Fields should include:
+    prof_data: dictionary-like object with initial profile data (an xarray Dataset or a dict of 
+            arrays, see load_input). Fields should include:
             ['z', 't', 's', 'lat']. These represent 1-D vertical profiles of temperature,
             salinity and density. 'lat' is expected to be a length=1 array-like object. e.g. 
             prof_data['lat'] = [25.0]
             
     params: dictionary-like object with fields defined by set_params function
     
+    alloc: if False, the output arrays hold the initial profiles only (one time step, in memory
+            regardless of memmap_dir), for callers that point pwp_out at output arrays of their 
+            own (e.g. PWP_grid). [True]
+    
     OUTPUT:
     
     forcing: dictionary with interpolated surface forcing data. 
@@ -189,6 +294,8 @@ def prep_data(met_dset, prof_dset, params):
     from scipy.interpolate import interp1d
     forcing = {} 
     for vname in met_dset:
+        if vname == 'time':
+            continue
         p_intp = interp1d(met_dset['time'], met_dset[vname], axis=0)
         forcing[vname] = p_intp(time_vec)
         
@@ -228,7 +335,7 @@ def prep_data(met_dset, prof_dset, params):
            
     #define depth coordinate, but first check to see if profile max depth
     #is greater than user defined max depth
-    zmax = max(prof_dset.z)
+    zmax = np.max(np.asarray(prof_dset['z']))
     if zmax < params['max_depth']:
         depth = zmax
         print('Profile input shorter than depth selected, truncating to %sm' %depth)
@@ -252,6 +359,12 @@ def prep_data(met_dset, prof_dset, params):
     forcing['absrb'] = absrb
     params['dstab'] = dstab
     
+    #store the forcing in the requested precision (the time vector is always float64)
+    dtype = np.dtype(params['precision'])
+    for vname in forcing:
+        if vname != 'time':
+            forcing[vname] = forcing[vname].astype(dtype, copy=False)
+    
     #check depth resolution of profile data
     prof_incr = np.diff(prof_dset['z']).mean()
     # if params['dz'] < prof_incr/5.:
@@ -290,13 +403,10 @@ def prep_data(met_dset, prof_dset, params):
     pwp_out['z'] = init_prof['z']
     
     tlen = int(np.floor(tlen/params['dt_save']))
-    arr_sz = (zlen, tlen)
-    pwp_out['temp'] = np.zeros(arr_sz)
-    pwp_out['sal'] = np.zeros(arr_sz)
-    pwp_out['dens'] = np.zeros(arr_sz)
-    pwp_out['uvel'] = np.zeros(arr_sz)
-    pwp_out['vvel'] = np.zeros(arr_sz)
-    pwp_out['mld'] = np.zeros((tlen,))
+    if alloc:
+        alloc_output(pwp_out, tlen, zlen, dtype, params['memmap_dir'])
+    else:
+        alloc_output(pwp_out, 1, zlen, dtype)
     
     #use temp, sal and dens profile data for the first time step
     pwp_out['sal'][:,0] = sal0
@@ -305,6 +415,308 @@ def prep_data(met_dset, prof_dset, params):
     
     return forcing, pwp_out, params
     
+def alloc_output(pwp_out, tlen, zlen, dtype, memmap_dir=None):
+    
+    """
+    Allocate the (z, time) output arrays of pwp_out (PWP.STATE_VARS) and the MLD for tlen time 
+    steps and zlen levels, filled with zeros.
+    
+    The buffers are allocated time-major, i.e. (time, z), so that writing one profile per time 
+    step is a contiguous copy. The (z, time) arrays stored in pwp_out are transposed views of 
+    these buffers. If memmap_dir is not None, the buffers are np.memmap files in a new 
+    sub-directory of memmap_dir, whose path is stored in pwp_out['memmap_dir'] (see 
+    remove_memmaps).
+    """
+    
+    arr_sz = (tlen, zlen)
+    if memmap_dir is not None:
+        #back the buffers with files, so the model writes straight to disk
+        import tempfile
+        if not os.path.isdir(memmap_dir):
+            os.makedirs(memmap_dir)
+        pwp_out['memmap_dir'] = tempfile.mkdtemp(prefix='pwp_out_', dir=memmap_dir)
+    else:
+        pwp_out.pop('memmap_dir', None)
+        
+    for vname in PWP.STATE_VARS:
+        if memmap_dir is None:
+            buf = np.zeros(arr_sz, dtype=dtype)
+        else:
+            fname = os.path.join(pwp_out['memmap_dir'], '%s.dat' %vname)
+            buf = np.memmap(fname, dtype=dtype, mode='w+', shape=arr_sz)
+        pwp_out[vname] = buf.T
+    pwp_out['mld'] = np.zeros((tlen,), dtype=dtype)
+    
+    return pwp_out
+    
+def remove_memmaps(pwp_out, keep_arrays=False):
+    
+    """
+    Delete the memory-mapped output files of a run made with the memmap_dir option. 
+    
+    If keep_arrays is False, the (z, time) arrays in pwp_out are dropped, so save the output 
+    first. If keep_arrays is True, only the files are removed: the arrays stay readable, since 
+    the mapped data of a removed file is kept (on POSIX systems) until the arrays are released.
+    """
+    
+    import shutil
+    
+    if pwp_out.get('memmap_dir') is None:
+        return
+        
+    if not keep_arrays:
+        for vname in PWP.STATE_VARS:
+            pwp_out[vname] = None
+    shutil.rmtree(pwp_out['memmap_dir'])
+    pwp_out['memmap_dir'] = None
+    
+
+def balanced_chunks(shape, itemsize, chunk_bytes=2**18):
+    
+    """
+    Choose a chunk shape for a (z, time) output variable that is balanced between reading 
+    all depths at one time and reading one depth over all times. 
+    
+    Both access patterns touch the same number of chunks (k) if the chunk is a 1/k scaled copy 
+    of the full array, so k is chosen such that each chunk holds roughly chunk_bytes bytes 
+    (before compression). [256 kB]
+    """
+    
+    nz, nt = shape
+    k = np.sqrt(nz*nt*itemsize/float(chunk_bytes))
+    if k <= 1:
+        return (nz, nt)
+        
+    cz = int(min(nz, max(1, np.ceil(nz/k))))
+    ct = int(min(nt, max(1, np.ceil(nt/k))))
+    
+    return (cz, ct)
+    
+
+def save_output(pwp_out, fname, forcing=None, params=None, complevel=4, shuffle=True, quantize=None, 
+                chunk_bytes=2**18, block_size=4096, keyframe_every=None, tolerance=None):
+    
+    """
+    Write the model output to a compressed, chunked netCDF4 file.
+    
+    Every (z, time) variable is zlib compressed (with the byte shuffle filter) and chunked with 
+    balanced_chunks(), so that reading one profile or one depth level over the whole run only 
+    decompresses a small part of the file. The data are written in blocks of block_size time 
+    steps, so no (z, time) array is copied as a whole.
+    
+    INPUT:
+    pwp_out: dictionary with model output (see prep_data).
+    fname: name of the output file.
+    forcing: (optional) dictionary with interpolated forcing. It is stored in the 'forcing' group
+             of the file. Read it with xr.open_dataset(fname, group='forcing').
+    params: (optional) dictionary with model parameters. Scalar parameters are stored as global 
+            attributes.
+    complevel: zlib compression level (1-9). 0 turns compression off. [4]
+    shuffle: True/False flag to turn ON/OFF the shuffle filter. [True]
+    quantize: (optional) dict with the number of decimal digits to retain for each variable,
+              e.g. {'temp': 4, 'sal': 4}. This makes the compression lossy, but much more 
+              effective. [None]
+    chunk_bytes: target (uncompressed) chunk size in bytes. [256 kB]
+    block_size: number of time steps written at a time. [4096]
+    keyframe_every: if given, the (z, time) variables are stored as a full profile every 
+                    keyframe_every steps plus, for the steps in between, only the levels that 
+                    changed (see PWP_sparse.py). read_output() decodes them. [None]
+    tolerance: with keyframe_every, levels that changed by less than the tolerance are not stored,
+               so the stored profiles are within the tolerance of the model output. A number, or 
+               a dict with a tolerance per variable, e.g. {'temp': 1e-4, 'sal': 1e-5}. If None, 
+               the encoding is lossless. [None]
+    """
+    
+    import netCDF4
+    
+    if quantize is None:
+        quantize = {}
+        
+    z = np.asarray(pwp_out['z'])
+    time = np.asarray(pwp_out['time'])
+    zlen = len(z)
+    tlen = pwp_out['mld'].shape[0]
+    comp = {'zlib': complevel>0, 'complevel': max(complevel, 1), 'shuffle': shuffle}
+    
+    #remove an existing file first rather than truncating it, since it may be hard-linked 
+    #elsewhere (see PWP_cache.py)
+    if os.path.exists(fname):
+        os.remove(fname)
+        
+    with netCDF4.Dataset(fname, 'w', format='NETCDF4') as nc:
+        nc.createDimension('z', zlen)
+        nc.createDimension('time', tlen)
+        nc.createVariable('z', 'f8', ('z',))[:] = z
+        nc.createVariable('time', 'f8', ('time',))[:] = time[:tlen]
+        
+        if params is not None:
+            for key, val in params.items():
+                val = np.asarray(val)
+                #one-element parameters, e.g. lat given as [45], are stored as scalars
+                if val.size == 1 and val.dtype.kind in 'biufU':
+                    val = val.reshape(())
+                if val.ndim == 0 and val.dtype.kind in 'biuf':
+                    nc.setncattr(key, val.astype(int) if val.dtype.kind == 'b' else val)
+                elif val.ndim == 0 and val.dtype.kind == 'U':
+                    nc.setncattr(key, str(val))
+        
+        if keyframe_every is not None:
+            nc.setncattr('keyframe_every', keyframe_every)
+            
+        for vname in PWP.STATE_VARS:
+            arr = pwp_out[vname]
+            if keyframe_every is not None:
+                tol = tolerance.get(vname, 0.) if isinstance(tolerance, dict) else (tolerance or 0.)
+                PWP_sparse.write_encoded(nc, vname, arr, keyframe_every, tol, comp)
+                continue
+            chunks = balanced_chunks((zlen, tlen), arr.dtype.itemsize, chunk_bytes)
+            var = nc.createVariable(vname, arr.dtype, ('z', 'time'), chunksizes=chunks, 
+                                    least_significant_digit=quantize.get(vname), **comp)
+            for t0 in range(0, tlen, block_size):
+                var[:, t0:t0+block_size] = arr[:, t0:t0+block_size]
+                
+        nc.createVariable('mld', pwp_out['mld'].dtype, ('time',), 
+                          least_significant_digit=quantize.get('mld'), **comp)[:] = pwp_out['mld']
+                          
+        if forcing is not None:
+            grp = nc.createGroup('forcing')
+            grp.createDimension('time', len(forcing['time']))
+            grp.createDimension('z', zlen)
+            for vname, arr in forcing.items():
+                arr = np.asarray(arr)
+                if arr.dtype.kind not in 'iuf':
+                    continue
+                dim = 'z' if vname == 'absrb' else 'time'
+                grp.createVariable(vname, arr.dtype, (dim,), 
+                                   least_significant_digit=quantize.get(vname), **comp)[:] = arr
+        
+        if 'mixing_events' in pwp_out:
+            #the event log is stored column by column (see PWP_events.py)
+            events = pwp_out['mixing_events']
+            grp = nc.createGroup('mixing_events')
+            grp.createDimension('event', len(events['step']))
+            grp.setncattr('stages', ','.join(PWP_events.STAGES))
+            for vname, arr in events.items():
+                grp.createVariable(vname, arr.dtype, ('event',), **comp)[:] = arr
+        
+        if 'time_pyramid' in pwp_out:
+            PWP_pyramid.write_pyramid(nc, pwp_out['time_pyramid'], comp)
+                                   
+def read_output(fname, vname, time_idx=None, z_idx=None):
+    
+    """
+    Read part of a (z, time) variable from a file written by save_output without loading the rest.
+    
+    read_output(fname, 'temp', time_idx=n) returns the profile at the n-th time step, 
+    read_output(fname, 'temp', z_idx=k) returns the time series at the k-th depth level. 
+    Slices and index arrays are also accepted. Variables stored with the keyframe encoding 
+    (see save_output) are decoded; a time series then needs all steps, so it is slower.
+    """
+    
+    import netCDF4
+    
+    if time_idx is None:
+        time_idx = slice(None)
+    if z_idx is None:
+        z_idx = slice(None)
+        
+    with netCDF4.Dataset(fname, 'r') as nc:
+        if PWP_sparse.is_encoded(nc, vname):
+            return PWP_sparse.read_variable(nc, vname, time_idx)[z_idx]
+        return np.ma.filled(nc.variables[vname][z_idx, time_idx], np.nan)
+    
+def compare_precision(met_dset, prof_dset, param_kwds=None):
+    
+    """
+    Run the model twice, in float64 and in float32 precision, with the same forcing, initial 
+    profile and parameters, and report how far the float32 run drifts from the float64 run.
+    
+    INPUT:
+    met_dset, prof_dset: forcing and profile datasets, as for prep_data.
+    param_kwds: dict with keyword arguments for set_params (the precision key is ignored).
+    
+    OUTPUT:
+    report: dict returned by precision_report().
+    pwp_out64, pwp_out32: the model output of the two runs.
+    """
+    
+    runs = {}
+    for precision in ['float64', 'float32']:
+        kwds = {} if param_kwds is None else dict(param_kwds)
+        kwds['lat'] = prof_dset['lat']
+        kwds['precision'] = precision
+        params = set_params(**kwds)
+        forcing, pwp_out, params = prep_data(met_dset, prof_dset, params)
+        runs[precision] = PWP.pwpgo(forcing, params, pwp_out, False)
+        
+    report = precision_report(runs['float64'], runs['float32'])
+    
+    return report, runs['float64'], runs['float32']
+    
+def compare_adaptive(met_dset, prof_dset, param_kwds=None):
+    
+    """
+    Run the model twice, with the regular step and with adaptive stepping, with the same forcing, 
+    initial profile and parameters, and report the number of steps taken and how far the 
+    adaptive run drifts from the regular run.
+    
+    INPUT:
+    met_dset, prof_dset: forcing and profile datasets, as for prep_data.
+    param_kwds: dict with keyword arguments for set_params (the adaptive key is ignored).
+    
+    OUTPUT:
+    report: dict returned by precision_report(), with the number of model steps of both runs in 
+            report['steps'].
+    pwp_out_fixed, pwp_out_adaptive: the model output of the two runs.
+    """
+    
+    runs = {}
+    for adaptive in [False, True]:
+        kwds = {} if param_kwds is None else dict(param_kwds)
+        kwds['lat'] = prof_dset['lat']
+        kwds['adaptive'] = adaptive
+        params = set_params(**kwds)
+        forcing, pwp_out, params = prep_data(met_dset, prof_dset, params)
+        runs[adaptive] = PWP.pwpgo(forcing, params, pwp_out, False)
+        
+    steps = {'fixed': len(runs[False]['time'])-1, 'adaptive': len(runs[True]['step_sizes'])}
+    print("Steps: %s regular, %s adaptive (%.0f %%)" %(steps['fixed'], steps['adaptive'], 100.*steps['adaptive']/steps['fixed']))
+    report = precision_report(runs[False], runs[True])
+    report['steps'] = steps
+    
+    return report, runs[False], runs[True]
+    
+def precision_report(pwp_out_ref, pwp_out):
+    
+    """
+    Compare the temperature, salinity and MLD of pwp_out against a reference run (usually float64).
+    
+    For temp and sal, the maximum and rms absolute differences over the whole (z, time) record
+    and the difference in the final SST/SSS are reported. For the MLD, the maximum and rms 
+    differences and the fraction of time steps at which the MLD differs are reported. 
+    
+    The report is printed and returned as a dict of dicts.
+    """
+    
+    report = {}
+    for vname in ['temp', 'sal']:
+        diff = np.asarray(pwp_out[vname], dtype=np.float64) - pwp_out_ref[vname]
+        report[vname] = {'max_abs': np.abs(diff).max(), 'rms': np.sqrt(np.mean(diff**2)), 
+                         'final_surf': diff[0, -1]}
+                         
+    diff = np.asarray(pwp_out['mld'], dtype=np.float64) - pwp_out_ref['mld']
+    report['mld'] = {'max_abs': np.abs(diff).max(), 'rms': np.sqrt(np.mean(diff**2)), 
+                     'frac_differs': np.mean(diff != 0)}
+    
+    print("Drift relative to reference run:")
+    for vname in ['temp', 'sal']:
+        print("  %s: max |diff| = %.3g, rms = %.3g, final surface diff = %.3g" 
+              %(vname, report[vname]['max_abs'], report[vname]['rms'], report[vname]['final_surf']))
+    print("  mld: max |diff| = %.3g m, rms = %.3g m, differs at %.1f %% of time steps" 
+          %(report['mld']['max_abs'], report['mld']['rms'], 100*report['mld']['frac_differs']))
+    
+    return report
+    
 def livePlots(pwp_out, n):
     
     """
@@ -502,6 +914,197 @@ def makeSomePlots(forcing, pwp_out, time_vec=None, save_plots=False, suffix=''):
     plt.show()
     
 
+def bin_time(arr, nbins):
+    
+    """
+    Reduce the last (time) axis of arr to at most nbins bins of equal length (the last bin may be 
+    shorter). Returns the bin means, minima and maxima, and the index of the first sample of each 
+    bin. If arr is already short enough, the data are returned as they are.
+    """
+    
+    arr = np.asarray(arr)
+    tlen = arr.shape[-1]
+    if tlen <= nbins:
+        return arr, arr, arr, np.arange(tlen)
+    
+    #put time first. For the time-major output buffers (see prep_data) this is the contiguous axis.
+    work = np.moveaxis(arr, -1, 0)
+    width = int(np.ceil(tlen/float(nbins)))
+    nfull = tlen//width
+    head = work[:nfull*width].reshape((nfull, width) + work.shape[1:])
+    mean, amin, amax = head.mean(axis=1), head.min(axis=1), head.max(axis=1)
+    if nfull*width < tlen:
+        tail = work[nfull*width:]
+        mean = np.concatenate([mean, tail.mean(axis=0)[np.newaxis]])
+        amin = np.concatenate([amin, tail.min(axis=0)[np.newaxis]])
+        amax = np.concatenate([amax, tail.max(axis=0)[np.newaxis]])
+    
+    start = np.arange(0, tlen, width)
+    
+    return np.moveaxis(mean, 0, -1), np.moveaxis(amin, 0, -1), np.moveaxis(amax, 0, -1), start
+    
+def quick_plot_data(forcing, pwp_out, nbins=1000):
+    
+    """
+    Bin the forcing and the temp/sal sections in time for makeQuickPlots(). Returns a small dict
+    with the bin centre times ('time'), the mean/min/max of each forcing field ('<name>_mean', 
+    '<name>_min', '<name>_max'), the binned temp and sal sections and the initial and final profiles.
+    """
+    
+    ntime = np.asarray(pwp_out['mld']).shape[0]
+    data = {'z': np.asarray(pwp_out['z'])}
+    data['time'] = bin_time(np.asarray(pwp_out['time'])[:ntime], nbins)[0]
+    
+    f = dict((vname, np.asarray(forcing[vname])[:ntime]) for vname in ['lw', 'qlat', 'qsens', 'sw', 'tx', 'ty'])
+    mmpd = 1000*3600*24 #convert to mm per day
+    f['qnet'] = np.asarray(forcing['q_in'])[:ntime] - np.asarray(forcing['q_out'])[:ntime]
+    f['emp'] = np.asarray(forcing['emp'])[:ntime]*mmpd
+    f['evap'] = np.asarray(forcing['evap'])[:ntime]*mmpd
+    f['precip'] = np.asarray(forcing['precip'])[:ntime]*mmpd
+    for vname in f:
+        data[vname+'_mean'], data[vname+'_min'], data[vname+'_max'], _ = bin_time(f[vname], nbins)
+        
+    for vname in ['temp', 'sal']:
+        data[vname] = bin_time(pwp_out[vname], nbins)[0]
+        data[vname+'_i'] = np.asarray(pwp_out[vname][:, 0])
+        data[vname+'_f'] = np.asarray(pwp_out[vname][:, ntime-1])
+        
+    return data
+    
+def makeQuickPlots(forcing, pwp_out, save_plots=False, suffix='', nbins=1000, data=None):
+    
+    """
+    Faster version of makeSomePlots() for long runs. 
+    
+    The time axis is binned to about screen resolution (nbins bins) before plotting. The forcing
+    is shown as the bin mean with a min/max envelope, so short events are not lost, and the 
+    temp/sal sections are drawn with a rasterized pcolormesh of the bin means instead of contourf.
+    
+    If data (the output of quick_plot_data) is given, forcing and pwp_out are not used.
+    """
+    
+    if len(suffix)>0 and suffix[0] != '_':
+        suffix = '_%s' %suffix
+        
+    if data is None:
+        data = quick_plot_data(forcing, pwp_out, nbins)
+    tvec = data['time']
+    z = data['z']
+    
+    def envelope(ax, vname, **kwds):
+        line, = ax.plot(tvec, data[vname+'_mean'], **kwds)
+        ax.fill_between(tvec, data[vname+'_min'], data[vname+'_max'], color=line.get_color(), alpha=0.3, lw=0)
+    
+    ## plot surface forcing 
+    fig, axes = plt.subplots(3,1, sharex=True, figsize=(7.5,9))
+    
+    envelope(axes[0], 'lw', label='$Q_{lw}$')
+    envelope(axes[0], 'qlat', label='$Q_{lat}$')
+    envelope(axes[0], 'qsens', label='$Q_{sens}$')
+    envelope(axes[0], 'sw', label='$Q_{sw}$')
+    envelope(axes[0], 'qnet', ls='-', lw=2, color='k', label='$Q_{net}$')
+    axes[0].set_ylabel('Heat flux (W/m2)')
+    axes[0].set_title('Heat flux into ocean')
+    
+    envelope(axes[1], 'tx', label=r'$\tau_x$')
+    envelope(axes[1], 'ty', label=r'$\tau_y$')
+    axes[1].set_ylabel('Wind stress (N/m2)')
+    axes[1].set_title('Wind stress')
+    
+    envelope(axes[2], 'precip', label='$P$', lw=1, color='b')
+    envelope(axes[2], 'evap', label='$-E$', lw=1, color='r')
+    envelope(axes[2], 'emp', label='$|E| - P$', lw=2, color='k')
+    axes[2].set_ylabel('Freshwater forcing (mm/day)')
+    axes[2].set_title('Freshwater forcing')
+    axes[2].set_xlabel('Time (days)')
+    
+    for ax in axes:
+        ax.axhline(0, ls='--', color='0.3')
+        ax.grid(True)
+        ax.legend(loc=0, ncol=2, fontsize='smaller')
+        
+    if save_plots:
+        plt.savefig('plots/surface_forcing%s.png' %suffix, bbox_inches='tight')
+        
+    ## plot temp and sal change over time
+    fig, axes = plt.subplots(2,1, sharex=True)
+    vble = ['temp', 'sal']
+    units = ['$^{\circ}$C', 'PSU']
+    for i in range(2):
+        ax = axes[i]
+        im = ax.pcolormesh(tvec, z, data[vble[i]], cmap=plt.cm.rainbow, shading='nearest', rasterized=True)
+        ax.set_ylabel('Depth (m)')
+        ax.set_title('Evolution of ocean %s (%s)' %(vble[i], units[i]))
+        ax.invert_yaxis()
+        plt.colorbar(im, ax=ax, format='%.1f')
+    ax.set_xlabel('Days')
+    
+    if save_plots:
+        plt.savefig('plots/temp_sal_over_time%s.png' %suffix, bbox_inches='tight')
+        
+    ## plot initial and final T-S profiles
+    fig, host = plt.subplots()
+    host.invert_yaxis()
+    par1 = host.twiny()
+    host.set_ylabel("Depth (m)")
+    host.set_xlabel("Temperature ($^{\circ}$C)")
+    par1.set_xlabel("Salinity (PSU)")
+    
+    p1, = host.plot(data['temp_i'], z, '--r', label='$T_i$')
+    p11, = host.plot(data['temp_f'], z, '-r', label='$T_f$')
+    p2, = par1.plot(data['sal_i'], z, '--b', label='$S_i$')
+    p22, = par1.plot(data['sal_f'], z, '-b', label='$S_f$')
+    host.grid(True)
+    lns = [p1,p11,p2,p22]
+    host.legend(lns, [l.get_label() for l in lns], loc=0, ncol=2)
+    host.xaxis.label.set_color(p1.get_color())
+    par1.xaxis.label.set_color(p2.get_color())
+    
+    if save_plots:
+        fig.savefig('plots/initial_final_TS_profiles%s.png' %suffix, bbox_inches='tight')
+        
+def plot_in_background(forcing, pwp_out, suffix='', nbins=1000):
+    
+    """
+    Save the makeQuickPlots() figures from a separate (headless) process, so the caller can go on 
+    with the next run while the plots are rendered. The data are binned in time before they are 
+    handed over, so only small arrays are sent to the plotting process.
+    
+    Returns the multiprocessing.Process object; call .join() on it to wait for the plots.
+    """
+    
+    import multiprocessing
+    import tempfile
+    
+    #the binned data go through a temporary file, so that starting the process does not block 
+    #on sending them through a pipe
+    data = quick_plot_data(forcing, pwp_out, nbins)
+    fd, data_fname = tempfile.mkstemp(suffix='.npz', prefix='pwp_plot_')
+    with os.fdopen(fd, 'wb') as f:
+        np.savez(f, **data)
+    
+    ctx = multiprocessing.get_context('spawn')
+    proc = ctx.Process(target=save_quick_plots, args=(data_fname, suffix))
+    proc.start()
+    
+    return proc
+    
+def save_quick_plots(data_fname, suffix):
+    
+    "target of plot_in_background(): make and save the plots with the Agg backend"
+    
+    import matplotlib
+    matplotlib.use('Agg')
+    
+    with np.load(data_fname) as f:
+        data = dict(f)
+    os.remove(data_fname)
+    
+    if not os.path.isdir('plots'):
+        os.makedirs('plots')
+    makeQuickPlots(None, None, save_plots=True, suffix=suffix, data=data)
+    plt.close('all')
+    
 def custom_div_cmap(numcolors=11, name='custom_div_cmap', mincol='blue', midcol='white', maxcol='red'):
                     
     """ Create a custom diverging colormap with three colors
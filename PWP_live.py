@@ -0,0 +1,149 @@
+"""
+This module contains the live diagnostics channel of the PWP model.
+
+The model pushes light-weight snapshots of the water column (the ColumnState block, the MLD and
+the time) into a queue every few time steps. A separate process takes them off the queue and
+does all the plotting, so the model loop never waits for matplotlib. If the renderer falls
+behind, new snapshots are dropped instead of blocking the model.
+
+Usage:
+
+    >> live = PWP_live.LiveDiagnostics(pwp_out['z'], every=24)
+    >> pwp_out = PWP.pwpgo(forcing, params, pwp_out, live)
+
+PWP.pwpgo(..., diagnostics=True) does the same with the default settings.
+"""
+
+import multiprocessing
+import queue
+
+import numpy as np
+
+import PWP_diagnostics as pdg
+
+class LiveDiagnostics(object):
+
+    """
+    Non-blocking, throttled channel from the model loop to a renderer process.
+
+    INPUT:
+    z: depth levels of the model grid.
+    every: a snapshot is sent every 'every' time steps. [10]
+    maxsize: number of snapshots that can wait in the queue. Further snapshots are dropped
+             until the renderer catches up. [64]
+    fname: if given, the renderer does not open a window, but saves the figure to this file
+           each time it is updated (useful on machines without a display). [None]
+    """
+
+    def __init__(self, z, every=10, maxsize=64, fname=None):
+
+        self.every = every
+        self.dropped = 0
+
+        ctx = multiprocessing.get_context('spawn')
+        self.queue = ctx.Queue(maxsize)
+        self.proc = ctx.Process(target=render_snapshots, args=(self.queue, np.asarray(z), fname),
+                                daemon=True)
+        self.proc.start()
+
+    def push(self, n, time, state, mld):
+
+        "send a copy of the column state at step n to the renderer (only every 'every' steps)"
+
+        if n % self.every != 0:
+            return
+
+        try:
+            self.queue.put_nowait((n, time, state.data.copy(), mld))
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self, timeout=5.):
+
+        "tell the renderer that the run is over and wait (at most timeout seconds) for it to finish"
+
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        self.proc.join(timeout)
+        if self.dropped > 0:
+            print("Live diagnostics: %s snapshots were dropped." %self.dropped)
+
+def render_snapshots(snap_queue, z, fname=None):
+
+    """
+    Renderer process: plot the depth integrated KE and momentum over time, and the latest
+    velocity, temperature and salinity profiles. Runs until it receives None.
+    """
+
+    import matplotlib
+    if fname is not None:
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    fig = plt.figure(figsize=(12, 8))
+    ax_ke = plt.subplot2grid((2, 4), (0, 0), colspan=4)
+    ax_uv = plt.subplot2grid((2, 4), (1, 0), colspan=2)
+    ax_t = plt.subplot2grid((2, 4), (1, 2))
+    ax_s = plt.subplot2grid((2, 4), (1, 3))
+    ax_mom = ax_ke.twinx()
+
+    ke_line, = ax_ke.plot([], [], 'b.-', label='KE')
+    mom_line, = ax_mom.plot([], [], 'r.-', label='Mom.')
+    ax_ke.set_title('Depth integrated KE (blue) and momentum (red)')
+    ax_ke.grid(True)
+
+    u_line, = ax_uv.plot(np.zeros_like(z), z, 'b', label='uvel')
+    v_line, = ax_uv.plot(np.zeros_like(z), z, 'r', label='vvel')
+    ax_uv.legend(loc=3)
+    t_line, = ax_t.plot(np.zeros_like(z), z, 'b')
+    ax_t.set_xlabel('Temp.')
+    s_line, = ax_s.plot(np.zeros_like(z), z, 'b')
+    ax_s.set_xlabel('Salinity')
+    for ax in [ax_uv, ax_t, ax_s]:
+        ax.invert_yaxis()
+        ax.grid(True)
+    mld_lines = [ax.axhline(0, color='0.5', ls='--') for ax in [ax_uv, ax_t, ax_s]]
+
+    dz = float(z[1]-z[0])
+    times, ke, mom = [], [], []
+    done = False
+    while not done:
+        #block for the next snapshot, then drain whatever else is waiting
+        snaps = [snap_queue.get()]
+        while True:
+            try:
+                snaps.append(snap_queue.get_nowait())
+            except queue.Empty:
+                break
+        if snaps[-1] is None:
+            done = True
+            snaps = snaps[:-1]
+        if len(snaps) == 0:
+            break
+
+        for n, time, data, mld in snaps:
+            temp, sal, dens, uvel, vvel = data
+            times.append(time)
+            ke.append(pdg.kinetic_energy(uvel, vvel, dens, dz))
+            mom.append(pdg.momentum(uvel, vvel, dens, dz))
+
+        ke_line.set_data(times, ke)
+        mom_line.set_data(times, mom)
+        u_line.set_xdata(uvel)
+        v_line.set_xdata(vvel)
+        t_line.set_xdata(temp)
+        s_line.set_xdata(sal)
+        for line in mld_lines:
+            line.set_ydata([mld, mld])
+        for ax in [ax_ke, ax_mom, ax_uv, ax_t, ax_s]:
+            ax.relim()
+            ax.autoscale_view()
+        fig.suptitle('Step %s, day %.2f' %(n, time))
+
+        if fname is None:
+            fig.canvas.draw_idle()
+            plt.pause(0.001)
+        else:
+            fig.savefig(fname)
@@ -0,0 +1,285 @@
+"""
+This module contains a coarse preview mode of the PWP model.
+
+preview() runs the model on a coarser grid (dz and dt multiplied by the factors in coarsen) to
+get an approximate answer in a fraction of the time of the full resolution run. The inputs are
+interpolated to the full resolution grid once (prep_data), and the forcing and initial profile of
+the coarse runs are subsampled from it (see coarsen_prep), so the preview does not pay for
+prep_data on every grid.
+
+The error of the preview is estimated by running the model once more on a grid that is twice as
+coarse again: for a first order scheme, the difference between the two coarse runs is about the
+error of the finer of them. The periods where the estimated error of the MLD or of the SST
+exceeds a tolerance can then be refined: the full resolution model is run over these periods
+only, starting from the preview state, and the result is spliced into the preview.
+
+    >> pv = PWP_preview.preview('SO_met_100day.nc', 'SO_profile1.nc', param_kwds={'rg': 0.25})
+    >> pv['max_err'], pv['periods']
+    >> pv = PWP_preview.preview('SO_met_100day.nc', 'SO_profile1.nc', param_kwds={'rg': 0.25}, refine=True)
+    >> pv['refined']['temp'] #full resolution (z, time) output, refined where the preview was off
+    >> pv = PWP_preview.preview('beaufort_met.nc', 'beaufort_profile.nc', compare=True)
+    >> pv['speedup'], pv['actual_err'] #measured against a full resolution run
+"""
+
+import os
+import timeit
+import contextlib
+
+import numpy as np
+
+def coarse_kwds(param_kwds, params, fz, ft):
+
+    """
+    set_params keywords of the run on a grid with fz times the dz and ft times the dt of params.
+    dt is coarsened less if diffusion would be unstable (dt*rkz/dz**2 > 0.5).
+    """
+
+    kwds = dict(param_kwds)
+    dz = params['dz']*fz
+    while ft > 1 and params['dt']*ft*params['rkz']/dz**2 > 0.5:
+        ft -= 1
+    kwds['dz'] = dz
+    kwds['dt'] = params['dt']*ft/3600.
+    #the preview is not logged or aggregated
+    kwds['log_mixing'] = False
+    kwds['time_pyramid'] = False
+
+    return kwds
+
+def prepare(met_dset, prof_dset, kwds):
+
+    "forcing, pwp_out and params (see prep_data) for the set_params keywords kwds, quietly"
+
+    import PWP_helper as phf
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        params = phf.set_params(**kwds)
+        return phf.prep_data(met_dset, prof_dset, params)
+
+def coarsen_prep(forcing, pwp_out, params, kwds):
+
+    """
+    forcing, pwp_out and params (as returned by prep_data) of the run with the set_params keywords
+    kwds on a coarser grid, from those of the full resolution run. kwds['dt'] and kwds['dz'] must be
+    whole multiples of the full resolution dt and dz (see coarse_kwds). The forcing is subsampled
+    in time, which gives the same values as interpolating the inputs to the coarse time steps, and
+    the initial profiles are interpolated linearly in depth (extrapolated below the full resolution
+    grid, as prep_data does).
+    """
+
+    import PWP
+    import PWP_helper as phf
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        cparams = phf.set_params(**kwds)
+    ft = int(round(cparams['dt']/params['dt']))
+    cparams['dstab'] = cparams['dt']*cparams['rkz']/cparams['dz']**2
+
+    cforcing = {vname: arr[::ft] for vname, arr in forcing.items() if vname != 'absrb'}
+    z = np.arange(0, cparams['max_depth']+cparams['dz'], cparams['dz'])
+    cforcing['absrb'] = PWP.absorb(cparams['beta1'], cparams['beta2'], len(z), cparams['dz']).astype(forcing['absrb'].dtype)
+
+    cout = {'time': cforcing['time'], 'dt': cparams['dt'], 'dz': cparams['dz'], 'lat': cparams['lat'], 'z': z}
+    tlen = int(np.floor(len(cforcing['time'])/cparams['dt_save']))
+    phf.alloc_output(cout, tlen, len(z), pwp_out['temp'].dtype, cparams['memmap_dir'])
+    fz = np.asarray(pwp_out['z'])
+    for vname in ['temp', 'sal']:
+        prof = np.asarray(pwp_out[vname][:, 0], dtype=np.float64)
+        cprof = np.interp(z, fz, prof)
+        below = z > fz[-1]
+        cprof[below] = prof[-1] + (z[below]-fz[-1])*(prof[-1]-prof[-2])/(fz[-1]-fz[-2])
+        cout[vname][:, 0] = cprof
+    cout['dens'][:, 0] = PWP.density(cout['sal'][:, 0], cout['temp'][:, 0])
+
+    return cforcing, cout, cparams
+
+def integrate(forcing, pwp_out, params):
+
+    "run the model quietly, without plots"
+
+    import PWP
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        pwp_out = PWP.pwpgo(forcing, params, pwp_out, False, plot=False)
+
+    return pwp_out
+
+def regrid(pwp_out, z, time):
+
+    "the (z, time) output of a run linearly interpolated to another grid (held at the edges)"
+
+    import PWP
+
+    zc = np.asarray(pwp_out['z'])
+    tc = np.asarray(pwp_out['time'])
+    z = np.clip(z, zc[0], zc[-1])
+    time = np.clip(time, tc[0], tc[-1])
+
+    #interpolation weights in z and time
+    jz = np.clip(np.searchsorted(zc, z, side='right')-1, 0, len(zc)-2)
+    wz = ((z-zc[jz])/(zc[jz+1]-zc[jz]))[:, np.newaxis]
+    jt = np.clip(np.searchsorted(tc, time, side='right')-1, 0, len(tc)-2)
+    wt = (time-tc[jt])/(tc[jt+1]-tc[jt])
+
+    out = {}
+    for vname in PWP.STATE_VARS:
+        arr = np.asarray(pwp_out[vname], dtype=np.float64)
+        arr = arr[jz]*(1-wz) + arr[jz+1]*wz
+        out[vname] = arr[:, jt]*(1-wt) + arr[:, jt+1]*wt
+    mld = np.asarray(pwp_out['mld'], dtype=np.float64)
+    out['mld'] = mld[jt]*(1-wt) + mld[jt+1]*wt
+
+    return out
+
+def error_periods(time, bad, pad):
+
+    "merged (t0, t1) periods around the times where bad is True, widened by pad (days) on both sides"
+
+    periods = []
+    for t in time[bad]:
+        t0, t1 = t-pad, t+pad
+        if periods and t0 <= periods[-1][1]:
+            periods[-1][1] = t1
+        else:
+            periods.append([t0, t1])
+
+    return [(max(t0, time[0]), min(t1, time[-1])) for t0, t1 in periods]
+
+def preview(met_data, prof_data, param_kwds=None, coarsen=(4, 2), tol_mld=5., tol_sst=0.1, pad=1., refine=False, compare=False):
+
+    """
+    Run a coarse preview of a model run, estimate its error and optionally refine it.
+
+    INPUT:
+    met_data, prof_data: model inputs, as for PWP.run.
+    param_kwds: set_params keywords of the full resolution run. [None]
+    coarsen: factors (dz, dt) of the preview grid relative to the full resolution grid. [(4, 2)]
+    tol_mld: tolerance of the MLD error (m). [5]
+    tol_sst: tolerance of the SST error (C). [0.1]
+    pad: the periods where the error exceeds a tolerance are widened by pad days on both sides, so
+         the refined runs have some time to spin up. [1]
+    refine: if True, run the full resolution model over the periods beyond the tolerances. [False]
+    compare: if True, also run the full resolution model over the whole period, to measure the
+             speedup and the actual error of the preview. [False]
+
+    OUTPUT:
+    dict with
+    forcing, pwp_out, params: the preview run (as returned by prep_data and pwpgo).
+    err: estimated error of the preview MLD ('mld') and SST ('sst') at each preview step.
+    max_err: largest estimated errors.
+    periods: list of (t0, t1) periods (days) where the estimated error exceeds a tolerance.
+    timing: seconds spent on preparing the inputs ('prep', on the full resolution grid), the preview,
+            the error estimate and the refinement.
+    If compare is True also
+    full: the full resolution pwp_out.
+    actual_err: actual largest errors of the preview MLD and SST (preview minus full run).
+    speedup: time of the full resolution run (timing['full']) over the time of the preview (prep
+             and preview).
+    If refine is True also
+    refined: full resolution pwp_out, i.e. the preview interpolated to the full resolution grid,
+             with the refined periods replaced by full resolution runs. refined['refined'] flags
+             the steps that were refined.
+    junction: difference of the MLD and SST between the refined run and the preview at the end of
+              each refined period, where the refined output joins the preview again.
+    """
+
+    import PWP
+    import PWP_helper as phf
+    import PWP_shared
+
+    met_dset = phf.load_input(met_data)
+    prof_dset = phf.load_input(prof_data)
+    kwds = dict(param_kwds or {})
+    if 'lat' in prof_dset:
+        kwds['lat'] = float(np.squeeze(np.asarray(prof_dset['lat'])))
+    elif 'lat' not in kwds:
+        raise ValueError("The profile data has no 'lat'. Please pass it in param_kwds.")
+    fine_params = phf.set_params(**kwds)
+    fz, ft = coarsen
+
+    timing = {}
+    t0 = timeit.default_timer()
+    #the inputs are interpolated once, to the full resolution grid
+    fine_forcing, fine_out, fine_params = prepare(met_dset, prof_dset, kwds)
+    t1 = timeit.default_timer()
+    timing['prep'] = t1-t0
+    forcing, pwp_out, params = coarsen_prep(fine_forcing, fine_out, fine_params, coarse_kwds(kwds, fine_params, fz, ft))
+    pwp_out = integrate(forcing, pwp_out, params)
+    phf.remove_memmaps(pwp_out, keep_arrays=True)
+    t2 = timeit.default_timer()
+    timing['preview'] = t2-t1
+
+    #error estimate from a run on a twice coarser grid
+    forcing2, pwp_out2, params2 = coarsen_prep(fine_forcing, fine_out, fine_params, coarse_kwds(kwds, fine_params, 2*fz, 2*ft))
+    pwp_out2 = integrate(forcing2, pwp_out2, params2)
+    time = np.asarray(pwp_out['time'])
+    coarser = regrid(pwp_out2, np.asarray(pwp_out['z']), time)
+    err = {'mld': np.abs(np.asarray(pwp_out['mld'], dtype=np.float64)-coarser['mld']),
+           'sst': np.abs(np.asarray(pwp_out['temp'][0], dtype=np.float64)-coarser['temp'][0])}
+    #the MLD of step 0 is not computed by the model
+    err['mld'][0] = 0.
+    bad = (err['mld'] > tol_mld) | (err['sst'] > tol_sst)
+    periods = error_periods(time, bad, pad)
+    t3 = timeit.default_timer()
+    timing['error'] = t3-t2
+    phf.remove_memmaps(pwp_out2)
+
+    result = {'forcing': forcing, 'pwp_out': pwp_out, 'params': params, 'err': err,
+              'max_err': {key: float(val.max()) for key, val in err.items()},
+              'periods': periods, 'timing': timing}
+    print("Preview on a %g m, %g hour grid in %.1f s. Estimated max error: MLD %.1f m, SST %.3f C. %i period(s) beyond the tolerance."
+          %(params['dz'], params['dt']/3600., timing['prep']+timing['preview'], result['max_err']['mld'], result['max_err']['sst'], len(periods)))
+
+    if compare:
+        init = PWP_shared.initial_output(fine_out)
+        t4 = timeit.default_timer()
+        full = integrate(fine_forcing, PWP_shared.new_output(init, fine_params['memmap_dir']), fine_params)
+        phf.remove_memmaps(full, keep_arrays=True)
+        timing['full'] = timeit.default_timer()-t4+timing['prep']
+        on_preview = regrid(full, np.asarray(pwp_out['z']), time)
+        result['full'] = full
+        result['actual_err'] = {'mld': float(np.abs(np.asarray(pwp_out['mld'], dtype=np.float64)-on_preview['mld'])[1:].max()),
+                                'sst': float(np.abs(np.asarray(pwp_out['temp'][0], dtype=np.float64)-on_preview['temp'][0]).max())}
+        result['speedup'] = timing['full']/(timing['prep']+timing['preview'])
+        print("The full resolution run took %.1f s, %.1f times as long as the preview. Actual max error: MLD %.1f m, SST %.3f C."
+              %(timing['full'], result['speedup'], result['actual_err']['mld'], result['actual_err']['sst']))
+
+    if not refine:
+        phf.remove_memmaps(fine_out)
+        return result
+
+    #full resolution output, starting from the preview, refined over the periods beyond the tolerance
+    t5 = timeit.default_timer()
+    init = PWP_shared.initial_output(fine_out)
+    fine_time = np.asarray(fine_out['time'])
+    refined = regrid(pwp_out, np.asarray(fine_out['z']), fine_time)
+    for vname in PWP.STATE_VARS:
+        refined[vname][:, 0] = init[vname]
+    mask = np.zeros(len(fine_time), dtype=bool)
+    junction = []
+    for ta, tb in periods:
+        i0 = max(np.searchsorted(fine_time, ta, side='right')-1, 0)
+        i1 = min(np.searchsorted(fine_time, tb, side='left'), len(fine_time)-1)
+        if i1 <= i0:
+            continue
+        state = np.array([refined[vname][:, i0] for vname in PWP.STATE_VARS])
+        seg = PWP_shared.run_steps(fine_forcing, init, fine_params, i0, i1, state)
+        if i1 < len(fine_time)-1:
+            junction.append({'time': fine_time[i1], 'mld': float(seg['mld'][-1]-refined['mld'][i1]),
+                             'sst': float(seg['temp'][0, -1]-refined['temp'][0, i1])})
+        for vname in PWP.STATE_VARS:
+            refined[vname][:, i0+1:i1+1] = seg[vname][:, 1:]
+        refined['mld'][i0+1:i1+1] = seg['mld'][1:]
+        phf.remove_memmaps(seg)
+        mask[i0+1:i1+1] = True
+
+    for key in ['z', 'time', 'dt', 'dz', 'lat']:
+        refined[key] = fine_out[key]
+    refined['refined'] = mask
+    phf.remove_memmaps(fine_out)
+    timing['refine'] = timeit.default_timer()-t5
+    result['refined'] = refined
+    result['junction'] = junction
+    print("Refined %.0f %% of the steps at full resolution in %.1f s." %(100*mask.mean(), timing['refine']))
+
+    return result
@@ -0,0 +1,231 @@
+"""
+This module contains the multi-resolution time pyramid of the model output.
+
+If set_params(time_pyramid=True), the profiles and the MLD are aggregated into daily, weekly and
+monthly (30 day) bins while the model runs: the mean, minimum and maximum of every level over
+each bin. The daily bins are built from the time steps as they are produced, and the weekly and
+monthly bins from the daily ones as they are completed, so the pyramid costs a few vector
+operations per step and never needs a second pass over the output. The bins are aligned to whole
+multiples of their width in model time (days), so they nest and are the same across runs.
+
+The pyramid is kept in pwp_out['time_pyramid'] and written to the 'pyramid_<level>' groups of the
+output file. load() picks the coarsest level that resolves the requested time range, so browsing
+a season of a multi-year run reads a few hundred profiles instead of the hourly record:
+
+    >> ds = PWP_pyramid.load('output/pwp_output.nc', t0=100., t1=250., resolution=7.)
+    >> ds['temp'].plot()  # weekly means; ds['temp_min'] and ds['temp_max'] give the range
+"""
+
+import numpy as np
+import xarray as xr
+
+#levels of the pyramid, finest first: (name, bin width in days)
+LEVELS = (('daily', 1.), ('weekly', 7.), ('monthly', 30.))
+
+#aggregated profiles, in the order of the rows of PWP.ColumnState
+PROFILE_VARS = ('temp', 'sal', 'dens', 'uvel', 'vvel')
+
+#guard against rounding when a time lies exactly on a bin edge
+EDGE_TOL = 1e-9
+
+class _Bin(object):
+
+    "running count, time and mean/min/max of the bin of one level that is being filled"
+
+    __slots__ = ('key', 'count', 'tsum', 't_start', 't_end', 'vsum', 'vmin', 'vmax')
+
+    def __init__(self, key, count, tsum, t_start, t_end, vsum, vmin, vmax):
+        self.key = key
+        self.count = count
+        self.tsum = tsum
+        self.t_start = t_start
+        self.t_end = t_end
+        self.vsum = vsum.astype(np.float64)
+        self.vmin = vmin.astype(np.float64)
+        self.vmax = vmax.astype(np.float64)
+
+    def add(self, other):
+        self.count += other.count
+        self.tsum += other.tsum
+        self.t_end = other.t_end
+        self.vsum += other.vsum
+        np.minimum(self.vmin, other.vmin, out=self.vmin)
+        np.maximum(self.vmax, other.vmax, out=self.vmax)
+
+class TimePyramid(object):
+
+    """
+    Incremental builder of the time pyramid (see module docs). Call push() for every output step
+    in time order and finish() at the end of the run.
+    """
+
+    def __init__(self, zlen, levels=LEVELS):
+
+        self.zlen = zlen
+        self.levels = levels
+        self.current = [None]*len(levels)
+        self.done = [[] for _ in levels]
+
+    def push(self, time, profiles, mld):
+
+        "add one output step: its time (days), the (5, nz) profiles (e.g. state.data) and the MLD"
+
+        vec = np.empty(len(PROFILE_VARS)*self.zlen+1)
+        vec[:-1] = np.ravel(profiles)
+        vec[-1] = mld
+        time = float(time)
+        self._add(0, _Bin(None, 1, time, time, time, vec, vec, vec))
+
+    def push_stored(self, pwp_out, n):
+
+        "add the n-th output step of pwp_out"
+
+        profiles = np.array([pwp_out[vname][:, n] for vname in PROFILE_VARS])
+        self.push(pwp_out['time'][n], profiles, pwp_out['mld'][n])
+
+    def _add(self, i, b):
+
+        #the completed bins of the finest level are passed on to all the coarser levels (weeks do not
+        #nest in months, but days nest in both)
+        b.key = int(np.floor(b.t_start/self.levels[i][1] + EDGE_TOL))
+        cur = self.current[i]
+        if cur is not None and cur.key == b.key:
+            cur.add(b)
+            return
+        if cur is not None:
+            self._complete(i)
+        self.current[i] = b
+
+    def _complete(self, i):
+
+        b = self.current[i]
+        self.current[i] = None
+        self.done[i].append(b)
+        if i == 0:
+            for j in range(1, len(self.levels)):
+                self._add(j, _Bin(None, b.count, b.tsum, b.t_start, b.t_end, b.vsum, b.vmin, b.vmax))
+
+    def finish(self):
+
+        """
+        Complete the open bins and return the pyramid as a dict {level name: dict of arrays}. Each
+        level has the mean time of its bins (time), the first and last step in each bin
+        (time_start, time_end), the number of steps (count), and the mean (temp, sal, ...), min
+        (temp_min, ...) and max (temp_max, ...) of each profile (z, bin) and of the MLD (bin).
+        """
+
+        for i in range(len(self.levels)):
+            if self.current[i] is not None:
+                self._complete(i)
+
+        pyramid = {}
+        nvar = len(PROFILE_VARS)
+        for (name, width), bins in zip(self.levels, self.done):
+            count = np.array([b.count for b in bins], dtype=np.int64)
+            level = {'time': np.array([b.tsum for b in bins])/np.maximum(count, 1),
+                     'time_start': np.array([b.t_start for b in bins]),
+                     'time_end': np.array([b.t_end for b in bins]),
+                     'count': count}
+            stats = {'': np.array([b.vsum for b in bins]).reshape(len(bins), -1)/np.maximum(count, 1)[:, np.newaxis],
+                     '_min': np.array([b.vmin for b in bins]).reshape(len(bins), -1),
+                     '_max': np.array([b.vmax for b in bins]).reshape(len(bins), -1)}
+            for suffix, arr in stats.items():
+                prof = arr[:, :-1].reshape(len(bins), nvar, self.zlen)
+                for j, vname in enumerate(PROFILE_VARS):
+                    level[vname+suffix] = prof[:, j, :].T.copy()
+                level['mld'+suffix] = arr[:, -1].copy()
+            pyramid[name] = level
+
+        return pyramid
+
+def write_pyramid(nc, pyramid, comp=None):
+
+    "write the pyramid (see TimePyramid.finish) to the open netCDF4 Dataset nc, one group per level"
+
+    if comp is None:
+        comp = {}
+    widths = dict(LEVELS)
+    for name, level in pyramid.items():
+        grp = nc.createGroup('pyramid_%s' %name)
+        grp.createDimension('bin', len(level['time']))
+        grp.setncattr('bin_width', widths.get(name, np.nan))
+        for vname, arr in level.items():
+            dims = ('z', 'bin') if arr.ndim == 2 else ('bin',)
+            grp.createVariable(vname, arr.dtype, dims, **comp)[:] = arr
+
+def read_level(fname, level):
+
+    "read one level of the pyramid of an output file written by PWP_helper.save_output (as a Dataset)"
+
+    ds = xr.open_dataset(fname, group='pyramid_%s' %level)
+    with xr.open_dataset(fname) as out_ds:
+        z = out_ds['z'].values
+
+    return ds.assign_coords(z=('z', z), bin=ds['time'].values).rename({'bin': 'time_bin'})
+
+def choose_level(resolution, levels=LEVELS):
+
+    "name of the coarsest level with bins no wider than resolution (days), or None if none is"
+
+    best = None
+    for name, width in levels:
+        if width <= resolution*(1+EDGE_TOL):
+            best = name
+
+    return best
+
+def load(fname, t0=None, t1=None, resolution=None, npoints=None):
+
+    """
+    Load the profiles and MLD of an output file over a time range at a given resolution.
+
+    INPUT:
+    fname: output file written by PWP_helper.save_output.
+    t0, t1: time range (days, as pwp_out['time']). Either bound can be None. [None]
+    resolution: coarsest acceptable time resolution in days. [None]
+    npoints: if resolution is None, the resolution is (t1-t0)/npoints, i.e. roughly npoints bins
+             are returned. If both are None, the full resolution is loaded. [None]
+
+    OUTPUT:
+    xarray Dataset. It holds the coarsest level of the pyramid whose bins are no wider than the
+    resolution, with the bins that overlap [t0, t1): the mean (temp, ..., mld), min (temp_min, ...)
+    and max (temp_max, ...) along the 'time_bin' dimension. The 'level' attribute names the
+    level. If no level is fine enough or the file has no pyramid, the full resolution output
+    in the time range is read (level 'full').
+    """
+
+    import netCDF4
+    import PWP_helper as phf
+
+    with netCDF4.Dataset(fname, 'r') as nc:
+        time = nc.variables['time'][:]
+        z = nc.variables['z'][:]
+        available = [name for name, _ in LEVELS if 'pyramid_%s' %name in nc.groups]
+    if t0 is None:
+        t0 = time[0]
+    if t1 is None:
+        t1 = time[-1]+EDGE_TOL
+
+    if resolution is None and npoints is not None:
+        resolution = (t1-t0)/float(npoints)
+    level = None
+    if resolution is not None:
+        level = choose_level(resolution, [lev for lev in LEVELS if lev[0] in available])
+
+    if level is not None:
+        ds = read_level(fname, level)
+        keep = (ds['time_end'].values >= t0) & (ds['time_start'].values < t1)
+        ds = ds.isel(time_bin=np.flatnonzero(keep)).load()
+        ds.attrs['level'] = level
+        ds.close()
+        return ds
+
+    i0, i1 = np.searchsorted(time, [t0, t1], side='left')
+    data_vars = {vname: (('z', 'time'), phf.read_output(fname, vname, time_idx=slice(i0, i1)))
+                 for vname in PROFILE_VARS}
+    with netCDF4.Dataset(fname, 'r') as nc:
+        data_vars['mld'] = ('time', np.asarray(nc.variables['mld'][i0:i1]))
+    ds = xr.Dataset(data_vars, coords={'z': z, 'time': time[i0:i1]})
+    ds.attrs['level'] = 'full'
+
+    return ds
@@ -0,0 +1,394 @@
+"""
+This module contains a batch scheduler for many model runs of different cost.
+
+The cost of a run varies by orders of magnitude: it grows with the number of time steps (forcing
+length over dt) and of levels (max_depth/dz), and gradient Richardson number mixing (rg > 0)
+adds iterations that depend on how convective and sheared the forcing is. Handing such a batch
+to a plain pool in the order it was given leaves most workers idle while the last long runs
+finish. run_batch() instead:
+
+1. predicts the cost of every job from these features with a linear cost model (see
+   job_features) whose coefficients are fitted to the model timings in the run catalog
+   (see PWP_catalog.py), so the predictions improve as more runs are made,
+2. optionally splits long jobs into segments at checkpoints: the state at the end of a segment
+   is the initial state of the next, so the result is the same as that of the whole run, and with
+   a checkpoint_dir finished segments are kept on disk and are not re-run if the batch is
+   restarted. Every job is prepared (prep_data) once, and its segments are run on the prepared
+   forcing, which is published once in shared memory (see PWP_shared.py). Each segment costs a
+   fixed overhead on top of its steps, which the cost model includes when it splits a job,
+3. hands the segments to a process pool longest first (longest remaining chain of segments
+   first), which keeps the tail of the batch short,
+4. reports the makespan of the batch, the predicted makespan, the lower bound and the use of
+   the workers.
+
+The jobs are dicts as for PWP_worker.submit:
+
+    >> jobs = [{'met_data': 'SO_met_100day.nc', 'prof_data': 'SO_profile1.nc', 'param_kwds': {'rg': rg},
+    ...         'suffix': 'rg%g' %rg} for rg in [0., 0.1, 0.25]]
+    >> results, report = PWP_schedule.run_batch(jobs, processes=8, segment_cost=60.)
+"""
+
+import os
+import heapq
+import queue
+import timeit
+from multiprocessing import Pool
+
+import numpy as np
+
+#names of the cost model features (see job_features); each is multiplied by the number of steps
+FEATURES = ('step', 'level', 'rg_level', 'rg_conv_level', 'conv_level')
+
+#coefficients (seconds per step and feature) used until the catalog has enough timed runs
+DEFAULT_COEFS = np.array([2e-4, 1e-5, 5e-5, 1e-4, 0.])
+
+#fixed cost of a segment (seconds): sending it to a worker, starting the model and returning the output
+SEGMENT_OVERHEAD = 0.05
+
+#convective fraction of the forcing files, keyed by (path, mtime, size)
+_conv_cache = {}
+
+def convective_fraction(met_data):
+
+    "fraction of the forcing records with a net surface heat loss, i.e. with convection"
+
+    import xarray as xr
+    import PWP_helper as phf
+
+    path = phf.input_path(met_data)
+    st = os.stat(path)
+    memo_key = (os.path.abspath(path), st.st_mtime, st.st_size)
+    if memo_key not in _conv_cache:
+        with xr.open_dataset(path) as met_dset:
+            q_net = sum(np.asarray(met_dset[vname], dtype=np.float64) for vname in ['sw', 'lw', 'qlat', 'qsens'])
+        _conv_cache[memo_key] = float(np.mean(q_net < 0))
+
+    return _conv_cache[memo_key]
+
+def job_features(nt, nz, rg, conv):
+
+    """
+    cost model features of a run with nt steps, nz levels, critical gradient Richardson number rg
+    and convective fraction conv (see FEATURES): the predicted cost is their dot product with the
+    coefficients.
+    """
+
+    g = float(rg > 0)
+
+    return nt*np.array([1., nz, g*nz, g*conv*nz, conv*nz])
+
+def fit_cost_model(db=None, min_runs=None):
+
+    """
+    Fit the cost model coefficients to the model stage timings of the runs in the catalog (runs
+    that were not taken from the cache, with a forcing file that still exists). The coefficients
+    are non-negative least squares fits. Returns DEFAULT_COEFS if there are fewer than min_runs
+    usable runs [2*len(FEATURES)].
+    """
+
+    from scipy.optimize import nnls
+    import PWP_catalog
+    import PWP_helper as phf
+
+    if min_runs is None:
+        min_runs = 2*len(FEATURES)
+
+    rows = []
+    cost = []
+    for run in PWP_catalog.find(cached=0, db=db):
+        p = run['params']
+        if 'model' not in run['timing'] or run['met_name'] is None or not os.path.exists(phf.input_path(run['met_name'])):
+            continue
+        nz = round(p['max_depth']/p['dz'])+1
+        rows.append(job_features(run['ntime'], nz, p['rg'], convective_fraction(run['met_name'])))
+        cost.append(run['timing']['model'])
+
+    if len(rows) < min_runs:
+        return DEFAULT_COEFS.copy()
+
+    #scale the columns, since the features differ by orders of magnitude
+    X = np.array(rows)
+    scale = np.abs(X).max(axis=0)
+    scale[scale == 0] = 1.
+    coefs, _ = nnls(X/scale, np.array(cost))
+
+    return coefs/scale
+
+def plan_segments(nt, cost, segment_cost=None, overhead=SEGMENT_OVERHEAD):
+
+    """
+    split steps 0..nt-1 into (i0, i1) segments of about segment_cost, including the overhead of
+    each segment (one segment if segment_cost is None, or not larger than twice the overhead)
+    """
+
+    if segment_cost is None or cost+overhead <= segment_cost or segment_cost <= 2*overhead:
+        return [(0, nt-1)]
+    nseg = int(np.ceil(cost/(segment_cost-overhead)))
+    bounds = np.unique(np.linspace(0, nt-1, nseg+1).round().astype(int))
+
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def join_segments(segments, bounds):
+
+    """
+    Stitch the outputs of consecutive segments (see run_segment) into the profiles, MLD and, if
+    logged, mixing events of the whole run. The first step of a segment is the last step of the
+    one before it. bounds are the (i0, i1) steps of the segments.
+    """
+
+    import PWP
+
+    out = {}
+    for vname in PWP.STATE_VARS:
+        out[vname] = np.concatenate([segments[0][vname]]+[seg[vname][:, 1:] for seg in segments[1:]], axis=1)
+    out['mld'] = np.concatenate([segments[0]['mld']]+[seg['mld'][1:] for seg in segments[1:]])
+
+    #the steps of the events are counted from the start of their segment
+    names = [key[len('event_'):] for key in segments[0] if key.startswith('event_')]
+    if names:
+        events = {name: np.concatenate([seg['event_'+name] for seg in segments]) for name in names}
+        events['step'] = np.concatenate([seg['event_step']+i0 for seg, (i0, _) in zip(segments, bounds)])
+        out['mixing_events'] = events
+
+    return out
+
+def simulate(chains, processes):
+
+    """
+    makespan of the list schedule of chains of tasks (lists of durations; the tasks of a chain run
+    one after the other) on processes workers, longest remaining chain first, as in run_batch
+    """
+
+    ready = [(-sum(chain), c, 0) for c, chain in enumerate(chains) if chain]
+    heapq.heapify(ready)
+    running = []
+    now = 0.
+    while ready or running:
+        while ready and len(running) < processes:
+            _, c, k = heapq.heappop(ready)
+            heapq.heappush(running, (now+chains[c][k], c, k))
+        now, c, k = heapq.heappop(running)
+        if k+1 < len(chains[c]):
+            heapq.heappush(ready, (-sum(chains[c][k+1:]), c, k+1))
+
+    return now
+
+def init_worker():
+
+    "Pool initializer (see PWP_worker.init_worker)"
+
+    import PWP_worker
+    PWP_worker.init_worker()
+
+def run_segment(args):
+
+    """
+    Run steps i0..i1 of a prepared job (descriptors of its forcing and initial_output of prep_data,
+    published by run_batch) from state ((5, nz) array, or None for the initial profile) in a worker
+    process (see PWP_shared.run_steps).
+    Returns the job and segment index, the output of the segment (profiles, MLD and the columns
+    of the mixing events as 'event_<name>') and the model time.
+    """
+
+    import PWP
+    import PWP_helper as phf
+    import PWP_shared
+
+    j, k, forcing_desc, init_desc, params, i0, i1, state = args
+
+    t0 = timeit.default_timer()
+    seg_out = PWP_shared.run_steps(PWP_shared.attach(forcing_desc), PWP_shared.attach(init_desc), params, i0, i1, state)
+    t1 = timeit.default_timer()
+
+    out = {vname: np.ascontiguousarray(seg_out[vname]) for vname in PWP.STATE_VARS+('mld',)}
+    for name, arr in seg_out.get('mixing_events', {}).items():
+        out['event_'+name] = arr
+    phf.remove_memmaps(seg_out)
+
+    return j, k, out, t1-t0
+
+def checkpoint_path(checkpoint_dir, key, i0, i1):
+    return os.path.join(checkpoint_dir, '%s_%i_%i.npz' %(key, i0, i1))
+
+def run_batch(jobs, processes=None, coefs=None, segment_cost=None, segment_overhead=SEGMENT_OVERHEAD,
+              checkpoint_dir=None, db=None, verbose=True):
+
+    """
+    Run a batch of jobs on a process pool, longest predicted job first.
+
+    INPUT:
+    jobs: list of dicts with the keys 'met_data' and 'prof_data' (file names, as for PWP.run) and
+          optionally 'param_kwds', 'save_kwds' and 'suffix' (see PWP_worker.run_job).
+    processes: number of worker processes. If None, the number of CPUs is used. [None]
+    coefs: cost model coefficients (see FEATURES). If None, they are fitted to the catalog. [None]
+    segment_cost: jobs predicted to take longer than this (seconds) are split into segments of
+                  about this cost at checkpoints. If None, jobs are not split. Split float64 runs 
+                  are identical to whole ones; float32 runs restart from the rounded state and 
+                  adaptive runs from the regular step at each checkpoint, so they differ slightly. 
+                  The mixing events (log_mixing) of the segments are joined and the time pyramid 
+                  (time_pyramid) is built from the joined output. [None]
+    segment_overhead: fixed cost of each segment (seconds) in the cost model. [SEGMENT_OVERHEAD]
+    checkpoint_dir: if given, every finished segment is saved there, and segments that are found
+                    there (same inputs, parameters, code and steps) are not run again. [None]
+    db: run catalog to fit the cost model to and to record the runs in. [PWP_catalog.CATALOG_DB]
+    verbose: print the makespan report. [True]
+
+    OUTPUT:
+    results: list with the output file of each job, in order.
+    report: dict with the makespan of the batch (seconds), the predicted makespan, the lower
+            bound (total work over the workers, or the longest job), the busy fraction of the
+            workers, the measured overhead per segment, the cost model coefficients and the
+            predicted and actual cost of each job.
+    """
+
+    import contextlib
+    import PWP
+    import PWP_cache
+    import PWP_catalog
+    import PWP_helper as phf
+    import PWP_pyramid
+    import PWP_shared
+    import PWP_worker
+
+    t_start = timeit.default_timer()
+    if processes is None:
+        processes = os.cpu_count()
+    if coefs is None:
+        coefs = fit_cost_model(db)
+
+    #prepare each job once, predict its cost and plan its segments
+    plans = []
+    for job in jobs:
+        t0 = timeit.default_timer()
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            forcing, pwp_out, params = PWP_worker.prepare(job['met_data'], job['prof_data'], job.get('param_kwds'))
+        #the time pyramid is built from the joined output
+        seg_params = dict(params, time_pyramid=False)
+        init = PWP_shared.initial_output(pwp_out)
+        nt, nz = init['tlen'], len(init['z'])
+        cost = float(np.dot(coefs, job_features(nt, nz, params['rg'], convective_fraction(job['met_data']))))
+        segments = plan_segments(nt, cost, segment_cost, segment_overhead)
+        key = PWP_cache.run_key(phf.input_path(job['met_data']), phf.input_path(job['prof_data']), params)
+        plans.append({'params': params, 'seg_params': seg_params, 'forcing': forcing, 'init': init,
+                      'nt': nt, 'cost': cost, 'segments': segments, 'key': key,
+                      'seg_cost': [cost*(i1-i0)/max(nt-1, 1)+segment_overhead for i0, i1 in segments],
+                      'prep': timeit.default_timer()-t0})
+
+    if checkpoint_dir is not None and not os.path.isdir(checkpoint_dir):
+        os.makedirs(checkpoint_dir)
+
+    outputs = [[None]*len(plan['segments']) for plan in plans]
+    seg_time = [[0.]*len(plan['segments']) for plan in plans]
+    seg_wall = []
+
+    def load_checkpoint(j, k):
+        if checkpoint_dir is None:
+            return None
+        fname = checkpoint_path(checkpoint_dir, plans[j]['key'], *plans[j]['segments'][k])
+        if not os.path.exists(fname):
+            return None
+        with np.load(fname) as data:
+            return {vname: data[vname] for vname in data.files}
+
+    #the ready segments are kept in a heap, longest remaining chain first
+    ready = []
+    def make_ready(j, k):
+        #skip the segments that are already checkpointed
+        while k < len(plans[j]['segments']):
+            out = load_checkpoint(j, k)
+            if out is None:
+                break
+            outputs[j][k] = out
+            k += 1
+        if k < len(plans[j]['segments']):
+            heapq.heappush(ready, (-sum(plans[j]['seg_cost'][k:]), j, k))
+
+    for j in range(len(jobs)):
+        make_ready(j, 0)
+
+    #publish the forcing and initial profiles of each job once, so the segments only carry descriptors
+    shms = []
+    try:
+        for plan in plans:
+            plan['forcing_desc'], shm = PWP_shared.publish(plan['forcing'])
+            shms.append(shm)
+            plan['init_desc'], shm = PWP_shared.publish(plan['init'])
+            shms.append(shm)
+        done = queue.Queue()
+        sent = {}
+        with Pool(processes, initializer=init_worker) as pool:
+            while ready or sent:
+                while ready and len(sent) < processes:
+                    _, j, k = heapq.heappop(ready)
+                    plan = plans[j]
+                    i0, i1 = plan['segments'][k]
+                    state = None
+                    if k > 0:
+                        prev = outputs[j][k-1]
+                        state = np.array([prev[vname][:, -1] for vname in PWP.STATE_VARS])
+                    sent[j, k] = timeit.default_timer()
+                    pool.apply_async(run_segment, ((j, k, plan['forcing_desc'], plan['init_desc'], plan['seg_params'], i0, i1, state),),
+                                     callback=done.put, error_callback=done.put)
+
+                result = done.get()
+                if isinstance(result, BaseException):
+                    raise result
+                j, k, out, model_time = result
+                seg_wall.append(timeit.default_timer()-sent.pop((j, k))-model_time)
+                outputs[j][k] = out
+                seg_time[j][k] = model_time
+                if checkpoint_dir is not None:
+                    np.savez(checkpoint_path(checkpoint_dir, plans[j]['key'], *plans[j]['segments'][k]), **out)
+                make_ready(j, k+1)
+    finally:
+        for shm in shms:
+            PWP_shared.release(shm)
+
+    #stitch the segments, save the output and record the runs in the catalog
+    results = []
+    for j, (job, plan) in enumerate(zip(jobs, plans)):
+        t0 = timeit.default_timer()
+        params = plan['params']
+        pwp_out = dict(plan['init'])
+        del pwp_out['tlen']
+        pwp_out.update(join_segments(outputs[j], plan['segments']))
+        if params.get('time_pyramid', False):
+            pyramid = PWP_pyramid.TimePyramid(len(pwp_out['z']))
+            for n in range(plan['nt']):
+                pyramid.push_stored(pwp_out, n)
+            pwp_out['time_pyramid'] = pyramid.finish()
+
+        suffix = job.get('suffix') or 'batch%i' %j
+        if suffix[0] != '_':
+            suffix = '_%s' %suffix
+        fname = os.path.abspath("output/pwp_output%s.nc" %suffix)
+        phf.save_output(pwp_out, fname, forcing=plan['forcing'], params=params, **job.get('save_kwds', {}))
+        timing = {'prep': plan['prep'], 'model': sum(seg_time[j]), 'save': timeit.default_timer()-t0}
+        timing['total'] = sum(timing.values())
+        if all(t > 0 for t in seg_time[j]):
+            #runs resumed from checkpoints would spoil the timings of the cost model
+            PWP_catalog.record(fname, job['met_data'], job['prof_data'], params, pwp_out, timing=timing,
+                               suffix=suffix, db=db)
+        results.append(fname)
+
+    makespan = timeit.default_timer()-t_start
+    busy = sum(map(sum, seg_time))
+    report = {'makespan': makespan,
+              'predicted_makespan': simulate([plan['seg_cost'] for plan in plans], processes),
+              'lower_bound': max(busy/processes, max(map(sum, seg_time))),
+              'busy_fraction': busy/(processes*makespan),
+              'segment_overhead': float(np.mean(seg_wall)) if seg_wall else 0.,
+              'processes': processes,
+              'coefs': dict(zip(FEATURES, coefs)),
+              'jobs': [{'output': fname, 'predicted': plan['cost'], 'actual': sum(seg_time[j]),
+                        'segments': len(plan['segments'])} for j, (fname, plan) in enumerate(zip(results, plans))]}
+
+    if verbose:
+        print("Batch of %i jobs on %i processes: makespan %.1f s (predicted %.1f s, lower bound %.1f s), workers busy %.0f %% of the time, %.2f s overhead per segment."
+              %(len(jobs), processes, report['makespan'], report['predicted_makespan'], report['lower_bound'],
+                100*report['busy_fraction'], report['segment_overhead']))
+        for job in report['jobs']:
+            print("  %s: predicted %.1f s, took %.1f s in %i segment(s)"
+                  %(os.path.basename(job['output']), job['predicted'], job['actual'], job['segments']))
+
+    return results, report
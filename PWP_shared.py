@@ -0,0 +1,220 @@
+"""
+This module publishes read-only model inputs (e.g. the forcing dict from prep_data) to
+worker processes through shared memory.
+
+publish() packs a dict of numpy arrays into a single multiprocessing.shared_memory block and
+returns a small descriptor (block name plus the offset, shape and dtype of each array). The
+descriptor is cheap to pickle, so it can be passed to every worker of a pool; attach() then
+returns numpy views of the block, without copying. However many workers there are, the arrays
+exist in memory only once.
+
+Usage:
+
+    >> desc, shm = PWP_shared.publish(forcing)
+    >> #in a worker process:
+    >> forcing = PWP_shared.attach(desc)
+    >> #when all workers are done:
+    >> PWP_shared.release(shm)
+
+run_many() uses this to integrate the model on one forcing for several parameter sets in
+parallel.
+"""
+
+import os
+from multiprocessing import Pool, shared_memory
+
+import numpy as np
+
+#blocks attached by this process, keyed by name. They must stay open as long as the views are used.
+_attached = {}
+
+#shared inputs of the run_many workers
+_run_inputs = {}
+
+_ALIGN = 64
+
+def publish(arrays):
+
+    """
+    Copy a dict of arrays into a new shared memory block. Entries that are not numpy arrays (or
+    are object arrays) are kept in the descriptor as they are, so e.g. a params dict can be
+    published alongside.
+
+    Returns (descriptor, shm). The caller owns shm and must call release(shm) once the workers are
+    done with it.
+    """
+
+    fields = {}
+    extras = {}
+    offset = 0
+    for vname, arr in arrays.items():
+        if not isinstance(arr, np.ndarray) or arr.dtype.hasobject:
+            extras[vname] = arr
+            continue
+        fields[vname] = (offset, arr.shape, arr.dtype.str)
+        offset += -(-arr.nbytes//_ALIGN)*_ALIGN
+
+    shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+    for vname, (start, shape, dtype) in fields.items():
+        view = np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=start)
+        view[...] = arrays[vname]
+
+    descriptor = {'name': shm.name, 'fields': fields, 'extras': extras}
+
+    return descriptor, shm
+
+def attach(descriptor):
+
+    """
+    Return a dict of read-only numpy views of a block made by publish() (plus the non-array
+    entries). The block is opened once per process.
+    """
+
+    name = descriptor['name']
+    if name not in _attached:
+        _attached[name] = shared_memory.SharedMemory(name=name)
+    shm = _attached[name]
+
+    arrays = dict(descriptor['extras'])
+    for vname, (start, shape, dtype) in descriptor['fields'].items():
+        view = np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=start)
+        view.flags.writeable = False
+        arrays[vname] = view
+
+    return arrays
+
+def detach(descriptor):
+
+    "close this process's handle of a block (all views of it must be gone)"
+
+    shm = _attached.pop(descriptor['name'], None)
+    if shm is not None:
+        shm.close()
+
+def release(shm):
+
+    "close and remove a block made by publish()"
+
+    shm.close()
+    shm.unlink()
+
+def initial_output(pwp_out):
+
+    "the part of an initialized pwp_out (from prep_data) that runs share: grid, scalars and initial profiles"
+
+    import PWP
+
+    init = {'z': pwp_out['z'], 'time': pwp_out['time'], 'dt': pwp_out['dt'], 'dz': pwp_out['dz'],
+            'lat': pwp_out['lat'], 'tlen': len(pwp_out['mld'])}
+    for vname in PWP.STATE_VARS:
+        init[vname] = np.ascontiguousarray(pwp_out[vname][:, 0])
+
+    return init
+
+def new_output(init, memmap_dir=None):
+
+    """
+    a fresh pwp_out for a run, with private (time-major) output arrays, from initial_output(). The
+    arrays are allocated as by prep_data, i.e. memory-mapped if memmap_dir is not None.
+    """
+
+    import PWP
+    import PWP_helper as phf
+
+    pwp_out = dict(init)
+    phf.alloc_output(pwp_out, init['tlen'], len(init['z']), init['temp'].dtype, memmap_dir)
+    for vname in PWP.STATE_VARS:
+        pwp_out[vname][:, 0] = init[vname]
+
+    return pwp_out
+
+def run_steps(forcing, init, params, i0, i1, state=None):
+
+    """
+    Integrate the model over the steps i0..i1 of a prepared forcing, starting from state (a (5, nz)
+    array in the order of PWP.STATE_VARS) or, if None, from the initial profiles in init (see
+    initial_output). Returns a pwp_out with the i1-i0+1 output steps (memory-mapped if
+    params['memmap_dir'] is set; see PWP_helper.remove_memmaps). A run split into consecutive
+    pieces, each started from the last column of the one before, gives the same output as the
+    whole run (float64 runs without adaptive stepping are identical).
+    """
+
+    import contextlib
+    import PWP
+
+    seg_forcing = {vname: (arr if vname == 'absrb' else arr[i0:i1+1]) for vname, arr in forcing.items()}
+    seg_init = dict(init)
+    seg_init['time'] = init['time'][i0:i1+1]
+    seg_init['tlen'] = i1-i0+1
+    if state is not None:
+        for i, vname in enumerate(PWP.STATE_VARS):
+            seg_init[vname] = state[i]
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        return PWP.pwpgo(seg_forcing, params, new_output(seg_init, params.get('memmap_dir')), False, plot=False)
+
+def _init_run_worker(forcing_desc, init_desc):
+
+    "Pool initializer for run_many: attach the shared forcing and initial profiles once per worker"
+
+    import matplotlib
+    matplotlib.use('Agg')
+    import PWP
+
+    _run_inputs['forcing'] = attach(forcing_desc)
+    _run_inputs['init'] = attach(init_desc)
+
+def _run_one(args):
+
+    "integrate the model for one parameter set on the shared forcing (see run_many)"
+
+    import contextlib
+    import PWP
+    import PWP_helper as phf
+
+    params, reduce_func = args
+    forcing = _run_inputs['forcing']
+
+    #only the output arrays are private to the run
+    pwp_out = new_output(_run_inputs['init'], params.get('memmap_dir'))
+
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            pwp_out = PWP.pwpgo(forcing, params, pwp_out, False, plot=False)
+
+        if reduce_func is None:
+            return pwp_out
+        return reduce_func(pwp_out, params)
+    finally:
+        #the output is sent back (or reduced) from the mapped data, the files are not needed
+        phf.remove_memmaps(pwp_out, keep_arrays=True)
+
+def run_many(forcing, pwp_out, params_list, reduce_func=None, processes=None):
+
+    """
+    Run the model on the same prepared forcing for several parameter sets, in parallel.
+
+    INPUT:
+    forcing, pwp_out: as returned by prep_data. The forcing and the initial profiles are published
+                      once in shared memory; only the output arrays are allocated per run.
+    params_list: list of parameter dicts (as returned by set_params). Parameters that are baked
+                 into the forcing by prep_data (dt, dz, max_depth, beta1/beta2 via absrb and the
+                 on/off switches) must be the same for all runs.
+    reduce_func: if given, reduce_func(pwp_out, params) is called in the worker and its result
+                 is returned instead of the full output, e.g. a misfit score. [None]
+    processes: number of worker processes. If None, the number of CPUs is used. [None]
+
+    OUTPUT:
+    list with the output (or reduced result) of each parameter set, in order.
+    """
+
+    forcing_desc, forcing_shm = publish(forcing)
+    init_desc, init_shm = publish(initial_output(pwp_out))
+    try:
+        with Pool(processes, initializer=_init_run_worker, initargs=(forcing_desc, init_desc)) as pool:
+            results = pool.map(_run_one, [(params, reduce_func) for params in params_list], chunksize=1)
+    finally:
+        release(forcing_shm)
+        release(init_shm)
+
+    return results
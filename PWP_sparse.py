@@ -0,0 +1,153 @@
+"""
+This module contains the keyframe + change encoding of the (z, time) model output.
+
+Below the mixed layer, most levels of a profile do not change (or barely change) from one time
+step to the next. Instead of the full column at every step, an encoded variable stores:
+
+- <vname>_key: the full column every keyframe_every steps (key, z).
+- <vname>_idx, <vname>_val: the levels whose value changed by more than the tolerance since the
+  last stored value of that level, and their new values, for all steps one after the other.
+- <vname>_ptr: the changes of step n are entries ptr[n] to ptr[n+1] of _idx and _val.
+
+The changes are taken against the reconstructed column, not the previous exact one, so the
+error of the reconstruction never exceeds the tolerance, however many steps are skipped. With a
+tolerance of 0 the encoding is lossless. The stored values are the model values themselves,
+not differences, so lossless runs are reconstructed bit for bit.
+
+Reading time step n only needs the keyframe before it and the changes in between (at most
+keyframe_every-1 steps). save_output(..., keyframe_every=K) writes this encoding and
+read_output() decodes it transparently.
+"""
+
+import numpy as np
+
+def encode(arr, keyframe_every, tol=0.):
+
+    """
+    Encode a (z, time) array such as pwp_out['temp'], which is read one step at a time. Returns a
+    dict with the arrays key, idx, val and ptr (see module docs). Levels whose value changed by
+    more than tol since it was last stored are stored.
+    """
+
+    nz, nt = arr.shape
+    idx_dtype = np.int16 if nz < 2**15 else np.int32
+
+    keys = []
+    idx_parts = []
+    val_parts = []
+    counts = np.zeros(nt, dtype=np.int64)
+    for n in range(nt):
+        col = np.asarray(arr[:, n])
+        if n % keyframe_every == 0:
+            keys.append(col.copy())
+            recon = col.copy()
+            continue
+        diff = np.abs(col.astype(np.float64)-recon)
+        changed = np.flatnonzero(diff > tol)
+        recon[changed] = col[changed]
+        idx_parts.append(changed.astype(idx_dtype))
+        val_parts.append(col[changed])
+        counts[n] = len(changed)
+
+    ptr = np.zeros(nt+1, dtype=np.int64)
+    ptr[1:] = np.cumsum(counts)
+    empty_idx = np.zeros(0, dtype=idx_dtype)
+    empty_val = np.zeros(0, dtype=arr.dtype)
+
+    return {'key': np.array(keys, dtype=arr.dtype).reshape(-1, nz),
+            'idx': np.concatenate([empty_idx]+idx_parts),
+            'val': np.concatenate([empty_val]+val_parts),
+            'ptr': ptr}
+
+def decode(key, idx, val, ptr, keyframe_every, t0, t1, idx_offset=0):
+
+    """
+    Reconstruct the steps t0..t1-1 as a (z, t1-t0) array. key holds the keyframes from the one at
+    or before t0 onwards, and idx/val the changes from step (t0//keyframe_every)*keyframe_every
+    on; idx_offset is the position of their first entry in the full change arrays (ptr is the
+    full pointer array).
+    """
+
+    k0 = t0//keyframe_every
+    out = np.empty((key.shape[1], t1-t0), dtype=key.dtype)
+    for n in range(k0*keyframe_every, t1):
+        if n % keyframe_every == 0:
+            col = key[n//keyframe_every-k0].copy()
+        else:
+            a = ptr[n]-idx_offset
+            b = ptr[n+1]-idx_offset
+            col[idx[a:b]] = val[a:b]
+        if n >= t0:
+            out[:, n-t0] = col
+
+    return out
+
+def write_encoded(nc, vname, arr, keyframe_every, tol=0., comp=None):
+
+    "write the encoding of the (z, time) array arr to the open netCDF4 Dataset nc (see save_output)"
+
+    if comp is None:
+        comp = {}
+    enc = encode(arr, keyframe_every, tol)
+    if 'key' not in nc.dimensions:
+        nc.createDimension('key', enc['key'].shape[0])
+        nc.createDimension('time_ptr', len(enc['ptr']))
+    nc.createDimension('%s_change' %vname, len(enc['idx']))
+
+    nc.createVariable('%s_key' %vname, enc['key'].dtype, ('key', 'z'), **comp)[:] = enc['key']
+    nc.createVariable('%s_idx' %vname, enc['idx'].dtype, ('%s_change' %vname,), **comp)[:] = enc['idx']
+    nc.createVariable('%s_val' %vname, enc['val'].dtype, ('%s_change' %vname,), **comp)[:] = enc['val']
+    var = nc.createVariable('%s_ptr' %vname, 'i8', ('time_ptr',), **comp)
+    var[:] = enc['ptr']
+    var.setncattr('tolerance', tol)
+
+    return enc
+
+def is_encoded(nc, vname):
+
+    "True if vname is stored with the keyframe + change encoding in the open netCDF4 Dataset nc"
+
+    return vname not in nc.variables and '%s_key' %vname in nc.variables
+
+def read_variable(nc, vname, time_idx=None):
+
+    """
+    Read the steps time_idx (an int, slice or index array; all if None) of a (z, time) variable
+    from the open netCDF4 Dataset nc, whether it is encoded or not. Returns a (z, time) array,
+    or a profile if time_idx is an int.
+    """
+
+    if time_idx is None:
+        time_idx = slice(None)
+    if not is_encoded(nc, vname):
+        return np.ma.filled(nc.variables[vname][:, time_idx], np.nan)
+
+    keyframe_every = int(nc.getncattr('keyframe_every'))
+    ptr_var = nc.variables['%s_ptr' %vname]
+    tlen = len(ptr_var)-1
+
+    steps = np.arange(tlen)[time_idx]
+    if steps.size == 0:
+        return np.zeros((len(nc.dimensions['z']), 0), dtype=nc.variables['%s_key' %vname].dtype)
+    t0 = int(steps.min())
+    t1 = int(steps.max())+1
+
+    #only the keyframes and changes from the keyframe before t0 up to t1 are read
+    k0 = t0//keyframe_every
+    k1 = (t1-1)//keyframe_every+1
+    ptr = ptr_var[:]
+    a = ptr[k0*keyframe_every]
+    b = ptr[t1]
+    key = nc.variables['%s_key' %vname][k0:k1]
+    idx = nc.variables['%s_idx' %vname][a:b]
+    val = nc.variables['%s_val' %vname][a:b]
+
+    out = decode(np.asarray(key), np.asarray(idx), np.asarray(val), ptr, keyframe_every, t0, t1, idx_offset=a)
+
+    return out[:, steps-t0]
+
+def encoded_size(nc, vname):
+
+    "number of bytes of the (uncompressed) encoded variable vname, to compare with z*time*itemsize"
+
+    return sum(nc.variables['%s_%s' %(vname, part)][:].nbytes for part in ['key', 'idx', 'val', 'ptr'])
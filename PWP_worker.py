@@ -0,0 +1,290 @@
+"""
+This module contains a long-running local worker service for the PWP model.
+
+Starting a new python process for every model run means paying for the interpreter,
+matplotlib, xarray and seawater imports, and re-reading the input files, every time. The
+service below keeps the model loaded in a pool of worker processes and accepts run requests
+over a Unix socket. Each worker keeps a small cache of prepared forcing (the output of
+prep_data), so repeated runs with the same inputs skip the file reads and interpolation.
+
+To start the service from the bash command line:
+
+    python PWP_worker.py [socket_address] [number_of_processes]
+
+To submit a run from python:
+
+    >> import PWP_worker
+    >> result = PWP_worker.submit('SO_met_30day.nc', 'SO_profile1.nc', param_kwds={'rg': 0.})
+    >> result['output'], result['timing']
+
+The request returns once the run is complete. Runs from several clients (or threads) are
+spread over the worker processes.
+
+Requests are pickled, so only clients that know the shared key are accepted. The key is taken
+from the PWP_WORKER_AUTHKEY environment variable, or else from the key file ~/.pwp_worker_key,
+which is created (readable by its owner only) on first use. The socket itself is also only
+accessible by its owner.
+"""
+
+import os
+import threading
+import timeit
+import uuid
+from collections import OrderedDict
+from multiprocessing import Pool, AuthenticationError
+from multiprocessing.connection import Listener, Client
+
+DEFAULT_ADDRESS = '/tmp/pwp_worker.sock'
+
+#shared key of the service and its clients (see get_authkey)
+AUTHKEY_ENV = 'PWP_WORKER_AUTHKEY'
+DEFAULT_KEY_FILE = os.path.join(os.path.expanduser('~'), '.pwp_worker_key')
+
+#prepared forcing cached by each worker process (see prepare)
+_prep_cache = OrderedDict()
+_PREP_CACHE_SIZE = 8
+
+def init_worker():
+
+    """
+    Pool initializer. Import the model (and its heavy dependencies) once per worker process.
+    Plots are never shown by the workers, so the non-interactive backend is used.
+    """
+
+    import matplotlib
+    matplotlib.use('Agg')
+    import PWP
+    import PWP_helper
+
+def get_authkey(key_file=None):
+
+    """
+    Key that the service and its clients authenticate each other with: the value of the
+    PWP_WORKER_AUTHKEY environment variable if it is set, otherwise the contents of key_file
+    (DEFAULT_KEY_FILE if None). A missing key file is created with a random key and mode 0600. A
+    key file that is accessible by other users is refused.
+    """
+
+    if os.environ.get(AUTHKEY_ENV):
+        return os.environ[AUTHKEY_ENV].encode()
+
+    if key_file is None:
+        key_file = DEFAULT_KEY_FILE
+    try:
+        fd = os.open(key_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        pass
+    else:
+        with os.fdopen(fd, 'w') as f:
+            f.write(os.urandom(32).hex())
+
+    if os.stat(key_file).st_mode & 0o077:
+        raise PermissionError("The key file %s is accessible by other users. Please make it private "
+                              "(chmod 600 %s)." %(key_file, key_file))
+    with open(key_file) as f:
+        return f.read().strip().encode()
+
+def input_key(fname):
+
+    "cache key of an input file: the path plus its modification time and size"
+
+    import PWP_helper as phf
+
+    path = os.path.abspath(phf.input_path(fname))
+    st = os.stat(path)
+    return (path, st.st_mtime, st.st_size)
+
+def prepare(met_data, prof_data, param_kwds):
+
+    """
+    Return (forcing, pwp_out, params) for the given inputs, as produced by prep_data. Results are
+    cached per worker, keyed by the input files (path, mtime, size) and the parameters. The
+    returned pwp_out must not be modified; use fresh_output() to get arrays to run the model on.
+    """
+
+    import PWP_helper as phf
+
+    if param_kwds is None:
+        param_kwds = {}
+
+    key = (input_key(met_data), input_key(prof_data), repr(sorted(param_kwds.items())))
+    if key in _prep_cache:
+        _prep_cache.move_to_end(key)
+        return _prep_cache[key]
+
+    met_dset = phf.load_input(met_data)
+    prof_dset = phf.load_input(prof_data)
+    kwds = dict(param_kwds)
+    if 'lat' in prof_dset:
+        kwds['lat'] = prof_dset['lat']
+    elif 'lat' not in kwds:
+        raise ValueError("The profile data has no 'lat'. Please pass it in param_kwds.")
+    params = phf.set_params(**kwds)
+    prepped = phf.prep_data(met_dset, prof_dset, params)
+    #only the initial profiles of the prepared output are used (see fresh_output)
+    phf.remove_memmaps(prepped[1], keep_arrays=True)
+
+    _prep_cache[key] = prepped
+    if len(_prep_cache) > _PREP_CACHE_SIZE:
+        _prep_cache.popitem(last=False)
+
+    return prepped
+
+def fresh_output(pwp_out, memmap_dir=None):
+
+    """
+    Make a copy of an initialized pwp_out with new (time-major) output arrays, allocated as by
+    prep_data (memory-mapped if memmap_dir is not None). Only the first time step (the initial
+    profile) is copied over.
+    """
+
+    import PWP
+    import PWP_helper as phf
+
+    new_out = dict(pwp_out)
+    zlen, tlen = pwp_out['temp'].shape
+    phf.alloc_output(new_out, tlen, zlen, pwp_out['temp'].dtype, memmap_dir)
+    for vname in PWP.STATE_VARS:
+        new_out[vname][:, 0] = pwp_out[vname][:, 0]
+
+    return new_out
+
+def run_job(request):
+
+    """
+    Run the model for a single request in a worker process and save the output.
+
+    The request is a dict with the keys 'met_data' and 'prof_data' (file names, as for PWP.run), and optionally 'param_kwds', 'save_kwds' and 'suffix'. If no suffix is given, a
+    unique one is generated so that concurrent jobs do not overwrite each other's output.
+
+    Returns a dict with the output path and the timing (seconds) of each stage.
+    """
+
+    import PWP
+    import PWP_catalog
+    import PWP_helper as phf
+
+    timing = {}
+    t0 = timeit.default_timer()
+
+    forcing, pwp_out, params = prepare(request['met_data'], request['prof_data'], request.get('param_kwds'))
+    pwp_out = fresh_output(pwp_out, params['memmap_dir'])
+    t1 = timeit.default_timer()
+    timing['prep'] = t1-t0
+
+    try:
+        pwp_out = PWP.pwpgo(forcing, params, pwp_out, False, plot=False)
+        t2 = timeit.default_timer()
+        timing['model'] = t2-t1
+
+        suffix = request.get('suffix') or uuid.uuid4().hex[:12]
+        if suffix[0] != '_':
+            suffix = '_%s' %suffix
+        fname = os.path.abspath("output/pwp_output%s.nc" %suffix)
+        phf.save_output(pwp_out, fname, forcing=forcing, params=params, **request.get('save_kwds', {}))
+        t3 = timeit.default_timer()
+        timing['save'] = t3-t2
+        timing['total'] = t3-t0
+        PWP_catalog.record(fname, request['met_data'], request['prof_data'], params, pwp_out, timing=timing, suffix=suffix)
+    finally:
+        phf.remove_memmaps(pwp_out)
+
+    return {'output': fname, 'timing': timing, 'error': None}
+
+def handle_request(conn, request, pool):
+
+    "run a request on the pool and send the result back to the client"
+
+    t_recv = timeit.default_timer()
+    with conn:
+        try:
+            result = pool.apply(run_job, (request,))
+        except Exception as err:
+            result = {'output': None, 'timing': {}, 'error': repr(err)}
+        result['timing']['service'] = timeit.default_timer()-t_recv
+        try:
+            conn.send(result)
+        except (OSError, EOFError):
+            pass #client went away
+
+def serve(address=DEFAULT_ADDRESS, processes=None, key_file=None):
+
+    """
+    Start the worker service and block until it is stopped with stop() (or Ctrl-C).
+
+    INPUT:
+    address: path of the Unix socket to listen on. [/tmp/pwp_worker.sock]
+    processes: number of worker processes. If None, the number of CPUs is used. [None]
+    key_file: file with the key that clients must know (see get_authkey). [DEFAULT_KEY_FILE]
+    """
+
+    authkey = get_authkey(key_file)
+    if os.path.exists(address):
+        os.remove(address)
+
+    pool = Pool(processes, initializer=init_worker)
+    #the socket is created accessible by its owner only
+    umask = os.umask(0o177)
+    try:
+        listener = Listener(address, family='AF_UNIX', authkey=authkey)
+    finally:
+        os.umask(umask)
+    print("PWP worker service listening on %s" %address)
+
+    #each client connection carries a single request, which is handed to its own thread so that
+    #the accept loop is never blocked by a running model
+    try:
+        while True:
+            try:
+                conn = listener.accept()
+            except (AuthenticationError, EOFError, ConnectionError):
+                continue #client without the key, or gone during the handshake
+            try:
+                request = conn.recv()
+            except EOFError:
+                conn.close()
+                continue
+            if not isinstance(request, dict):
+                conn.close()
+                continue
+            if request.get('cmd') == 'stop':
+                conn.close()
+                break
+            threading.Thread(target=handle_request, args=(conn, request, pool), daemon=True).start()
+    finally:
+        listener.close()
+        pool.terminate()
+        if os.path.exists(address):
+            os.remove(address)
+
+def submit(met_data, prof_data, param_kwds=None, save_kwds=None, suffix=None, address=DEFAULT_ADDRESS, key_file=None):
+
+    """
+    Submit a model run to the worker service and wait for the result.
+
+    The arguments have the same meaning as for PWP.run. Returns a dict with the keys 'output'
+    (path of the netCDF output), 'timing' (seconds spent in each stage) and 'error' (None, or the
+    error raised by the run). key_file is the key file of the service (see get_authkey).
+    """
+
+    request = {'cmd': 'run', 'met_data': met_data, 'prof_data': prof_data, 'param_kwds': param_kwds,
+               'save_kwds': save_kwds or {}, 'suffix': suffix}
+
+    with Client(address, family='AF_UNIX', authkey=get_authkey(key_file)) as conn:
+        conn.send(request)
+        return conn.recv()
+
+def stop(address=DEFAULT_ADDRESS, key_file=None):
+
+    "stop the worker service"
+
+    with Client(address, family='AF_UNIX', authkey=get_authkey(key_file)) as conn:
+        conn.send({'cmd': 'stop'})
+
+if __name__ == "__main__":
+
+    import sys
+
+    address = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_ADDRESS
+    processes = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    serve(address, processes)
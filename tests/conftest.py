@@ -0,0 +1,46 @@
+import os
+import sys
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+@pytest.fixture(autouse=True)
+def repo_dir(monkeypatch):
+
+    "run every test from the repository, where the model finds input_data/ and output/"
+
+    monkeypatch.chdir(REPO_DIR)
+    yield REPO_DIR
+    plt.close('all')
+
+@pytest.fixture
+def run_dir(tmp_path, monkeypatch):
+
+    "an empty working directory with input_data/ and output/, so runs do not touch the repository output"
+
+    os.symlink(os.path.join(REPO_DIR, 'input_data'), str(tmp_path/'input_data'))
+    (tmp_path/'output').mkdir()
+    monkeypatch.chdir(tmp_path)
+
+    return tmp_path
+
+def run_model(met_data, prof_data, **kwds):
+
+    "prep_data and pwpgo for the set_params keywords kwds (lat is taken from the profile)"
+
+    import numpy as np
+    import PWP
+    import PWP_helper as phf
+
+    met_dset = phf.load_input(met_data)
+    prof_dset = phf.load_input(prof_data)
+    kwds.setdefault('lat', float(np.squeeze(np.asarray(prof_dset['lat']))))
+    params = phf.set_params(**kwds)
+    forcing, pwp_out, params = phf.prep_data(met_dset, prof_dset, params)
+
+    return PWP.pwpgo(forcing, params, pwp_out, False)
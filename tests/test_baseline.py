@@ -0,0 +1,33 @@
+import os
+
+import numpy as np
+import pytest
+import xarray as xr
+
+import PWP
+from conftest import run_model
+
+#final profiles, surface values and MLD of the first 40 forcing records of the Southern Ocean case,
+#computed in float64 with the model before the state was carried in a ColumnState
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'baseline_so.npz')
+
+CASES = {'rg': {'rg': 0.25, 'max_depth': 150.}, 'diffusion': {'rg': 0., 'rkz': 1e-5}}
+
+#the old model stepped on views of the previous output column, so step n overwrote parts of column
+#n-1: only its last profiles and MLD are comparable as they are, and its stored surface temperature
+#and salinity are those of the next step (the last one is stored twice)
+TOL = 1e-9
+
+@pytest.mark.parametrize('case', sorted(CASES))
+def test_float64_run_matches_baseline(case):
+
+    met = xr.load_dataset('input_data/SO_met_30day.nc').drop_vars('dtime').isel(time=slice(0, 40))
+    prof = xr.load_dataset('input_data/SO_profile1.nc')
+    pwp_out = run_model(met, prof, dt=3., **CASES[case])
+
+    with np.load(BASELINE) as ref:
+        for vname in PWP.STATE_VARS:
+            np.testing.assert_allclose(np.asarray(pwp_out[vname])[:, -1], ref['%s_%s' %(case, vname)], rtol=0, atol=TOL)
+        for vname in ['temp', 'sal']:
+            np.testing.assert_allclose(np.asarray(pwp_out[vname])[0, 1:], ref['%s_surface_%s' %(case, vname)][:-1], rtol=0, atol=TOL)
+        np.testing.assert_array_equal(np.asarray(pwp_out['mld']), ref[case+'_mld'])
@@ -0,0 +1,63 @@
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+import PWP
+import PWP_cache
+import PWP_helper as phf
+
+MET, PROF = 'beaufort_met.nc', 'beaufort_profile.nc'
+
+def cache_key():
+
+    prof = phf.load_input(PROF)
+    params = phf.set_params(lat=prof['lat'])
+    return PWP_cache.run_key(phf.input_path(MET), phf.input_path(PROF), params, {})
+
+def test_identical_run_is_taken_from_cache(run_dir, monkeypatch):
+
+    forcing, out = PWP.run(MET, PROF, suffix='first', catalog=False)
+    assert PWP_cache.lookup(cache_key()) is not None
+
+    def no_integration(*args, **kwds):
+        raise AssertionError("the model was integrated despite a cached result")
+    monkeypatch.setattr(PWP, 'pwpgo', no_integration)
+    forcing2, out2 = PWP.run(MET, PROF, suffix='second', catalog=False)
+
+    for vname in list(PWP.STATE_VARS)+['mld']:
+        np.testing.assert_array_equal(np.asarray(out2[vname]), np.asarray(out[vname]))
+    assert os.path.exists('output/pwp_output_second.nc')
+
+@pytest.mark.parametrize('module, invalidates', [('PWP.py', True), ('PWP_sparse.py', True), ('PWP_events.py', True),
+                                                 ('PWP_pyramid.py', True), ('PWP_worker.py', False), ('PWP_schedule.py', False)])
+def test_module_change_invalidates_cache(run_dir, monkeypatch, module, invalidates):
+
+    #hash a copy of the code, so a module can be changed without touching the repository
+    code_dir = run_dir/'code'
+    code_dir.mkdir()
+    for fname in PWP_cache.CODE_MODULES+[module]:
+        shutil.copy(os.path.join(os.path.dirname(PWP_cache.__file__), fname), str(code_dir/fname))
+    monkeypatch.setattr(PWP_cache, '__file__', str(code_dir/'PWP_cache.py'))
+
+    PWP.run(MET, PROF, catalog=False)
+    assert PWP_cache.lookup(cache_key()) is not None
+
+    with open(str(code_dir/module), 'a') as f:
+        f.write('\n#changed\n')
+    assert (PWP_cache.lookup(cache_key()) is None) == invalidates
+
+def test_cached_run_with_one_element_lat(run_dir):
+
+    #the profile as a dict of arrays, with lat in the documented one-element form
+    prof = phf.load_input(PROF)
+    prof = {vname: np.asarray(prof[vname]) for vname in prof.variables}
+    prof['lat'] = np.array([-55.])
+
+    forcing, out = PWP.run(MET, prof, suffix='first', catalog=False)
+    forcing2, out2 = PWP.run(MET, prof, suffix='second', catalog=False)
+
+    assert float(out2['lat']) == -55.
+    for vname in list(PWP.STATE_VARS)+['mld']:
+        np.testing.assert_array_equal(np.asarray(out2[vname]), np.asarray(out[vname]))
@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+import PWP_catalog
+import PWP_helper as phf
+from conftest import run_model
+
+MET, PROF = 'beaufort_met.nc', 'beaufort_profile.nc'
+
+@pytest.fixture
+def catalog(run_dir):
+
+    "a catalog with three Beaufort runs (rg = 0, 0.1, 0.25) recorded under the file names of the inputs"
+
+    db = str(run_dir/'output'/'catalog.sqlite')
+    for rg in [0., 0.1, 0.25]:
+        pwp_out = run_model(MET, PROF, rg=rg)
+        params = phf.set_params(lat=float(np.squeeze(np.asarray(phf.load_input(PROF)['lat']))), rg=rg)
+        PWP_catalog.record('output/run_rg%g.nc' %rg, MET, PROF, params, pwp_out, timing={'model': 1.}, db=db)
+
+    return db
+
+def test_find_by_parameter(catalog):
+
+    runs = PWP_catalog.find(params={'rg': 0.25}, db=catalog)
+    assert [r['params']['rg'] for r in runs] == [0.25]
+    assert runs[0]['out_fname'].endswith('run_rg0.25.nc')
+
+    #tolerance of float matches, and ranges
+    assert len(PWP_catalog.find(params={'rg': 0.25+1e-12}, db=catalog)) == 1
+    assert sorted(r['params']['rg'] for r in PWP_catalog.find(params={'rg': (0.05, 1.)}, db=catalog)) == [0.1, 0.25]
+
+def test_find_with_patterns_and_order(catalog):
+
+    runs = PWP_catalog.find(met_name='beaufort*', order_by='max_mld', descending=True, db=catalog)
+    assert len(runs) == 3
+    max_mld = [r['max_mld'] for r in runs]
+    assert max_mld == sorted(max_mld, reverse=True)
+    assert all(r['timing'] == {'model': 1.} for r in runs)
+
+    assert PWP_catalog.find(met_name='Svalbard*', db=catalog) == []
+    assert len(PWP_catalog.find(params={'rg': 0.}, prof_name=PROF, limit=5, db=catalog)) == 1
+
+def test_find_rejects_unknown_columns(catalog):
+
+    with pytest.raises(ValueError):
+        PWP_catalog.find(order_by='nonsense', db=catalog)
+    with pytest.raises(ValueError):
+        PWP_catalog.find(nonsense=1, db=catalog)
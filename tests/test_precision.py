@@ -0,0 +1,18 @@
+import numpy as np
+
+from conftest import run_model
+
+#the Southern Ocean configuration that used to blow up in float32 (NaN density at ~300 m)
+SO_KWDS = dict(dt=3., dz=2., max_depth=500., rkz=1e-6, rg=0.25)
+
+def test_float32_so_matches_float64():
+
+    ref = run_model('SO_met_30day.nc', 'SO_profile1.nc', precision='float64', **SO_KWDS)
+    out = run_model('SO_met_30day.nc', 'SO_profile1.nc', precision='float32', **SO_KWDS)
+
+    assert out['temp'].dtype == np.float32
+    for vname in ['temp', 'sal', 'dens', 'mld']:
+        assert np.isfinite(out[vname]).all()
+    np.testing.assert_allclose(out['temp'], ref['temp'], rtol=0, atol=1e-3)
+    np.testing.assert_allclose(out['sal'], ref['sal'], rtol=0, atol=1e-3)
+    np.testing.assert_allclose(out['mld'], ref['mld'], rtol=0, atol=2*SO_KWDS['dz'])
@@ -0,0 +1,36 @@
+import numpy as np
+import xarray as xr
+
+import PWP
+import PWP_events
+import PWP_pyramid
+import PWP_schedule
+
+MET, PROF = 'beaufort_met.nc', 'beaufort_profile.nc'
+
+def test_split_job_matches_whole_job(run_dir):
+
+    job = {'met_data': MET, 'prof_data': PROF, 'param_kwds': {'log_mixing': True, 'time_pyramid': True}}
+    coefs = PWP_schedule.DEFAULT_COEFS
+    db = str(run_dir/'output'/'catalog.sqlite')
+
+    (whole,), report = PWP_schedule.run_batch([dict(job, suffix='whole')], processes=1, coefs=coefs, db=db, verbose=False)
+    assert report['jobs'][0]['segments'] == 1
+    cost = report['jobs'][0]['predicted']
+    (split,), report = PWP_schedule.run_batch([dict(job, suffix='split')], processes=1, coefs=coefs, db=db, verbose=False,
+                                              segment_cost=cost/3+2*PWP_schedule.SEGMENT_OVERHEAD)
+    assert report['jobs'][0]['segments'] == 3
+
+    with xr.open_dataset(whole) as a, xr.open_dataset(split) as b:
+        for vname in list(PWP.STATE_VARS)+['mld']:
+            np.testing.assert_array_equal(b[vname].values, a[vname].values)
+
+    with PWP_events.read_events(whole) as a, PWP_events.read_events(split) as b:
+        assert a.sizes['event'] > 0
+        for vname in a.data_vars:
+            np.testing.assert_array_equal(b[vname].values, a[vname].values)
+
+    for level, _ in PWP_pyramid.LEVELS:
+        with PWP_pyramid.read_level(whole, level) as a, PWP_pyramid.read_level(split, level) as b:
+            for vname in a.data_vars:
+                np.testing.assert_array_equal(b[vname].values, a[vname].values)
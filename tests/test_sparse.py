@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+import PWP
+import PWP_helper as phf
+import PWP_sparse
+from conftest import run_model
+
+MET, PROF = 'beaufort_met.nc', 'beaufort_profile.nc'
+KEYFRAME_EVERY = 16
+
+@pytest.fixture
+def pwp_out():
+    return run_model(MET, PROF)
+
+def test_encode_decode_is_lossless(pwp_out):
+
+    arr = np.asarray(pwp_out['temp'])
+    enc = PWP_sparse.encode(arr, KEYFRAME_EVERY)
+    nt = arr.shape[1]
+    np.testing.assert_array_equal(PWP_sparse.decode(enc['key'], enc['idx'], enc['val'], enc['ptr'], KEYFRAME_EVERY, 0, nt), arr)
+
+    #a slice starting between keyframes
+    t0, t1 = KEYFRAME_EVERY+5, nt-3
+    k0 = t0//KEYFRAME_EVERY
+    a = enc['ptr'][k0*KEYFRAME_EVERY]
+    out = PWP_sparse.decode(enc['key'][k0:], enc['idx'][a:], enc['val'][a:], enc['ptr'], KEYFRAME_EVERY, t0, t1, idx_offset=a)
+    np.testing.assert_array_equal(out, arr[:, t0:t1])
+
+def test_encoding_error_is_within_tolerance(pwp_out):
+
+    tol = 1e-3
+    arr = np.asarray(pwp_out['sal'])
+    enc = PWP_sparse.encode(arr, KEYFRAME_EVERY, tol)
+    out = PWP_sparse.decode(enc['key'], enc['idx'], enc['val'], enc['ptr'], KEYFRAME_EVERY, 0, arr.shape[1])
+    assert np.abs(out-arr).max() <= tol
+    assert len(enc['val']) < arr.size//2
+
+def test_saved_encoding_round_trip(pwp_out, run_dir):
+
+    fname = str(run_dir/'output'/'sparse.nc')
+    phf.save_output(pwp_out, fname, keyframe_every=KEYFRAME_EVERY)
+    nt = len(pwp_out['time'])
+    for vname in PWP.STATE_VARS:
+        arr = np.asarray(pwp_out[vname])
+        np.testing.assert_array_equal(phf.read_output(fname, vname), arr)
+        np.testing.assert_array_equal(phf.read_output(fname, vname, time_idx=nt//2), arr[:, nt//2])
+        np.testing.assert_array_equal(phf.read_output(fname, vname, time_idx=slice(3, nt, 7)), arr[:, 3::7])